@@ -1,30 +1,107 @@
-from fastapi import FastAPI
-from fastapi.responses import Response
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import FileResponse, StreamingResponse
+from starlette.background import BackgroundTask
 from pydantic import BaseModel
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterator, Optional, Sequence, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import asyncio
 import io
+import logging
+import os
+import tempfile
+import time
+import zipfile
+
+from shared.pdf_cache import PDFCache, pdf_cache_key
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI(title="PDF Generation Service")
 
+# ReportLab рендерит в отдельных процессах, чтобы не блокировать event loop
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(os.cpu_count() or 1)))
+# Сколько рендеров может быть в работе и в очереди, дальше отвечаем 429
+PDF_MAX_QUEUE = int(os.getenv("PDF_MAX_QUEUE", str(PDF_WORKERS * 4)))
+PDF_RETRY_AFTER = int(os.getenv("PDF_RETRY_AFTER", "2"))
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+PDF_CACHE_DIR = os.getenv("PDF_CACHE_DIR", os.path.join(tempfile.gettempdir(), "pdf-cache"))
+PDF_CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+pdf_cache: Optional[PDFCache] = PDFCache(PDF_CACHE_DIR, PDF_CACHE_MAX_BYTES) if PDF_CACHE_DIR else None
+
+_render_pool: Optional[ProcessPoolExecutor] = None
+_pending_renders = 0
+
 class PDFGenerationRequest(BaseModel):
     type: str
     data: Dict[str, Any]
 
+class PDFBundleRequest(BaseModel):
+    data: Dict[str, Any]
+
+@app.on_event("startup")
+async def startup_event():
+    global _render_pool
+    _render_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS)
+    logger.info(f"PDF render pool started with {PDF_WORKERS} workers, queue limit {PDF_MAX_QUEUE}")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    global _render_pool
+    if _render_pool is not None:
+        _render_pool.shutdown(wait=True, cancel_futures=True)
+        _render_pool = None
+
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy"}
+    return {
+        "status": "healthy",
+        "render_workers": PDF_WORKERS,
+        "pending_renders": _pending_renders,
+        "max_queue": PDF_MAX_QUEUE,
+        "cache": pdf_cache.stats() if pdf_cache else None
+    }
 
-@app.post("/generate")
-async def generate_pdf(request: PDFGenerationRequest):
+def wrap_text(text: str, width: int = 80) -> List[str]:
+    lines = []
+    words = text.split()
+    current_line = ""
+    
+    for word in words:
+        test_line = current_line + " " + word if current_line else word
+        if len(test_line) > width:
+            if current_line:
+                lines.append(current_line)
+                current_line = word
+            else:
+                lines.append(word)
+        else:
+            current_line = test_line
+    
+    if current_line:
+        lines.append(current_line)
+    
+    return lines
+
+def layout_tasks(tasks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Раскладка текста задач, общая для версий ученика и учителя"""
+    return [
+        {
+            "statement_lines": wrap_text(task.get("statement_text", "No statement")),
+            "answer": task.get("answer"),
+            "solution_lines": task["solution_text"].split('\n')[:3] if task.get("solution_text") else []
+        }
+        for task in tasks
+    ]
+
+def render_pdf(target, data: Dict[str, Any], pdf_type: str, layout: List[Dict[str, Any]], generated_at: datetime):
     from reportlab.pdfgen import canvas
     from reportlab.lib.pagesizes import A4
-    from reportlab.lib.units import mm
-    from reportlab.pdfbase import pdfmetrics
-    from reportlab.pdfbase.ttfonts import TTFont
-    from datetime import datetime
     
-    buffer = io.BytesIO()
-    c = canvas.Canvas(buffer, pagesize=A4)
+    c = canvas.Canvas(target, pagesize=A4)
     width, height = A4
     
     try:
@@ -32,22 +109,19 @@ async def generate_pdf(request: PDFGenerationRequest):
     except:
         pass
     
-    data = request.data
-    pdf_type = request.type
     assignment_id = data.get("assignment_id", "unknown")
     student_name = data.get("student", {}).get("name", "Unknown Student")
     topics_text = data.get("topics_text", "")
-    tasks = data.get("tasks", [])
     
     c.drawString(50, height - 50, f"Assignment #{assignment_id}")
     c.drawString(50, height - 70, f"Student: {student_name}")
     c.drawString(50, height - 90, f"Topics: {topics_text}")
-    c.drawString(50, height - 110, f"Generated: {datetime.now().strftime('%Y-%m-%d %H:%M')}")
+    c.drawString(50, height - 110, f"Generated: {generated_at.strftime('%Y-%m-%d %H:%M')}")
     c.drawString(50, height - 130, f"Type: {pdf_type.title()} Version")
     
     y_position = height - 170
     
-    for i, task in enumerate(tasks, 1):
+    for i, task in enumerate(layout, 1):
         if y_position < 150:
             c.showPage()
             y_position = height - 50
@@ -57,41 +131,20 @@ async def generate_pdf(request: PDFGenerationRequest):
         y_position -= 20
         
         c.setFont("Helvetica", 11)
-        statement = task.get("statement_text", "No statement")
-        
-        lines = []
-        words = statement.split()
-        current_line = ""
-        
-        for word in words:
-            test_line = current_line + " " + word if current_line else word
-            if len(test_line) > 80:
-                if current_line:
-                    lines.append(current_line)
-                    current_line = word
-                else:
-                    lines.append(word)
-            else:
-                current_line = test_line
-        
-        if current_line:
-            lines.append(current_line)
-        
-        for line in lines:
+        for line in task["statement_lines"]:
             c.drawString(70, y_position, line)
             y_position -= 15
         
         if pdf_type == "teacher":
             y_position -= 10
-            if task.get("answer"):
+            if task["answer"]:
                 c.setFont("Helvetica-Bold", 10)
-                c.drawString(70, y_position, f"Answer: {task.get('answer', '')}")
+                c.drawString(70, y_position, f"Answer: {task['answer']}")
                 y_position -= 15
             
-            if task.get("solution_text"):
+            if task["solution_lines"]:
                 c.setFont("Helvetica", 10)
-                solution_lines = task.get("solution_text", "").split('\n')
-                for sol_line in solution_lines[:3]:
+                for sol_line in task["solution_lines"]:
                     c.drawString(70, y_position, f"Solution: {sol_line}")
                     y_position -= 12
         else:
@@ -100,14 +153,160 @@ async def generate_pdf(request: PDFGenerationRequest):
         y_position -= 20
     
     c.save()
-    buffer.seek(0)
-    pdf_content = buffer.read()
-    buffer.close()
+
+def render_job(data: Dict[str, Any], targets: Dict[str, str], generated_at: datetime) -> float:
+    """Выполняется в процессе пула: раскладка и рендер версий прямо в файлы.
+
+    Возвращает процессорное время рендера в секундах.
+    """
+    started = time.process_time()
+    layout = layout_tasks(data.get("tasks", []))
+    for pdf_type, target in targets.items():
+        render_pdf(target, data, pdf_type, layout, generated_at)
+    return time.process_time() - started
+
+def new_render_path() -> str:
+    """Файл для рендера: в каталоге кэша, если он включён, иначе во временном"""
+    if pdf_cache is not None:
+        return pdf_cache.staging_path()
+    fd, path = tempfile.mkstemp(suffix=".pdf")
+    os.close(fd)
+    return path
+
+def remove_files(paths: List[str]):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+async def run_render(data: Dict[str, Any], pdf_types: Sequence[str]) -> Tuple[Dict[str, str], float, List[str]]:
+    """Отправляет рендер в пул процессов с ограничением глубины очереди.
+
+    Версии, уже лежащие в кэше, не рендерятся повторно. Возвращает пути к
+    PDF по типам, процессорное время и временные файлы, которые нужно
+    удалить после отправки ответа. Все возвращаемые пути принадлежат
+    только этому запросу, так что вытеснение из кэша их не затрагивает.
+    """
+    global _pending_renders
+    
+    paths = {}
+    if pdf_cache is not None:
+        for pdf_type in pdf_types:
+            # Если файл успели вытеснить, версия просто рендерится заново
+            lease = await asyncio.to_thread(pdf_cache.checkout, pdf_cache_key(data, pdf_type))
+            if lease:
+                paths[pdf_type] = lease
+    missing = [pdf_type for pdf_type in pdf_types if pdf_type not in paths]
+    if not missing:
+        return paths, 0.0, list(paths.values())
+    
+    if _render_pool is None:
+        remove_files(list(paths.values()))
+        raise HTTPException(status_code=503, detail="Render pool is not running")
+    if _pending_renders >= PDF_MAX_QUEUE:
+        remove_files(list(paths.values()))
+        raise HTTPException(
+            status_code=429,
+            detail="Too many PDF renders in progress",
+            headers={"Retry-After": str(PDF_RETRY_AFTER)}
+        )
+    
+    _pending_renders += 1
+    started = time.perf_counter()
+    targets = {}
+    try:
+        for pdf_type in missing:
+            targets[pdf_type] = await asyncio.to_thread(new_render_path)
+        loop = asyncio.get_running_loop()
+        cpu_seconds = await loop.run_in_executor(_render_pool, render_job, data, targets, datetime.now())
+    except Exception:
+        remove_files(list(targets.values()) + list(paths.values()))
+        raise
+    finally:
+        _pending_renders -= 1
+    
+    for pdf_type, target in targets.items():
+        if pdf_cache is not None:
+            await asyncio.to_thread(pdf_cache.put_link, pdf_cache_key(data, pdf_type), target)
+        paths[pdf_type] = target
+    
+    logger.info(
+        f"Rendered {', '.join(missing)} for assignment {data.get('assignment_id', 'unknown')}: "
+        f"cpu {cpu_seconds:.3f}s, wall {time.perf_counter() - started:.3f}s"
+    )
+    return {pdf_type: paths[pdf_type] for pdf_type in pdf_types}, cpu_seconds, list(paths.values())
+
+class ChunkSink(io.RawIOBase):
+    """Поток без seek для zipfile: накапливает записанные куски до выдачи клиенту"""
+    
+    def __init__(self):
+        self.chunks: List[bytes] = []
+    
+    def writable(self) -> bool:
+        return True
+    
+    def write(self, b) -> int:
+        self.chunks.append(bytes(b))
+        return len(b)
+    
+    def drain(self) -> List[bytes]:
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+def iter_zip(paths: Dict[str, str]) -> Iterator[bytes]:
+    """ZIP без сжатия, собираемый на лету из файлов на диске"""
+    sink = ChunkSink()
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_STORED) as archive:
+        for pdf_type, path in paths.items():
+            with open(path, "rb") as src, archive.open(f"{pdf_type}.pdf", "w") as dst:
+                while True:
+                    chunk = src.read(STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    yield from sink.drain()
+            yield from sink.drain()
+    yield from sink.drain()
+
+def render_headers(filename: str, cpu_seconds: float) -> Dict[str, str]:
+    return {
+        "Content-Disposition": f"attachment; filename={filename}",
+        "X-Render-CPU-Time": f"{cpu_seconds:.4f}"
+    }
+
+@app.post("/generate")
+async def generate_pdf(request: PDFGenerationRequest):
+    data = request.data
+    pdf_type = request.type
+    assignment_id = data.get("assignment_id", "unknown")
+    
+    paths, cpu_seconds, temp_paths = await run_render(data, (pdf_type,))
     
     filename = f"assignment_{assignment_id}_{pdf_type}.pdf"
-    return Response(
-        content=pdf_content,
+    return FileResponse(
+        paths[pdf_type],
         media_type="application/pdf",
-        headers={"Content-Disposition": f"attachment; filename={filename}"}
+        headers=render_headers(filename, cpu_seconds),
+        background=BackgroundTask(remove_files, temp_paths)
     )
 
+@app.post("/generate-bundle")
+async def generate_pdf_bundle(request: PDFBundleRequest):
+    """Версии для ученика и учителя в одном ZIP-архиве.
+
+    Текст задач раскладывается один раз и используется для обеих версий.
+    Архив отдаётся частями по мере чтения PDF с диска.
+    """
+    data = request.data
+    assignment_id = data.get("assignment_id", "unknown")
+    
+    paths, cpu_seconds, temp_paths = await run_render(data, ("student", "teacher"))
+    
+    filename = f"assignment_{assignment_id}_bundle.zip"
+    return StreamingResponse(
+        iter_zip(paths),
+        media_type="application/zip",
+        headers=render_headers(filename, cpu_seconds),
+        background=BackgroundTask(remove_files, temp_paths)
+    )
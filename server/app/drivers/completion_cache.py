@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import List, Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+# redis - общий для API и воркеров, sqlite - локальный файл, off - без кэша
+COMPLETION_CACHE_BACKEND = os.getenv("COMPLETION_CACHE_BACKEND", "redis")
+COMPLETION_CACHE_PATH = os.getenv("COMPLETION_CACHE_PATH", "/app/data/cache/completions.sqlite3")
+COMPLETION_CACHE_TTL = int(os.getenv("COMPLETION_CACHE_TTL", "86400"))
+COMPLETION_CACHE_MAX_ENTRIES = int(os.getenv("COMPLETION_CACHE_MAX_ENTRIES", "10000"))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+_cache: Optional["CompletionCache"] = None
+_cache_lock = threading.Lock()
+
+
+def completion_cache_key(model: str, messages: List[Dict[str, str]], temperature: float, max_tokens: int) -> str:
+    payload = json.dumps(
+        {"model": model, "messages": messages, "temperature": temperature, "max_tokens": max_tokens},
+        ensure_ascii=False,
+        sort_keys=True,
+        separators=(",", ":")
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """Кэш ответов YaGPT по хэшу (модель, сообщения, температура).
+
+    Записи живут ttl секунд; сверх max_entries вытесняются самые давно
+    использованные. В Redis порядок вытеснения хранится в sorted set
+    completion_cache:index, в SQLite - в колонке accessed_at.
+    """
+
+    INDEX_KEY = "completion_cache:index"
+
+    def __init__(
+        self,
+        backend: str = "sqlite",
+        path: str = COMPLETION_CACHE_PATH,
+        ttl: int = COMPLETION_CACHE_TTL,
+        max_entries: int = COMPLETION_CACHE_MAX_ENTRIES
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._redis = None
+        self._sqlite: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+        if backend == "redis":
+            if not REDIS_AVAILABLE:
+                logger.warning("redis package is not installed, caching completions in SQLite")
+            else:
+                try:
+                    self._redis = redis.Redis.from_url(REDIS_URL, socket_timeout=1.0, socket_connect_timeout=1.0)
+                    self._redis.ping()
+                except Exception as e:
+                    logger.warning(f"Redis is not available for completions, caching them in SQLite: {e}")
+                    self._redis = None
+
+        if self._redis is None:
+            self._open_sqlite(path)
+
+    def _open_sqlite(self, path: str):
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._sqlite = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._sqlite.execute("PRAGMA journal_mode=WAL")
+        self._sqlite.execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._sqlite.execute("CREATE INDEX IF NOT EXISTS completions_accessed_at ON completions (accessed_at)")
+
+    @property
+    def backend(self) -> str:
+        return "redis" if self._redis is not None else "sqlite"
+
+    @staticmethod
+    def _redis_key(key: str) -> str:
+        return f"completion_cache:{key}"
+
+    def get(self, key: str) -> Optional[str]:
+        value = None
+        try:
+            if self._redis is not None:
+                data = self._redis.get(self._redis_key(key))
+                if data is not None:
+                    value = data.decode("utf-8")
+                    self._redis.zadd(self.INDEX_KEY, {key: time.time()})
+            else:
+                now = time.time()
+                with self._lock:
+                    row = self._sqlite.execute(
+                        "SELECT value FROM completions WHERE key = ? AND expires_at > ?", (key, now)
+                    ).fetchone()
+                    if row is not None:
+                        value = row[0]
+                        self._sqlite.execute("UPDATE completions SET accessed_at = ? WHERE key = ?", (now, key))
+        except Exception as e:
+            logger.warning(f"Could not read cached completion: {e}")
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key: str, value: str):
+        now = time.time()
+        try:
+            if self._redis is not None:
+                pipeline = self._redis.pipeline(transaction=False)
+                pipeline.set(self._redis_key(key), value.encode("utf-8"), ex=self.ttl)
+                pipeline.zadd(self.INDEX_KEY, {key: now})
+                # Записи, истёкшие по TTL, тоже уходят из индекса
+                pipeline.zremrangebyscore(self.INDEX_KEY, "-inf", now - self.ttl)
+                pipeline.zcard(self.INDEX_KEY)
+                size = pipeline.execute()[-1]
+                if size > self.max_entries:
+                    evicted = [item for item, _ in self._redis.zpopmin(self.INDEX_KEY, size - self.max_entries)]
+                    if evicted:
+                        self._redis.delete(*(self._redis_key(item.decode("utf-8")) for item in evicted))
+            else:
+                with self._lock:
+                    self._sqlite.execute(
+                        "INSERT OR REPLACE INTO completions (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                        (key, value, now + self.ttl, now)
+                    )
+                    self._evict(now)
+        except Exception as e:
+            logger.warning(f"Could not store completion: {e}")
+
+    def _evict(self, now: float):
+        self._sqlite.execute("DELETE FROM completions WHERE expires_at <= ?", (now,))
+        self._sqlite.execute(
+            "DELETE FROM completions WHERE key IN ("
+            "SELECT key FROM completions ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,)
+        )
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "backend": self.backend,
+            "ttl": self.ttl,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0
+        }
+
+
+def get_completion_cache() -> Optional[CompletionCache]:
+    """Общий для процесса кэш ответов; None, если кэш отключён"""
+    global _cache
+    if COMPLETION_CACHE_BACKEND == "off":
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                try:
+                    _cache = CompletionCache(COMPLETION_CACHE_BACKEND)
+                except Exception as e:
+                    logger.warning(f"Could not open completion cache, completions will not be cached: {e}")
+                    return None
+    return _cache
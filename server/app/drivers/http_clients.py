@@ -0,0 +1,26 @@
+import os
+import httpx
+
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+def http_limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+    )
+
+def create_client(**kwargs) -> httpx.Client:
+    """Долгоживущий клиент с пулом keep-alive соединений и HTTP/2, если доступен"""
+    return httpx.Client(limits=http_limits(), http2=HTTP2_AVAILABLE, **kwargs)
+
+def create_async_client(**kwargs) -> httpx.AsyncClient:
+    return httpx.AsyncClient(limits=http_limits(), http2=HTTP2_AVAILABLE, **kwargs)
@@ -0,0 +1,73 @@
+import json
+import logging
+from typing import Any, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class IncrementalJSONObjectParser:
+    """Разбор JSON-объекта верхнего уровня по мере поступления текста.
+
+    feed возвращает поля, значения которых уже полностью пришли; каждый
+    символ просматривается один раз. Текст до первой '{' (например,
+    markdown-ограждение ```json) пропускается.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._position = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._member_start = None
+        self.fields: Dict[str, Any] = {}
+        self.done = False
+
+    def feed(self, text: str) -> List[Tuple[str, Any]]:
+        if self.done or not text:
+            return []
+        self._buffer += text
+        completed = []
+
+        buffer = self._buffer
+        position = self._position
+        while position < len(buffer) and not self.done:
+            char = buffer[position]
+            if self._member_start is None:
+                if char == "{":
+                    self._depth = 1
+                    self._member_start = position + 1
+            elif self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    completed.extend(self._finish_member(buffer[self._member_start:position]))
+                    self.done = True
+            elif char == "," and self._depth == 1:
+                completed.extend(self._finish_member(buffer[self._member_start:position]))
+                self._member_start = position + 1
+            position += 1
+
+        self._position = position
+        return completed
+
+    def _finish_member(self, member: str) -> List[Tuple[str, Any]]:
+        if not member.strip():
+            return []
+        try:
+            parsed = json.loads("{" + member + "}")
+        except ValueError as e:
+            logger.warning(f"Could not parse streamed JSON member {member[:80]!r}: {e}")
+            return []
+        self.fields.update(parsed)
+        return list(parsed.items())
@@ -0,0 +1,36 @@
+import time
+import asyncio
+import threading
+
+
+class TokenBucket:
+    """Ограничение частоты запросов: rate токенов в секунду, не больше burst подряд.
+
+    acquire резервирует токен сразу и спит до момента, когда он станет
+    доступен, поэтому одним ведром могут пользоваться разные циклы событий
+    и потоки процесса. rate <= 0 отключает ограничение.
+    """
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """Забирает токен и возвращает, сколько секунд до него ждать"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            self._tokens -= 1
+            return 0.0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    async def acquire(self) -> float:
+        if self.rate <= 0:
+            return 0.0
+        delay = self._reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return delay
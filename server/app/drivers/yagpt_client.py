@@ -1,23 +1,104 @@
 import os
 import httpx
 import json
-from typing import Dict, Any, Optional, List
+import time
+import random
+from typing import Dict, Any, Optional, List, AsyncIterator, Tuple
 import logging
 import asyncio
 
+from .http_clients import create_async_client
+from .completion_cache import get_completion_cache, completion_cache_key
+from .rate_limit import TokenBucket
+from .json_stream import IncrementalJSONObjectParser
+
 logger = logging.getLogger(__name__)
 
+YAGPT_TIMEOUT = float(os.getenv("YAGPT_TIMEOUT", "60"))
+# Одновременных запросов в generate_variants_batch
+YAGPT_MAX_CONCURRENCY = int(os.getenv("YAGPT_MAX_CONCURRENCY", "8"))
+# Квота YaGPT: запросов в секунду на процесс и допустимый всплеск; 0 - без ограничения
+YAGPT_RATE_LIMIT = float(os.getenv("YAGPT_RATE_LIMIT", "10"))
+YAGPT_RATE_BURST = int(os.getenv("YAGPT_RATE_BURST", "10"))
+# Повторы при 429, 5xx и сетевых ошибках
+YAGPT_MAX_RETRIES = int(os.getenv("YAGPT_MAX_RETRIES", "3"))
+YAGPT_RETRY_BASE_DELAY = float(os.getenv("YAGPT_RETRY_BASE_DELAY", "0.5"))
+YAGPT_MAX_RETRY_AFTER = float(os.getenv("YAGPT_MAX_RETRY_AFTER", "30"))
+
+_yagpt_client: Optional["YaGPTClient"] = None
+
+def get_yagpt_client() -> "YaGPTClient":
+    """Общий для процесса клиент YaGPT"""
+    global _yagpt_client
+    if _yagpt_client is None:
+        _yagpt_client = YaGPTClient()
+    return _yagpt_client
+
+async def close_yagpt_client():
+    if _yagpt_client is not None:
+        await _yagpt_client.aclose()
+
 class YaGPTClient:
-    def __init__(self):
-        self.api_url = os.getenv("YAGPT_API_URL", "https://llm.api.cloud.yandex.net/foundationModels/v1/completion")
-        self.api_key = os.getenv("YAGPT_API_KEY")
-        self.model = os.getenv("YAGPT_MODEL", "yandexgpt-lite")
+    def __init__(
+        self,
+        api_url: Optional[str] = None,
+        api_key: Optional[str] = None,
+        model: Optional[str] = None,
+        rate_limit: float = YAGPT_RATE_LIMIT,
+        rate_burst: int = YAGPT_RATE_BURST,
+        max_retries: int = YAGPT_MAX_RETRIES
+    ):
+        # Параметры конструктора переопределяют окружение (например, для локального mock-сервера)
+        self.api_url = api_url or os.getenv("YAGPT_API_URL", "https://llm.api.cloud.yandex.net/foundationModels/v1/completion")
+        self.api_key = api_key or os.getenv("YAGPT_API_KEY")
+        self.model = model or os.getenv("YAGPT_MODEL", "yandexgpt-lite")
+        self.max_retries = max_retries
+        self.rate_limiter = TokenBucket(rate_limit, rate_burst)
+        
+        # Асинхронный клиент привязан к циклу событий, поэтому на каждый цикл свой
+        self._http_clients: Dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
+        
+        # Запросы к API, которые сейчас выполняются, по ключу кэша
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.coalesced = 0
+        self.retries = 0
         
         if not self.api_key:
             logger.warning("YAGPT_API_KEY not set, using mock responses")
             self.mock_mode = True
         else:
             self.mock_mode = False
+        
+        self.cache = None if self.mock_mode else get_completion_cache()
+    
+    async def _get_http_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        client = self._http_clients.get(loop)
+        if client is None:
+            # Клиенты циклов, которые уже завершились (например, asyncio.run
+            # в Celery), закрываются здесь, чтобы не держать их соединения
+            for old_loop in [l for l in self._http_clients if l.is_closed()]:
+                old_client = self._http_clients.pop(old_loop, None)
+                if old_client is not None:
+                    await self._close_http_client(old_loop, old_client)
+            client = self._http_clients[loop] = create_async_client(timeout=YAGPT_TIMEOUT)
+        return client
+    
+    @staticmethod
+    async def _close_http_client(loop: asyncio.AbstractEventLoop, client: httpx.AsyncClient):
+        try:
+            if loop is not asyncio.get_running_loop() and loop.is_running():
+                # Цикл работает в другом потоке: закрываем клиент там же
+                await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(client.aclose(), loop))
+            else:
+                await client.aclose()
+        except Exception as e:
+            logger.warning(f"Could not close YaGPT HTTP client: {e}")
+    
+    async def aclose(self):
+        clients, self._http_clients = self._http_clients, {}
+        for loop, client in clients.items():
+            await self._close_http_client(loop, client)
     
     async def generate_completion(
         self,
@@ -29,39 +110,215 @@ class YaGPTClient:
         if self.mock_mode:
             return self._mock_completion(messages)
         
-        headers = {
+        key = completion_cache_key(self.model, messages, temperature, max_tokens)
+        if self.cache is not None:
+            cached = await asyncio.to_thread(self.cache.get, key)
+            if cached is not None:
+                return cached
+        
+        # Заглушка отдаётся только без ключа API; при ошибке API - None, чтобы
+        # вызывающий код не принял заглушку за настоящий ответ
+        return await self._coalesced_completion(key, messages, temperature, max_tokens)
+    
+    async def _coalesced_completion(
+        self,
+        key: str,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_tokens: int
+    ) -> Optional[str]:
+        """Одинаковые одновременные запросы ждут один вызов API"""
+        loop = asyncio.get_running_loop()
+        inflight = self._inflight.get(key)
+        if inflight is not None and inflight.get_loop() is loop:
+            self.coalesced += 1
+            return await asyncio.shield(inflight)
+        
+        future = loop.create_future()
+        self._inflight[key] = future
+        try:
+            text = await self._request_completion(messages, temperature, max_tokens)
+            if text is not None and self.cache is not None:
+                await asyncio.to_thread(self.cache.put, key, text)
+            future.set_result(text)
+            return text
+        finally:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+            # Если запрос отменён, ожидающие получат None
+            if not future.done():
+                future.set_result(None)
+    
+    async def _request_completion(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_tokens: int
+    ) -> Optional[str]:
+        headers = self._headers()
+        payload = self._payload(messages, temperature, max_tokens, stream=False)
+        
+        try:
+            client = await self._get_http_client()
+            for attempt in range(self.max_retries + 1):
+                await self.rate_limiter.acquire()
+                retry_after = None
+                try:
+                    response = await client.post(
+                        self.api_url,
+                        headers=headers,
+                        json=payload
+                    )
+                except httpx.TransportError as e:
+                    logger.warning(f"YaGPT API request failed: {e!r}")
+                else:
+                    if response.status_code == 200:
+                        result = response.json()
+                        return result["result"]["alternatives"][0]["message"]["text"]
+                    if response.status_code != 429 and response.status_code < 500:
+                        logger.error(f"YaGPT API error: {response.status_code} - {response.text}")
+                        return None
+                    logger.warning(f"YaGPT API returned {response.status_code}")
+                    retry_after = response.headers.get("Retry-After")
+                
+                if attempt == self.max_retries:
+                    break
+                delay = self._retry_delay(attempt, retry_after)
+                self.retries += 1
+                logger.info(f"Retrying YaGPT request in {delay:.1f}s")
+                await asyncio.sleep(delay)
+            
+            logger.error(f"YaGPT API failed after {self.max_retries + 1} attempts")
+            return None
+                
+        except Exception as e:
+            logger.error(f"Error calling YaGPT API: {e}")
+            return None
+    
+    def _headers(self) -> Dict[str, str]:
+        return {
             "Authorization": f"Api-Key {self.api_key}",
             "Content-Type": "application/json"
         }
-        
-        payload = {
+    
+    def _payload(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float,
+        max_tokens: int,
+        stream: bool
+    ) -> Dict[str, Any]:
+        return {
             "modelUri": f"gpt://{self.model}",
             "completionOptions": {
-                "stream": False,
+                "stream": stream,
                 "temperature": temperature,
                 "maxTokens": max_tokens
             },
             "messages": messages
         }
+    
+    async def stream_completion(
+        self,
+        messages: List[Dict[str, str]],
+        temperature: float = 0.7,
+        max_tokens: int = 2000
+    ) -> AsyncIterator[str]:
+        """Текст ответа по частям по мере генерации.
+
+        YaGPT в режиме stream присылает по строке JSON на каждое обновление
+        с накопленным текстом альтернативы; наружу отдаются только новые
+        символы (ответы с дельтами тоже поддерживаются). Повтор при 429/5xx
+        возможен, пока не пришло ни одной части. Полный ответ кладётся в
+        кэш; при ошибке до первой части поток просто заканчивается пустым.
+        """
+        if self.mock_mode:
+            yield self._mock_completion(messages)
+            return
+        
+        key = completion_cache_key(self.model, messages, temperature, max_tokens)
+        if self.cache is not None:
+            cached = await asyncio.to_thread(self.cache.get, key)
+            if cached is not None:
+                yield cached
+                return
         
+        payload = self._payload(messages, temperature, max_tokens, stream=True)
+        received = ""
+        completed = False
         try:
-            async with httpx.AsyncClient(timeout=60.0) as client:
-                response = await client.post(
-                    self.api_url,
-                    headers=headers,
-                    json=payload
-                )
+            client = await self._get_http_client()
+            for attempt in range(self.max_retries + 1):
+                await self.rate_limiter.acquire()
+                retry_after = None
+                try:
+                    async with client.stream("POST", self.api_url, headers=self._headers(), json=payload) as response:
+                        if response.status_code == 200:
+                            async for line in response.aiter_lines():
+                                text = self._stream_text(line)
+                                if not text:
+                                    continue
+                                if text.startswith(received):
+                                    delta, received = text[len(received):], text
+                                else:
+                                    delta, received = text, received + text
+                                if delta:
+                                    yield delta
+                            completed = True
+                            break
+                        
+                        await response.aread()
+                        if response.status_code != 429 and response.status_code < 500:
+                            logger.error(f"YaGPT API error: {response.status_code} - {response.text}")
+                            break
+                        logger.warning(f"YaGPT API returned {response.status_code}")
+                        retry_after = response.headers.get("Retry-After")
+                except httpx.TransportError as e:
+                    # Часть ответа уже отдана, повтор дал бы дублирующийся текст
+                    if received:
+                        raise
+                    logger.warning(f"YaGPT API request failed: {e!r}")
+                
+                if attempt == self.max_retries:
+                    logger.error(f"YaGPT API failed after {self.max_retries + 1} attempts")
+                    break
+                delay = self._retry_delay(attempt, retry_after)
+                self.retries += 1
+                logger.info(f"Retrying YaGPT request in {delay:.1f}s")
+                await asyncio.sleep(delay)
                 
-                if response.status_code == 200:
-                    result = response.json()
-                    return result["result"]["alternatives"][0]["message"]["text"]
-                else:
-                    logger.error(f"YaGPT API error: {response.status_code} - {response.text}")
-                    return self._mock_completion(messages)
-                    
         except Exception as e:
-            logger.error(f"Error calling YaGPT API: {e}")
-            return self._mock_completion(messages)
+            logger.error(f"Error streaming from YaGPT API: {e}")
+        
+        if completed and received and self.cache is not None:
+            await asyncio.to_thread(self.cache.put, key, received)
+    
+    @staticmethod
+    def _stream_text(line: str) -> str:
+        line = line.strip()
+        if line.startswith("data:"):
+            line = line[5:].strip()
+        if not line:
+            return ""
+        chunk = json.loads(line)
+        result = chunk.get("result", chunk)
+        return result["alternatives"][0]["message"]["text"]
+    
+    @staticmethod
+    def _retry_delay(attempt: int, retry_after: Optional[str]) -> float:
+        """Retry-After, если сервер его прислал, иначе экспонента с полным джиттером"""
+        if retry_after is not None:
+            try:
+                return min(max(float(retry_after), 0.0), YAGPT_MAX_RETRY_AFTER)
+            except ValueError:
+                pass
+        return random.uniform(0, min(YAGPT_RETRY_BASE_DELAY * (2 ** attempt), YAGPT_MAX_RETRY_AFTER))
+    
+    def cache_stats(self) -> Dict[str, Any]:
+        stats = self.cache.stats() if self.cache is not None else {"backend": "off"}
+        stats["coalesced"] = self.coalesced
+        stats["retries"] = self.retries
+        return stats
     
     def _mock_completion(self, messages: List[Dict[str, str]]) -> str:
         user_message = ""
@@ -90,14 +347,13 @@ class YaGPTClient:
         
         return "Извините, сервис временно недоступен. Используется заглушка."
     
-    async def generate_task_variant(
+    def _variant_messages(
         self,
         original_task: Dict[str, Any],
         student_profile: Dict[str, Any],
         prompt_template: str
-    ) -> Optional[Dict[str, Any]]:
-        
-        messages = [
+    ) -> List[Dict[str, str]]:
+        return [
             {
                 "role": "system",
                 "text": prompt_template
@@ -116,6 +372,15 @@ class YaGPTClient:
 """
             }
         ]
+    
+    async def generate_task_variant(
+        self,
+        original_task: Dict[str, Any],
+        student_profile: Dict[str, Any],
+        prompt_template: str
+    ) -> Optional[Dict[str, Any]]:
+        
+        messages = self._variant_messages(original_task, student_profile, prompt_template)
         
         try:
             response = await self.generate_completion(messages, temperature=0.8)
@@ -133,6 +398,73 @@ class YaGPTClient:
             logger.error(f"Error generating task variant: {e}")
             return None
     
+    async def generate_task_variant_stream(
+        self,
+        original_task: Dict[str, Any],
+        student_profile: Dict[str, Any],
+        prompt_template: str
+    ) -> AsyncIterator[Tuple[str, Any]]:
+        """Поля варианта задачи (имя, значение) по мере того, как модель их дописывает.
+
+        statement_text обычно приходит первым, и его можно показывать или
+        передавать дальше, не дожидаясь решения.
+        """
+        messages = self._variant_messages(original_task, student_profile, prompt_template)
+        parser = IncrementalJSONObjectParser()
+        
+        try:
+            # Поток читается до конца, чтобы полный ответ попал в кэш
+            async for delta in self.stream_completion(messages, temperature=0.8):
+                for field, value in parser.feed(delta):
+                    yield field, value
+        except Exception as e:
+            logger.error(f"Error streaming task variant: {e}")
+        
+        if not parser.done:
+            logger.warning(f"Streamed task variant is incomplete, got fields: {list(parser.fields)}")
+    
+    async def generate_variants_batch(
+        self,
+        original_tasks: List[Dict[str, Any]],
+        student_profile: Dict[str, Any],
+        prompt_template: str,
+        max_concurrency: int = YAGPT_MAX_CONCURRENCY
+    ) -> Dict[str, Any]:
+        """Варианты для всех задач задания параллельно.
+
+        Одновременно выполняется не больше max_concurrency запросов, частоту
+        дополнительно ограничивает общий для клиента rate_limiter. variants и
+        latencies идут в порядке original_tasks; вместо неудавшегося
+        варианта стоит None.
+        """
+        semaphore = asyncio.Semaphore(max(max_concurrency, 1))
+        retries_before = self.retries
+        started = time.perf_counter()
+        
+        async def generate_one(task: Dict[str, Any]):
+            async with semaphore:
+                call_started = time.perf_counter()
+                variant = await self.generate_task_variant(task, student_profile, prompt_template)
+                return variant, time.perf_counter() - call_started
+        
+        results = await asyncio.gather(*(generate_one(task) for task in original_tasks))
+        variants = [variant for variant, _ in results]
+        latencies = [round(latency, 3) for _, latency in results]
+        
+        ordered = sorted(latencies)
+        stats = {
+            "count": len(variants),
+            "failed": sum(1 for variant in variants if variant is None),
+            "retries": self.retries - retries_before,
+            "seconds": round(time.perf_counter() - started, 3),
+            "latency_avg": round(sum(ordered) / len(ordered), 3) if ordered else 0.0,
+            "latency_p50": ordered[len(ordered) // 2] if ordered else 0.0,
+            "latency_p95": ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)] if ordered else 0.0,
+            "latency_max": ordered[-1] if ordered else 0.0
+        }
+        logger.info(f"Generated {len(variants)} task variants: {stats}")
+        return {"variants": variants, "latencies": latencies, "stats": stats}
+    
     async def personalize_task_selection(
         self,
         candidate_tasks: List[Dict[str, Any]],
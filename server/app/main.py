@@ -1,8 +1,13 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
+from fastapi.concurrency import run_in_threadpool
 
-from .database import create_tables
+from .database import create_tables, get_pool_metrics
+from .services.rag_service import get_rag_service, close_rag_service
+from .services.pdf_service import close_pdf_http_client
+from .services.candidate_pool import get_candidate_pool_index
+from .drivers.yagpt_client import close_yagpt_client, get_yagpt_client
 from .routers import students, assignments, tasks
 
 app = FastAPI(title="EGE Math Tutor API", version="1.0.0")
@@ -22,11 +27,35 @@ app.include_router(tasks.router)
 @app.on_event("startup")
 async def startup_event():
     create_tables()
+    # Модель эмбеддингов и клиенты RAG создаются один раз на процесс
+    get_rag_service()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await close_rag_service()
+    await close_yagpt_client()
+    close_pdf_http_client()
 
 @app.get("/health")
 async def health_check():
     return {"status": "healthy", "service": "EGE Math Tutor API", "version": "1.0.0"}
 
+@app.get("/metrics/db-pool")
+async def db_pool_metrics():
+    """Загрузка пулов соединений и время ожидания соединения"""
+    return get_pool_metrics()
+
+@app.get("/metrics/candidate-pools")
+async def candidate_pool_metrics():
+    """Попадания в материализованные пулы кандидатов"""
+    pool_index = get_candidate_pool_index()
+    return pool_index.stats() if pool_index else {"backend": "off"}
+
+@app.get("/metrics/completion-cache")
+async def completion_cache_metrics():
+    """Попадания в кэш ответов YaGPT и объединённые запросы"""
+    return get_yagpt_client().cache_stats()
+
 @app.get("/")
 async def root():
     return {"message": "Система персонализированных заданий по математике для подготовки к ЕГЭ"}
@@ -95,8 +124,7 @@ async def import_tasks():
 async def test_rag():
     """Тестирование RAG системы"""
     try:
-        from app.services.rag_service import RAGService
-        rag = RAGService()
+        rag = get_rag_service()
         
         if not rag.available:
             return {
@@ -139,11 +167,8 @@ async def test_rag():
             }
         ]
         
-        # Индексация
-        indexed = 0
-        for task in sample_tasks:
-            if rag.index_task(task):
-                indexed += 1
+        # Индексация; поиск ниже должен видеть только что записанные точки
+        indexed = rag.index_tasks_bulk(sample_tasks, wait=True)["indexed"]
         
         # Поиск
         results = rag.hybrid_search("квадратное уравнение", limit=5)
@@ -166,8 +191,7 @@ async def test_rag():
 async def rag_search(q: str, topic: str = None, difficulty_min: int = 1, difficulty_max: int = 5):
     """Поиск через RAG систему"""
     try:
-        from app.services.rag_service import RAGService
-        rag = RAGService()
+        rag = await run_in_threadpool(get_rag_service)
         
         if not rag.available:
             return {
@@ -185,13 +209,14 @@ async def rag_search(q: str, topic: str = None, difficulty_min: int = 1, difficu
             }
         
         difficulty_range = (difficulty_min, difficulty_max) if difficulty_min != difficulty_max else None
-        results = rag.hybrid_search(q, topic=topic, difficulty_range=difficulty_range)
+        search = await rag.hybrid_search_async(q, topic=topic, difficulty_range=difficulty_range)
         
         return {
             "query": q,
-            "results": results,
-            "total": len(results),
-            "mode": "real"
+            "results": search["results"],
+            "total": len(search["results"]),
+            "mode": "real",
+            "legs": search["legs"]
         }
         
     except Exception as e:
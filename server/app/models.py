@@ -44,8 +44,10 @@ class Assignment(Base):
     topics_text = Column(Text, nullable=False)
     status = Column(String(50), default="pending")
     options = Column(JSON, default=dict)
+    # Ключи в хранилище артефактов; у старых заданий - абсолютные пути
     student_pdf_path = Column(String(500))
     teacher_pdf_path = Column(String(500))
+    stage_timings = Column(JSON, default=dict)
     created_at = Column(DateTime, default=datetime.utcnow)
     completed_at = Column(DateTime)
     
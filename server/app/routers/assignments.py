@@ -1,23 +1,47 @@
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
-from fastapi.responses import FileResponse
-from sqlalchemy.orm import Session
-from typing import List
+from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, StreamingResponse, RedirectResponse, Response
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from typing import List, Optional, Dict, Any, Tuple
+import asyncio
+import json
+import logging
 import os
 
-from ..database import get_db
+from ..database import get_db, AsyncSessionLocal
 from ..models import Assignment, Student, AssignmentItem
-from ..schemas import Assignment as AssignmentSchema, AssignmentCreate, AssignmentResponse
-from ..services.assignment_service import AssignmentService
+from ..schemas import (
+    Assignment as AssignmentSchema, AssignmentCreate, AssignmentResponse, AssignmentProgress,
+    AssignmentBatchCreate, AssignmentBatchResponse, AssignmentBatchStatus
+)
+from ..celery_app import celery_app
+from ..tasks import (
+    generate_assignment_task, run_assignment_generation,
+    generate_assignment_batch_task, run_assignment_batch_generation
+)
+from ..services.artifact_store import get_artifact_store
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/api/assignments", tags=["assignments"])
 
+PROGRESS_POLL_INTERVAL = float(os.getenv("ASSIGNMENT_PROGRESS_POLL_INTERVAL", "1.0"))
+PROGRESS_TIMEOUT = float(os.getenv("ASSIGNMENT_PROGRESS_TIMEOUT", "600"))
+FINAL_STATUSES = ("completed", "failed")
+
+# Если задан, локальные файлы отдаёт nginx через X-Accel-Redirect (sendfile, Range)
+ARTIFACT_ACCEL_REDIRECT_PREFIX = os.getenv("ARTIFACT_ACCEL_REDIRECT_PREFIX", "")
+RANGE_CHUNK_SIZE = 64 * 1024
+
 @router.post("/generate", response_model=AssignmentResponse)
 async def generate_assignment(
     assignment_data: AssignmentCreate,
     background_tasks: BackgroundTasks,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    student = db.query(Student).filter(Student.id == assignment_data.student_id).first()
+    student = await db.get(Student, assignment_data.student_id)
     if not student:
         raise HTTPException(status_code=404, detail="Student not found")
     
@@ -28,29 +52,129 @@ async def generate_assignment(
         status="pending"
     )
     db.add(db_assignment)
-    db.commit()
-    db.refresh(db_assignment)
+    await db.commit()
     
-    assignment_service = AssignmentService(db)
     try:
-        assignment_service.generate_assignment_async(db_assignment.id)
+        await run_in_threadpool(generate_assignment_task.delay, db_assignment.id)
     except Exception as e:
-        db_assignment.status = "failed"
-        db.commit()
-        raise HTTPException(status_code=500, detail=f"Assignment generation failed: {str(e)}")
+        logger.warning(f"Could not enqueue assignment {db_assignment.id}, generating in background: {e}")
+        background_tasks.add_task(run_assignment_generation, db_assignment.id)
     
+    return _assignment_response(db_assignment)
+
+def _assignment_response(db_assignment: Assignment) -> AssignmentResponse:
     return AssignmentResponse(
         assignment_id=db_assignment.id,
         download_urls={
             "student": f"/api/assignments/{db_assignment.id}/download/student",
             "teacher": f"/api/assignments/{db_assignment.id}/download/teacher"
         },
-        message="Задание успешно создано"
+        message="Генерация задания запущена",
+        status=db_assignment.status,
+        progress_url=f"/api/assignments/{db_assignment.id}/progress"
+    )
+
+@router.post("/generate-batch", response_model=AssignmentBatchResponse)
+async def generate_assignment_batch(
+    batch_data: AssignmentBatchCreate,
+    background_tasks: BackgroundTasks,
+    db: AsyncSession = Depends(get_db)
+):
+    """Задания для группы учеников по общему списку тем"""
+    student_ids = list(dict.fromkeys(batch_data.student_ids))
+    if not student_ids:
+        raise HTTPException(status_code=400, detail="No students given")
+    
+    result = await db.execute(select(Student.id).where(Student.id.in_(student_ids)))
+    missing_ids = set(student_ids) - set(result.scalars().all())
+    if missing_ids:
+        raise HTTPException(status_code=404, detail=f"Students not found: {sorted(missing_ids)}")
+    
+    db_assignments = [
+        Assignment(
+            student_id=student_id,
+            topics_text=batch_data.topics_text,
+            options=batch_data.options.dict(),
+            status="pending"
+        )
+        for student_id in student_ids
+    ]
+    db.add_all(db_assignments)
+    await db.commit()
+    
+    assignment_ids = [db_assignment.id for db_assignment in db_assignments]
+    batch_id = None
+    try:
+        async_result = await run_in_threadpool(generate_assignment_batch_task.delay, assignment_ids)
+        batch_id = async_result.id
+    except Exception as e:
+        logger.warning(f"Could not enqueue assignment batch, generating in background: {e}")
+        background_tasks.add_task(run_assignment_batch_generation, assignment_ids)
+    
+    return AssignmentBatchResponse(
+        batch_id=batch_id,
+        status_url=f"/api/assignments/batches/{batch_id}" if batch_id else None,
+        assignments=[_assignment_response(db_assignment) for db_assignment in db_assignments],
+        message=f"Генерация {len(db_assignments)} заданий запущена"
+    )
+
+@router.get("/batches/{batch_id}", response_model=AssignmentBatchStatus)
+async def get_batch_status(batch_id: str):
+    """Состояние пакетной генерации и её статистика после завершения"""
+    def read_result():
+        async_result = celery_app.AsyncResult(batch_id)
+        stats = async_result.result if async_result.successful() else None
+        return async_result.state, stats
+    
+    state, stats = await run_in_threadpool(read_result)
+    return AssignmentBatchStatus(batch_id=batch_id, state=state, stats=stats)
+
+async def _read_progress(assignment_id: int) -> Optional[Dict[str, Any]]:
+    async with AsyncSessionLocal() as db:
+        assignment = await db.get(Assignment, assignment_id)
+        if not assignment:
+            return None
+        return AssignmentProgress(
+            assignment_id=assignment.id,
+            status=assignment.status,
+            stage_timings=assignment.stage_timings or {}
+        ).dict()
+
+@router.get("/{assignment_id}/progress")
+async def stream_progress(assignment_id: int, request: Request):
+    """Server-Sent Events с переходами статуса задания и временем этапов"""
+    progress = await _read_progress(assignment_id)
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Assignment not found")
+    
+    async def events():
+        current, last_sent = progress, None
+        deadline = asyncio.get_running_loop().time() + PROGRESS_TIMEOUT
+        while current is not None:
+            if current != last_sent:
+                yield f"event: progress\ndata: {json.dumps(current, ensure_ascii=False)}\n\n"
+                last_sent = current
+            if current["status"] in FINAL_STATUSES:
+                break
+            if asyncio.get_running_loop().time() > deadline or await request.is_disconnected():
+                break
+            await asyncio.sleep(PROGRESS_POLL_INTERVAL)
+            current = await _read_progress(assignment_id)
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
     )
 
 @router.get("/{assignment_id}", response_model=AssignmentSchema)
-async def get_assignment(assignment_id: int, db: Session = Depends(get_db)):
-    assignment = db.query(Assignment).filter(Assignment.id == assignment_id).first()
+async def get_assignment(assignment_id: int, db: AsyncSession = Depends(get_db)):
+    result = await db.execute(
+        select(Assignment)
+        .options(selectinload(Assignment.items).selectinload(AssignmentItem.task))
+        .where(Assignment.id == assignment_id)
+    )
+    assignment = result.scalar_one_or_none()
     if not assignment:
         raise HTTPException(status_code=404, detail="Assignment not found")
     return assignment
@@ -60,29 +184,116 @@ async def list_assignments(
     student_id: int = None,
     skip: int = 0,
     limit: int = 100,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    query = db.query(Assignment)
+    query = select(Assignment).options(selectinload(Assignment.items).selectinload(AssignmentItem.task))
     if student_id:
-        query = query.filter(Assignment.student_id == student_id)
-    assignments = query.offset(skip).limit(limit).all()
-    return assignments
+        query = query.where(Assignment.student_id == student_id)
+    result = await db.execute(query.offset(skip).limit(limit))
+    return result.scalars().all()
 
 @router.get("/{assignment_id}/download/{pdf_type}")
-async def download_pdf(assignment_id: int, pdf_type: str, db: Session = Depends(get_db)):
+async def download_pdf(assignment_id: int, pdf_type: str, request: Request, db: AsyncSession = Depends(get_db)):
     if pdf_type not in ["student", "teacher"]:
         raise HTTPException(status_code=400, detail="Invalid PDF type")
     
-    assignment = db.query(Assignment).filter(Assignment.id == assignment_id).first()
+    assignment = await db.get(Assignment, assignment_id)
     if not assignment:
         raise HTTPException(status_code=404, detail="Assignment not found")
     
     if assignment.status != "completed":
         raise HTTPException(status_code=400, detail="Assignment not ready")
     
-    pdf_path = assignment.student_pdf_path if pdf_type == "student" else assignment.teacher_pdf_path
-    if not pdf_path or not os.path.exists(pdf_path):
+    pdf_key = assignment.student_pdf_path if pdf_type == "student" else assignment.teacher_pdf_path
+    if not pdf_key:
         raise HTTPException(status_code=404, detail="PDF file not found")
     
     filename = f"assignment_{assignment_id}_{pdf_type}.pdf"
-    return FileResponse(pdf_path, filename=filename, media_type="application/pdf")
+    
+    if os.path.isabs(pdf_key):
+        # Задания, созданные до появления хранилища артефактов
+        pdf_path = pdf_key if os.path.exists(pdf_key) else None
+    else:
+        store = await run_in_threadpool(get_artifact_store)
+        download_url = store.download_url(pdf_key, filename)
+        if download_url:
+            return RedirectResponse(download_url, status_code=307)
+        if ARTIFACT_ACCEL_REDIRECT_PREFIX:
+            return Response(
+                media_type="application/pdf",
+                headers={
+                    "X-Accel-Redirect": f"{ARTIFACT_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{pdf_key}",
+                    "Content-Disposition": f'attachment; filename="{filename}"'
+                }
+            )
+        pdf_path = store.local_path(pdf_key)
+    
+    if not pdf_path:
+        raise HTTPException(status_code=404, detail="PDF file not found")
+    
+    range_header = request.headers.get("range")
+    if range_header:
+        return _range_response(pdf_path, filename, range_header)
+    return FileResponse(pdf_path, filename=filename, media_type="application/pdf", headers={"Accept-Ranges": "bytes"})
+
+def _parse_range(range_header: str, file_size: int) -> Optional[Tuple[int, int]]:
+    """Один диапазон вида bytes=start-end, bytes=start- или bytes=-suffix.
+
+    Возвращает None для заголовков, которые проще проигнорировать
+    (несколько диапазонов, другие единицы).
+    """
+    unit, _, spec = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    start_text, sep, end_text = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if start_text:
+            start = int(start_text)
+            end = int(end_text) if end_text else file_size - 1
+        else:
+            suffix = int(end_text)
+            if suffix <= 0:
+                raise ValueError
+            start, end = max(file_size - suffix, 0), file_size - 1
+    except ValueError:
+        return None
+    
+    if start >= file_size or start > end:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{file_size}"}
+        )
+    return start, min(end, file_size - 1)
+
+def _range_response(pdf_path: str, filename: str, range_header: str) -> Response:
+    file_size = os.path.getsize(pdf_path)
+    byte_range = _parse_range(range_header, file_size)
+    if byte_range is None:
+        return FileResponse(pdf_path, filename=filename, media_type="application/pdf", headers={"Accept-Ranges": "bytes"})
+    start, end = byte_range
+    
+    def iter_range():
+        with open(pdf_path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(RANGE_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+    
+    return StreamingResponse(
+        iter_range(),
+        status_code=206,
+        media_type="application/pdf",
+        headers={
+            "Accept-Ranges": "bytes",
+            "Content-Range": f"bytes {start}-{end}/{file_size}",
+            "Content-Length": str(end - start + 1),
+            "Content-Disposition": f'attachment; filename="{filename}"'
+        }
+    )
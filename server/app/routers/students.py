@@ -1,6 +1,8 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from typing import List
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+from typing import List, Optional
 
 from ..database import get_db
 from ..models import Student, StudentProfile
@@ -8,45 +10,56 @@ from ..schemas import Student as StudentSchema, StudentCreate, StudentProfile as
 
 router = APIRouter(prefix="/api/students", tags=["students"])
 
+async def _get_student(db: AsyncSession, student_id: int) -> Optional[Student]:
+    result = await db.execute(
+        select(Student).options(selectinload(Student.profile)).where(Student.id == student_id)
+    )
+    return result.scalar_one_or_none()
+
+async def _get_profile(db: AsyncSession, student_id: int) -> Optional[StudentProfile]:
+    result = await db.execute(select(StudentProfile).where(StudentProfile.student_id == student_id))
+    return result.scalar_one_or_none()
+
 @router.post("/", response_model=StudentSchema)
-async def create_student(student_data: StudentCreate, db: Session = Depends(get_db)):
+async def create_student(student_data: StudentCreate, db: AsyncSession = Depends(get_db)):
     db_student = Student(name=student_data.name, email=student_data.email)
     db.add(db_student)
-    db.commit()
-    db.refresh(db_student)
-    return db_student
+    await db.commit()
+    return await _get_student(db, db_student.id)
 
 @router.get("/{student_id}", response_model=StudentSchema)
-async def get_student(student_id: int, db: Session = Depends(get_db)):
-    student = db.query(Student).filter(Student.id == student_id).first()
+async def get_student(student_id: int, db: AsyncSession = Depends(get_db)):
+    student = await _get_student(db, student_id)
     if not student:
         raise HTTPException(status_code=404, detail="Student not found")
     return student
 
 @router.get("/", response_model=List[StudentSchema])
-async def list_students(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    students = db.query(Student).offset(skip).limit(limit).all()
-    return students
+async def list_students(skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_db)):
+    result = await db.execute(
+        select(Student).options(selectinload(Student.profile)).offset(skip).limit(limit)
+    )
+    return result.scalars().all()
 
 @router.post("/{student_id}/profile", response_model=StudentProfileSchema)
-async def create_student_profile(student_id: int, profile_data: StudentProfileCreate, db: Session = Depends(get_db)):
-    student = db.query(Student).filter(Student.id == student_id).first()
+async def create_student_profile(student_id: int, profile_data: StudentProfileCreate, db: AsyncSession = Depends(get_db)):
+    student = await db.get(Student, student_id)
     if not student:
         raise HTTPException(status_code=404, detail="Student not found")
     
-    existing_profile = db.query(StudentProfile).filter(StudentProfile.student_id == student_id).first()
+    existing_profile = await _get_profile(db, student_id)
     if existing_profile:
         raise HTTPException(status_code=400, detail="Profile already exists")
     
     db_profile = StudentProfile(student_id=student_id, **profile_data.dict())
     db.add(db_profile)
-    db.commit()
-    db.refresh(db_profile)
+    await db.commit()
+    await db.refresh(db_profile)
     return db_profile
 
 @router.put("/{student_id}/profile", response_model=StudentProfileSchema)
-async def update_student_profile(student_id: int, profile_data: StudentProfileUpdate, db: Session = Depends(get_db)):
-    profile = db.query(StudentProfile).filter(StudentProfile.student_id == student_id).first()
+async def update_student_profile(student_id: int, profile_data: StudentProfileUpdate, db: AsyncSession = Depends(get_db)):
+    profile = await _get_profile(db, student_id)
     if not profile:
         raise HTTPException(status_code=404, detail="Profile not found")
     
@@ -54,13 +67,13 @@ async def update_student_profile(student_id: int, profile_data: StudentProfileUp
     for field, value in update_data.items():
         setattr(profile, field, value)
     
-    db.commit()
-    db.refresh(profile)
+    await db.commit()
+    await db.refresh(profile)
     return profile
 
 @router.get("/{student_id}/profile", response_model=StudentProfileSchema)
-async def get_student_profile(student_id: int, db: Session = Depends(get_db)):
-    profile = db.query(StudentProfile).filter(StudentProfile.student_id == student_id).first()
+async def get_student_profile(student_id: int, db: AsyncSession = Depends(get_db)):
+    profile = await _get_profile(db, student_id)
     if not profile:
         raise HTTPException(status_code=404, detail="Profile not found")
     return profile
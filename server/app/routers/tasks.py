@@ -1,14 +1,20 @@
 from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
-from sqlalchemy.orm import Session
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List
 import json
+import logging
 import os
 
 from ..database import get_db
 from ..models import Task, ImportSession
 from ..schemas import Task as TaskSchema, TaskCreate, ImportTasksRequest, ImportTasksResponse, SearchRequest, SearchResponse
 from ..services.task_service import TaskService
-from ..services.rag_service import RAGService
+from ..services.rag_service import get_rag_service
+from ..tasks import import_tasks_task, run_task_import
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/api/tasks", tags=["tasks"])
 
@@ -16,50 +22,37 @@ router = APIRouter(prefix="/api/tasks", tags=["tasks"])
 async def import_tasks(
     import_data: ImportTasksRequest,
     background_tasks: BackgroundTasks,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    session = ImportSession(
-        filename=import_data.filename or "api_import",
-        status="pending"
-    )
-    db.add(session)
-    db.commit()
-    db.refresh(session)
-    
-    task_service = TaskService(db)
-    
+    import_kwargs = {}
     if import_data.tasks:
-        background_tasks.add_task(
-            task_service.import_tasks_from_data,
-            session.id,
-            import_data.tasks
-        )
+        import_kwargs["tasks_data"] = [task.dict() for task in import_data.tasks]
         total_tasks = len(import_data.tasks)
     elif import_data.filename:
         file_path = f"/app/data/tasks/{import_data.filename}"
         if not os.path.exists(file_path):
             raise HTTPException(status_code=404, detail="File not found")
-        
-        background_tasks.add_task(
-            task_service.import_tasks_from_file,
-            session.id,
-            file_path
-        )
+        import_kwargs["file_path"] = file_path
         total_tasks = 0
     else:
         data_dir = "/app/data/tasks"
-        if os.path.exists(data_dir):
-            background_tasks.add_task(
-                task_service.import_all_tasks_from_directory,
-                session.id,
-                data_dir
-            )
-            total_tasks = 0
-        else:
+        if not os.path.exists(data_dir):
             raise HTTPException(status_code=404, detail="No data directory found")
+        total_tasks = 0
     
-    session.total_tasks = total_tasks
-    db.commit()
+    session = ImportSession(
+        filename=import_data.filename or "api_import",
+        status="pending",
+        total_tasks=total_tasks
+    )
+    db.add(session)
+    await db.commit()
+    
+    try:
+        await run_in_threadpool(import_tasks_task.delay, session.id, **import_kwargs)
+    except Exception as e:
+        logger.warning(f"Could not enqueue import session {session.id}, importing in background: {e}")
+        background_tasks.add_task(run_task_import, session.id, **import_kwargs)
     
     return ImportTasksResponse(
         session_id=session.id,
@@ -73,33 +66,42 @@ async def list_tasks(
     difficulty: int = None,
     skip: int = 0,
     limit: int = 100,
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    query = db.query(Task)
+    query = select(Task)
     if topic:
-        query = query.filter(Task.topic == topic)
+        query = query.where(Task.topic == topic)
     if difficulty:
-        query = query.filter(Task.difficulty == difficulty)
+        query = query.where(Task.difficulty == difficulty)
     
-    tasks = query.offset(skip).limit(limit).all()
-    return tasks
+    result = await db.execute(query.offset(skip).limit(limit))
+    return result.scalars().all()
 
 @router.get("/{task_id}", response_model=TaskSchema)
-async def get_task(task_id: int, db: Session = Depends(get_db)):
-    task = db.query(Task).filter(Task.id == task_id).first()
+async def get_task(task_id: int, db: AsyncSession = Depends(get_db)):
+    task = await db.get(Task, task_id)
     if not task:
         raise HTTPException(status_code=404, detail="Task not found")
     return task
 
 @router.post("/", response_model=TaskSchema)
-async def create_task(task_data: TaskCreate, db: Session = Depends(get_db)):
-    task_service = TaskService(db)
-    task = task_service.create_task(task_data)
+async def create_task(task_data: TaskCreate, db: AsyncSession = Depends(get_db)):
+    # Проверка доступности RAG блокирующая, поэтому сервис берётся в пуле потоков
+    rag_service = await run_in_threadpool(get_rag_service)
+    
+    def create(session):
+        task_service = TaskService(session, rag_service=rag_service)
+        return task_service, task_service.create_task(task_data, index=False)
+    
+    # Через run_sync поверх асинхронного соединения идёт только работа с БД,
+    # а индексация в RAG с блокирующими HTTP-вызовами уходит в пул потоков
+    task_service, task = await db.run_sync(create)
+    await run_in_threadpool(task_service.index_in_rag, task)
     return task
 
 @router.get("/search", response_model=SearchResponse)
 async def search_tasks(q: str, topic: str = None, difficulty_min: int = 1, difficulty_max: int = 5):
-    rag_service = RAGService()
+    rag_service = await run_in_threadpool(get_rag_service)
     
     if not rag_service.available:
         return SearchResponse(
@@ -110,10 +112,10 @@ async def search_tasks(q: str, topic: str = None, difficulty_min: int = 1, diffi
         )
     
     difficulty_range = (difficulty_min, difficulty_max) if difficulty_min != difficulty_max else None
-    results = rag_service.hybrid_search(q, topic=topic, difficulty_range=difficulty_range)
+    search = await rag_service.hybrid_search_async(q, topic=topic, difficulty_range=difficulty_range)
     
     search_results = []
-    for result in results:
+    for result in search["results"]:
         search_results.append({
             "task_id": result["task_id"],
             "vector_score": result["vector_score"],
@@ -127,5 +129,6 @@ async def search_tasks(q: str, topic: str = None, difficulty_min: int = 1, diffi
         query=q,
         results=search_results,
         total=len(search_results),
-        mode="real"
+        mode="real",
+        legs=search["legs"]
     )
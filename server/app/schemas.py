@@ -98,12 +98,21 @@ class AssignmentOptions(BaseModel):
     include_part2: bool = False
     max_time_min: Optional[int] = None
     make_two_pdfs: bool = True
+    # Не выдавать скелеты задач из прошлых заданий ученика
+    exclude_seen_skeletons: bool = False
+    # Не выдавать задачи из прошлых завершённых заданий ученика
+    exclude_seen_tasks: bool = True
 
 class AssignmentCreate(BaseModel):
     student_id: int
     topics_text: str
     options: AssignmentOptions = AssignmentOptions()
 
+class AssignmentBatchCreate(BaseModel):
+    student_ids: List[int]
+    topics_text: str
+    options: AssignmentOptions = AssignmentOptions()
+
 class AssignmentItemCreate(BaseModel):
     task_id: int
     order_index: int
@@ -134,6 +143,7 @@ class Assignment(BaseModel):
     options: Dict[str, Any]
     student_pdf_path: Optional[str]
     teacher_pdf_path: Optional[str]
+    stage_timings: Optional[Dict[str, Any]] = None
     created_at: datetime
     completed_at: Optional[datetime]
     items: List[AssignmentItem] = []
@@ -145,6 +155,24 @@ class AssignmentResponse(BaseModel):
     assignment_id: int
     download_urls: Dict[str, str]
     message: str
+    status: str = "pending"
+    progress_url: Optional[str] = None
+
+class AssignmentBatchResponse(BaseModel):
+    batch_id: Optional[str]
+    status_url: Optional[str]
+    assignments: List[AssignmentResponse]
+    message: str
+
+class AssignmentBatchStatus(BaseModel):
+    batch_id: str
+    state: str
+    stats: Optional[Dict[str, Any]] = None
+
+class AssignmentProgress(BaseModel):
+    assignment_id: int
+    status: str
+    stage_timings: Dict[str, Any] = {}
 
 class ImportTasksRequest(BaseModel):
     filename: Optional[str] = None
@@ -175,3 +203,4 @@ class SearchResponse(BaseModel):
     results: List[SearchResult]
     total: int
     mode: str
+    legs: Dict[str, Any] = {}
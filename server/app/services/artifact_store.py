@@ -0,0 +1,142 @@
+import os
+import shutil
+import logging
+import threading
+from abc import ABC, abstractmethod
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+try:
+    import boto3
+    from botocore.client import Config as BotoConfig
+    from botocore.exceptions import ClientError
+    BOTO3_AVAILABLE = True
+except ImportError:
+    BOTO3_AVAILABLE = False
+
+# local - общий том (./data в docker-compose), s3 - S3-совместимое хранилище (MinIO)
+ARTIFACT_STORE = os.getenv("ARTIFACT_STORE", "local")
+ARTIFACT_DIR = os.getenv("ARTIFACT_DIR", "/app/data/artifacts")
+
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL", "http://minio:9000")
+# Адрес, по которому хранилище доступно браузеру (для presigned-ссылок)
+S3_PUBLIC_ENDPOINT_URL = os.getenv("S3_PUBLIC_ENDPOINT_URL", "") or S3_ENDPOINT_URL
+S3_BUCKET = os.getenv("S3_BUCKET", "assignments")
+S3_ACCESS_KEY = os.getenv("S3_ACCESS_KEY", "")
+S3_SECRET_KEY = os.getenv("S3_SECRET_KEY", "")
+S3_REGION = os.getenv("S3_REGION", "us-east-1")
+S3_PRESIGN_EXPIRES = int(os.getenv("S3_PRESIGN_EXPIRES", "300"))
+
+_store: Optional["ArtifactStore"] = None
+_store_lock = threading.Lock()
+
+
+def pdf_artifact_key(assignment_id, pdf_type: str) -> str:
+    return f"assignments/{assignment_id}/{pdf_type}.pdf"
+
+
+class ArtifactStore(ABC):
+    """Хранилище готовых файлов, доступное и API, и воркерам"""
+
+    @abstractmethod
+    def put_file(self, key: str, source_path: str) -> str:
+        """Сохраняет файл под ключом и возвращает ключ"""
+
+    @abstractmethod
+    def local_path(self, key: str) -> Optional[str]:
+        """Путь к файлу на диске этого хоста, если хранилище его даёт"""
+
+    @abstractmethod
+    def download_url(self, key: str, filename: str) -> Optional[str]:
+        """Временная ссылка на скачивание в обход API"""
+
+
+class LocalArtifactStore(ArtifactStore):
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        path = os.path.normpath(os.path.join(self.root, key))
+        if not path.startswith(os.path.normpath(self.root) + os.sep):
+            raise ValueError(f"Invalid artifact key: {key}")
+        return path
+
+    def put_file(self, key: str, source_path: str) -> str:
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.copyfile(source_path, tmp_path)
+        os.replace(tmp_path, path)
+        return key
+
+    def local_path(self, key: str) -> Optional[str]:
+        try:
+            path = self._path(key)
+        except ValueError:
+            return None
+        return path if os.path.exists(path) else None
+
+    def download_url(self, key: str, filename: str) -> Optional[str]:
+        return None
+
+
+class S3ArtifactStore(ArtifactStore):
+    def __init__(self):
+        if not BOTO3_AVAILABLE:
+            raise RuntimeError("boto3 is required for ARTIFACT_STORE=s3")
+
+        options = dict(
+            aws_access_key_id=S3_ACCESS_KEY or None,
+            aws_secret_access_key=S3_SECRET_KEY or None,
+            region_name=S3_REGION,
+            config=BotoConfig(signature_version="s3v4", s3={"addressing_style": "path"})
+        )
+        self.bucket = S3_BUCKET
+        self.client = boto3.client("s3", endpoint_url=S3_ENDPOINT_URL, **options)
+        self.presign_client = boto3.client("s3", endpoint_url=S3_PUBLIC_ENDPOINT_URL, **options)
+        self._ensure_bucket()
+
+    def _ensure_bucket(self):
+        try:
+            self.client.head_bucket(Bucket=self.bucket)
+        except ClientError:
+            logger.info(f"Creating artifact bucket {self.bucket}")
+            self.client.create_bucket(Bucket=self.bucket)
+
+    def put_file(self, key: str, source_path: str) -> str:
+        self.client.upload_file(
+            source_path,
+            self.bucket,
+            key,
+            ExtraArgs={"ContentType": "application/pdf"}
+        )
+        return key
+
+    def local_path(self, key: str) -> Optional[str]:
+        return None
+
+    def download_url(self, key: str, filename: str) -> Optional[str]:
+        return self.presign_client.generate_presigned_url(
+            "get_object",
+            Params={
+                "Bucket": self.bucket,
+                "Key": key,
+                "ResponseContentDisposition": f'attachment; filename="{filename}"'
+            },
+            ExpiresIn=S3_PRESIGN_EXPIRES
+        )
+
+
+def get_artifact_store() -> ArtifactStore:
+    """Хранилище артефактов, выбранное через ARTIFACT_STORE"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                if ARTIFACT_STORE == "s3":
+                    _store = S3ArtifactStore()
+                else:
+                    _store = LocalArtifactStore(ARTIFACT_DIR)
+                logger.info(f"Using {type(_store).__name__} for artifacts")
+    return _store
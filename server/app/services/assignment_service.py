@@ -1,20 +1,32 @@
+import os
 import json
+import time
 import random
-from typing import List, Dict, Any, Tuple
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Tuple, Iterable, Optional
 from sqlalchemy.orm import Session
 from datetime import datetime
 
 from ..models import Assignment, AssignmentItem, Student, StudentProfile, Task
-from .rag_service import RAGService
+from .rag_service import get_rag_service
 from .pdf_service import PDFService
-from ..drivers.yagpt_client import YaGPTClient
+from .candidate_pool import get_candidate_pool_index, pool_request, search_complete, CANDIDATE_POOL_SIZE
+from .bitset import IdBitset
+from .seen_tasks import get_seen_task_index, SEEN_TASKS_MAX_EXCLUDE
+from ..drivers.yagpt_client import get_yagpt_client
+
+logger = logging.getLogger(__name__)
+
+# Параллельные запросы к PDF-сервису при пакетной генерации
+BATCH_RENDER_THREADS = int(os.getenv("BATCH_RENDER_THREADS", "8"))
 
 class AssignmentService:
     def __init__(self, db: Session):
         self.db = db
-        self.rag_service = RAGService()
+        self.rag_service = get_rag_service()
         self.pdf_service = PDFService()
-        self.yagpt_client = YaGPTClient()
+        self.yagpt_client = get_yagpt_client()
     
     def parse_topics_text(self, topics_text: str) -> List[Dict[str, Any]]:
         topics = []
@@ -52,53 +64,256 @@ class AssignmentService:
         
         return context
     
+    def load_tasks(self, task_ids: Iterable[int], task_cache: Dict[int, Task]) -> Dict[int, Task]:
+        """Догружает в task_cache задачи одним запросом"""
+        missing_ids = {task_id for task_id in task_ids if task_id not in task_cache}
+        if missing_ids:
+            tasks = self.db.query(Task).filter(Task.id.in_(missing_ids)).all()
+            for task in tasks:
+                task_cache[task.id] = task
+        return task_cache
+    
+    def _difficulty_levels(self, student_context: Dict[str, Any]) -> List[int]:
+        target_score = student_context.get("target_score", 80)
+        base_difficulty = min(5, max(1, target_score // 20))
+        return [d for d in [base_difficulty, base_difficulty + 1] if d <= 5]
+    
+    def _pick_candidates(
+        self,
+        results_by_difficulty: List[Tuple[int, List[Dict[str, Any]]]],
+        count: int,
+        student_context: Dict[str, Any],
+        used_skeletons: IdBitset,
+        task_cache: Dict[int, Task]
+    ) -> List[Dict[str, Any]]:
+        """Лучшие по combined_score кандидаты с неиспользованными скелетами.
+
+        Дедупликация идёт по skeleton_id из payload поиска ещё до загрузки
+        задач, так что из БД читаются только выбранные задачи. Для
+        документов без skeleton_id в payload используется колонка задачи.
+        """
+        target_score = student_context.get("target_score", 80)
+        ranked = sorted(
+            ((difficulty, result) for difficulty, search_results in results_by_difficulty for result in search_results),
+            key=lambda item: item[1]["combined_score"],
+            reverse=True
+        )
+        
+        selected = []
+        position = 0
+        while len(selected) < count and position < len(ranked):
+            batch = []
+            batch_skeletons = set()
+            while position < len(ranked) and len(selected) + len(batch) < count:
+                difficulty, result = ranked[position]
+                position += 1
+                skeleton_id = result.get("skeleton_id")
+                if skeleton_id is not None and (skeleton_id in used_skeletons or skeleton_id in batch_skeletons):
+                    continue
+                batch.append((difficulty, result))
+                if skeleton_id is not None:
+                    batch_skeletons.add(skeleton_id)
+            
+            # Задачи, которых нет в БД или чей скелет уже занят, заменяются следующими по рангу
+            self.load_tasks((result["task_id"] for _, result in batch), task_cache)
+            for difficulty, result in batch:
+                task = task_cache.get(result["task_id"])
+                if task is None or task.skeleton_id is None or task.skeleton_id in used_skeletons:
+                    continue
+                used_skeletons.add(task.skeleton_id)
+                selected.append({
+                    "task": task,
+                    "scores": result,
+                    "selection_reason": f"Difficulty {difficulty} for target score {target_score}"
+                })
+        
+        return selected
+    
+    def search_candidate_pools(
+        self,
+        topics: List[Dict[str, Any]],
+        difficulties: Iterable[int],
+        exclude_task_ids: Optional[IdBitset] = None
+    ) -> Dict[Tuple[int, int], List[Dict[str, Any]]]:
+        """Кандидаты для всех пар (номер темы, сложность).
+
+        Пары с материализованным пулом берутся из CandidatePoolIndex, в
+        гибридный поиск одним пакетом уходят только промахи; их результаты
+        сохраняются как новые пулы, если отработали обе части поиска. Пулы
+        общие для всех учеников, поэтому
+        exclude_task_ids передаётся в поиск только для пар без пула, а
+        иначе применяется в retrieve_candidates_for_topics. Пар с лимитом
+        больше CANDIDATE_POOL_SIZE пул не покрывает: они ищутся напрямую и
+        не сохраняются, иначе каждый такой запрос перезаписывал бы пул.
+        Списки не обрезаются до лимита темы.
+        """
+        keys = [
+            (topic_number, difficulty)
+            for topic_number in range(len(topics))
+            for difficulty in sorted(set(difficulties))
+        ]
+        limits = {key: topics[key[0]]["count"] * 3 for key in keys}
+        pool_index = get_candidate_pool_index()
+        
+        pools = {}
+        if pool_index is not None:
+            stored = pool_index.get_many({(topics[topic_number]["topic"], difficulty) for topic_number, difficulty in keys})
+            for key in keys:
+                entries = stored.get((topics[key[0]]["topic"], key[1]))
+                # Пул короче CANDIDATE_POOL_SIZE - это вся выдача поиска, его хватает для любого limit
+                if entries is not None and (len(entries) >= limits[key] or len(entries) < CANDIDATE_POOL_SIZE):
+                    pools[key] = entries
+        
+        misses = [key for key in keys if key not in pools]
+        if not misses:
+            return pools
+        
+        pooled = {key for key in misses if pool_index is not None and limits[key] <= CANDIDATE_POOL_SIZE}
+        requests = []
+        for topic_number, difficulty in misses:
+            if (topic_number, difficulty) in pooled:
+                # Промах ищется сразу на весь пул, чтобы следующие задания попали в него
+                search_exclude, search_limit = None, CANDIDATE_POOL_SIZE
+            else:
+                search_exclude, search_limit = self._seen_exclusion(exclude_task_ids, limits[(topic_number, difficulty)])
+            requests.append(pool_request(
+                topics[topic_number]["topic"], difficulty,
+                limit=search_limit,
+                exclude_task_ids=search_exclude
+            ))
+        response = self.rag_service.hybrid_search_batch_with_legs(requests)
+        fresh_pools = {}
+        for key, results in zip(misses, response["results"]):
+            pools[key] = results
+            # Пустая выдача может означать ошибку поиска, такие пулы не сохраняются
+            if results and key in pooled:
+                fresh_pools[(topics[key[0]]["topic"], key[1])] = results
+        
+        # Выдача по одной части поиска годится для этого задания, но не как общий пул на CANDIDATE_POOL_TTL
+        if pool_index is not None and search_complete(response["legs"]):
+            pool_index.put_many(fresh_pools)
+        return pools
+    
+    @staticmethod
+    def _seen_exclusion(
+        seen_tasks: Optional[IdBitset],
+        limit: int,
+        known_seen: Iterable[int] = ()
+    ) -> Tuple[Optional[List[int]], int]:
+        """exclude_task_ids и limit для поиска без выданных ученику задач.
+
+        До SEEN_TASKS_MAX_EXCLUDE выданных задач передаются в поиск целиком.
+        Иначе исключаются только known_seen (выданные задачи, уже
+        встреченные в выдаче), а остальные отсеиваются по битовой карте
+        после поиска, поэтому limit берётся с запасом.
+        """
+        if not seen_tasks:
+            return None, limit
+        seen_count = len(seen_tasks)
+        if seen_count <= SEEN_TASKS_MAX_EXCLUDE:
+            return list(seen_tasks), limit
+        exclude = list(known_seen)[:SEEN_TASKS_MAX_EXCLUDE]
+        return exclude or None, limit + min(seen_count - len(exclude), SEEN_TASKS_MAX_EXCLUDE)
+    
+    def retrieve_candidates_for_topics(
+        self,
+        topics: List[Dict[str, Any]],
+        student_context: Dict[str, Any],
+        pools: Optional[Dict[Tuple[int, int], List[Dict[str, Any]]]] = None,
+        seen_tasks: Optional[IdBitset] = None
+    ) -> List[List[Tuple[int, List[Dict[str, Any]]]]]:
+        """Результаты гибридного поиска для всех тем задания одним пакетом.
+
+        Для каждой темы из parse_topics_text возвращает список пар
+        (сложность, результаты поиска) без задач из seen_tasks. Уже
+        найденные pools (например, общие для класса) используются без
+        повторного поиска. Если после отсева выданных задач в пуле
+        осталось меньше нужного, тема ищется заново без них (см. _seen_exclusion).
+        """
+        difficulties = self._difficulty_levels(student_context)
+        if pools is None:
+            pools = self.search_candidate_pools(topics, difficulties, exclude_task_ids=seen_tasks)
+        if seen_tasks is None:
+            seen_tasks = IdBitset()
+        
+        candidates = {}
+        short = {}
+        for topic_number, topic_info in enumerate(topics):
+            limit = topic_info["count"] * 3
+            for difficulty in difficulties:
+                key = (topic_number, difficulty)
+                pool = pools[key]
+                unseen = [result for result in pool if result["task_id"] not in seen_tasks]
+                candidates[key] = unseen[:limit]
+                # Если отсеивать было нечего, поиск и так вернул всё, что нашёл
+                if len(unseen) < limit and len(unseen) < len(pool):
+                    short[key] = [result["task_id"] for result in pool if result["task_id"] in seen_tasks]
+        
+        if short:
+            requests = []
+            for (topic_number, difficulty), known_seen in short.items():
+                exclude, limit = self._seen_exclusion(seen_tasks, topics[topic_number]["count"] * 3, known_seen)
+                requests.append(pool_request(
+                    topics[topic_number]["topic"], difficulty, limit=limit, exclude_task_ids=exclude
+                ))
+            # Выдача зависит от ученика, поэтому в пулы она не попадает
+            for key, results in zip(short, self.rag_service.hybrid_search_batch(requests)):
+                unseen = [result for result in results if result["task_id"] not in seen_tasks]
+                unseen = unseen[:topics[key[0]]["count"] * 3]
+                if len(unseen) > len(candidates[key]):
+                    candidates[key] = unseen
+        
+        return [
+            [(difficulty, candidates[(topic_number, difficulty)]) for difficulty in difficulties]
+            for topic_number in range(len(topics))
+        ]
+    
     def select_tasks_for_topic(
         self, 
         topic: str, 
         count: int, 
         student_context: Dict[str, Any],
-        used_skeleton_hashes: set
+        used_skeletons: IdBitset,
+        task_cache: Optional[Dict[int, Task]] = None,
+        seen_tasks: Optional[IdBitset] = None
     ) -> List[Dict[str, Any]]:
         
-        if not self.rag_service.available:
-            return self._mock_task_selection(topic, count, used_skeleton_hashes)
+        if task_cache is None:
+            task_cache = {}
         
-        target_score = student_context.get("target_score", 80)
-        base_difficulty = min(5, max(1, target_score // 20))
+        if not self.rag_service.available:
+            return self._mock_task_selection(topic, count, used_skeletons, seen_tasks)
         
-        candidates = []
+        results_by_difficulty = self.retrieve_candidates_for_topics(
+            [{"topic": topic, "count": count}], student_context, seen_tasks=seen_tasks
+        )[0]
         
-        for difficulty in [base_difficulty, base_difficulty + 1]:
-            if difficulty > 5:
-                continue
-                
-            search_results = self.rag_service.hybrid_search(
-                query=topic,
-                topic=topic,
-                difficulty_range=(difficulty, difficulty),
-                limit=count * 3
-            )
-            
-            for result in search_results:
-                task = self.db.query(Task).filter(Task.id == result["task_id"]).first()
-                if task and task.skeleton and task.skeleton.skeleton_hash not in used_skeleton_hashes:
-                    candidates.append({
-                        "task": task,
-                        "scores": result,
-                        "selection_reason": f"Difficulty {difficulty} for target score {target_score}"
-                    })
-                    used_skeleton_hashes.add(task.skeleton.skeleton_hash)
-        
-        candidates = sorted(candidates, key=lambda x: x["scores"]["combined_score"], reverse=True)
-        return candidates[:count]
-    
-    def _mock_task_selection(self, topic: str, count: int, used_skeleton_hashes: set) -> List[Dict[str, Any]]:
+        return self._pick_candidates(
+            results_by_difficulty, count, student_context, used_skeletons, task_cache
+        )
+    
+    def _mock_task_selection(
+        self,
+        topic: str,
+        count: int,
+        used_skeletons: IdBitset,
+        seen_tasks: Optional[IdBitset] = None
+    ) -> List[Dict[str, Any]]:
         """Простой алгоритм подбора задач по теме"""
-        tasks = self.db.query(Task).filter(Task.topic.ilike(f"%{topic}%")).limit(count * 2).all()
+        if seen_tasks is None:
+            seen_tasks = IdBitset()
+        tasks = (
+            self.db.query(Task)
+            .filter(Task.topic.ilike(f"%{topic}%"))
+            .limit(count * 2)
+            .all()
+        )
         
         selected = []
         for task in tasks:
-            if task.skeleton and task.skeleton.skeleton_hash not in used_skeleton_hashes:
+            if task.id in seen_tasks:
+                continue
+            if task.skeleton_id is not None and task.skeleton_id not in used_skeletons:
                 selected.append({
                     "task": task,
                     "scores": {
@@ -109,91 +324,338 @@ class AssignmentService:
                     },
                     "selection_reason": f"Соответствует теме '{topic}', подходящий уровень сложности"
                 })
-                used_skeleton_hashes.add(task.skeleton.skeleton_hash)
+                used_skeletons.add(task.skeleton_id)
                 if len(selected) >= count:
                     break
         
         return selected
     
-    def generate_assignment_async(self, assignment_id: int):
+    def _set_status(self, assignment: Assignment, status: str):
+        """Переводит задание в новый статус и записывает время этапов.
+
+        В stage_timings для каждого статуса хранится время начала, а для
+        завершённых этапов ещё время окончания и длительность в секундах.
+        """
+        now = datetime.utcnow()
+        timings = {stage: dict(info) for stage, info in (assignment.stage_timings or {}).items()}
+        
+        previous = timings.setdefault(
+            assignment.status or "pending",
+            {"started_at": (assignment.created_at or now).isoformat()}
+        )
+        if "finished_at" not in previous:
+            started_at = datetime.fromisoformat(previous["started_at"])
+            previous["finished_at"] = now.isoformat()
+            previous["seconds"] = round((now - started_at).total_seconds(), 3)
+        
+        timings[status] = {"started_at": now.isoformat()}
+        assignment.stage_timings = timings
+        assignment.status = status
+        self.db.commit()
+    
+    def _fill_assignment(
+        self,
+        assignment: Assignment,
+        topics: List[Dict[str, Any]],
+        student_context: Dict[str, Any],
+        task_cache: Dict[int, Task],
+        topic_results: Optional[List[List[Tuple[int, List[Dict[str, Any]]]]]] = None,
+        used_skeletons: Optional[IdBitset] = None,
+        seen_tasks: Optional[IdBitset] = None
+    ) -> Dict[str, Any]:
+        """Подбирает задачи, создаёт AssignmentItem и возвращает данные для PDF.
+
+        Без topic_results задачи подбираются простым поиском по теме, без
+        задач из seen_tasks (topic_results уже отфильтрованы).
+        used_skeletons - скелеты, которые нельзя выдавать (например, из
+        прошлых заданий ученика); дополняется выбранными.
+        """
+        if used_skeletons is None:
+            used_skeletons = IdBitset()
+        # Повторная попытка после сбоя на этапе PDF не должна дублировать уже сохранённые задачи
+        self.db.query(AssignmentItem).filter(
+            AssignmentItem.assignment_id == assignment.id
+        ).delete(synchronize_session=False)
+        tasks_data = []
+        order_index = 1
+        
+        for topic_number, topic_info in enumerate(topics):
+            topic = topic_info["topic"]
+            count = topic_info["count"]
+            
+            if topic_results is not None:
+                selected_tasks = self._pick_candidates(
+                    topic_results[topic_number], count, student_context,
+                    used_skeletons, task_cache
+                )
+            else:
+                selected_tasks = self._mock_task_selection(topic, count, used_skeletons, seen_tasks)
+            
+            for selected in selected_tasks:
+                task = selected["task"]
+                scores = selected["scores"]
+                
+                assignment_item = AssignmentItem(
+                    assignment_id=assignment.id,
+                    task_id=task.id,
+                    order_index=order_index,
+                    selection_reason=selected["selection_reason"],
+                    vector_score=scores.get("vector_score"),
+                    bm25_score=scores.get("bm25_score"),
+                    combined_score=scores.get("combined_score")
+                )
+                self.db.add(assignment_item)
+                
+                # Данные для PDF собираются до commit, пока задачи не устарели в сессии
+                tasks_data.append({
+                    "id": task.id,
+                    "topic": task.topic,
+                    "statement_text": task.statement_text,
+                    "answer": task.answer,
+                    "solution_text": task.solution_text,
+                    "order_index": order_index
+                })
+                order_index += 1
+        
+        return {
+            "tasks": tasks_data,
+            "student": {
+                "name": student_context["student_name"],
+                "grade": student_context["grade"]
+            },
+            "assignment_id": assignment.id,
+            "topics_text": assignment.topics_text
+        }
+    
+    def skeleton_history(self, student_id: int, exclude_assignment_id: Optional[int] = None) -> IdBitset:
+        """Скелеты задач из прошлых заданий ученика"""
+        query = (
+            self.db.query(Task.skeleton_id)
+            .join(AssignmentItem, AssignmentItem.task_id == Task.id)
+            .join(Assignment, Assignment.id == AssignmentItem.assignment_id)
+            .filter(Assignment.student_id == student_id, Task.skeleton_id.isnot(None))
+        )
+        if exclude_assignment_id is not None:
+            query = query.filter(Assignment.id != exclude_assignment_id)
+        return IdBitset(skeleton_id for (skeleton_id,) in query.distinct())
+    
+    def _initial_skeletons(self, assignment: Assignment) -> IdBitset:
+        if (assignment.options or {}).get("exclude_seen_skeletons"):
+            return self.skeleton_history(assignment.student_id, exclude_assignment_id=assignment.id)
+        return IdBitset()
+    
+    def seen_task_ids(self, student_id: int) -> List[int]:
+        """Задачи из завершённых заданий ученика; читается только для
+        построения битовой карты SeenTaskIndex"""
+        query = (
+            self.db.query(AssignmentItem.task_id)
+            .join(Assignment, Assignment.id == AssignmentItem.assignment_id)
+            .filter(Assignment.student_id == student_id, Assignment.status == "completed")
+        )
+        return [task_id for (task_id,) in query.distinct()]
+    
+    def _seen_tasks(self, assignment: Assignment) -> Optional[IdBitset]:
+        if not (assignment.options or {}).get("exclude_seen_tasks", True):
+            return None
+        seen_index = get_seen_task_index()
+        if seen_index is None:
+            return None
+        return seen_index.get(assignment.student_id, self.seen_task_ids)
+    
+    def _complete(self, assignment: Assignment, pdf_keys: Tuple[str, str], pdf_data: Dict[str, Any]):
+        assignment.student_pdf_path, assignment.teacher_pdf_path = pdf_keys
+        assignment.completed_at = datetime.utcnow()
+        self._set_status(assignment, "completed")
+        
+        seen_index = get_seen_task_index()
+        if seen_index is not None:
+            seen_index.mark(assignment.student_id, (task["id"] for task in pdf_data["tasks"]))
+    
+    def _fail(self, assignment: Assignment, final_attempt: bool = True):
+        """Статус после ошибки: retrying, пока у задачи Celery остаются повторы"""
+        self._set_status(assignment, "failed" if final_attempt else "retrying")
+    
+    def generate_assignment_async(self, assignment_id: int, final_attempt: bool = True):
         assignment = self.db.query(Assignment).filter(Assignment.id == assignment_id).first()
         if not assignment:
             return
         
         try:
-            assignment.status = "generating"
-            self.db.commit()
+            self._set_status(assignment, "generating")
             
             student_context = self.get_student_context(assignment.student_id)
             topics = self.parse_topics_text(assignment.topics_text)
             
-            used_skeleton_hashes = set()
-            all_selected_tasks = []
-            order_index = 1
-            
-            for topic_info in topics:
-                topic = topic_info["topic"]
-                count = topic_info["count"]
-                
-                selected_tasks = self.select_tasks_for_topic(
-                    topic, count, student_context, used_skeleton_hashes
-                )
-                
-                for selected in selected_tasks:
-                    task = selected["task"]
-                    scores = selected["scores"]
-                    
-                    assignment_item = AssignmentItem(
-                        assignment_id=assignment.id,
-                        task_id=task.id,
-                        order_index=order_index,
-                        selection_reason=selected["selection_reason"],
-                        vector_score=scores.get("vector_score"),
-                        bm25_score=scores.get("bm25_score"),
-                        combined_score=scores.get("combined_score")
-                    )
-                    
-                    self.db.add(assignment_item)
-                    all_selected_tasks.append(assignment_item)
-                    order_index += 1
-            
-            self.db.commit()
+            # Задачи, уже загруженные для предыдущих тем этой генерации
+            task_cache: Dict[int, Task] = {}
+            topic_results = None
+            seen_tasks = self._seen_tasks(assignment)
             
-            assignment.status = "generating_pdfs"
-            self.db.commit()
+            if self.rag_service.available:
+                # Поиск по всем темам одним пакетом; из БД читаются только выбранные задачи
+                topic_results = self.retrieve_candidates_for_topics(topics, student_context, seen_tasks=seen_tasks)
             
-            tasks_data = []
-            for item in all_selected_tasks:
-                self.db.refresh(item)
-                tasks_data.append({
-                    "id": item.task.id,
-                    "topic": item.task.topic,
-                    "statement_text": item.task.statement_text,
-                    "answer": item.task.answer,
-                    "solution_text": item.task.solution_text,
-                    "order_index": item.order_index
-                })
-            
-            pdf_data = {
-                "tasks": tasks_data,
-                "student": {
-                    "name": student_context["student_name"],
-                    "grade": student_context["grade"]
-                },
-                "assignment_id": assignment.id,
-                "topics_text": assignment.topics_text
-            }
+            pdf_data = self._fill_assignment(
+                assignment, topics, student_context, task_cache, topic_results,
+                used_skeletons=self._initial_skeletons(assignment),
+                seen_tasks=seen_tasks
+            )
             
-            student_pdf_path = self.pdf_service.generate_student_pdf(pdf_data)
-            teacher_pdf_path = self.pdf_service.generate_teacher_pdf(pdf_data)
+            self._set_status(assignment, "generating_pdfs")
             
-            assignment.student_pdf_path = student_pdf_path
-            assignment.teacher_pdf_path = teacher_pdf_path
-            assignment.status = "completed"
-            assignment.completed_at = datetime.utcnow()
-            self.db.commit()
+            self._complete(assignment, self.pdf_service.generate_pdf_artifacts(pdf_data), pdf_data)
             
         except Exception as e:
-            assignment.status = "failed"
-            self.db.commit()
+            self.db.rollback()
+            self._fail(assignment, final_attempt)
             raise e
+    
+    def get_student_contexts(self, student_ids: Iterable[int]) -> Dict[int, Dict[str, Any]]:
+        """Контексты нескольких учеников двумя запросами вместо 2N"""
+        student_ids = set(student_ids)
+        students = {
+            student.id: student
+            for student in self.db.query(Student).filter(Student.id.in_(student_ids)).all()
+        }
+        profiles = {
+            profile.student_id: profile
+            for profile in self.db.query(StudentProfile).filter(StudentProfile.student_id.in_(student_ids)).all()
+        }
+        
+        contexts = {}
+        for student_id in student_ids:
+            student = students.get(student_id)
+            profile = profiles.get(student_id)
+            contexts[student_id] = {
+                "student_name": student.name if student else "Unknown",
+                "grade": profile.grade if profile else 11,
+                "target_score": profile.target_score if profile else 80,
+                "weak_topics": profile.weak_topics if profile else [],
+                "strong_topics": profile.strong_topics if profile else [],
+                "preferred_task_types": profile.preferred_task_types if profile else [],
+                "past_mistakes": profile.past_mistakes if profile else []
+            }
+        return contexts
+    
+    def generate_assignments_batch(self, assignment_ids: List[int], final_attempt: bool = True) -> Dict[str, Any]:
+        """Генерация заданий для класса по общему списку тем.
+
+        Поиск кандидатов выполняется один раз для каждой пары (тема,
+        сложность), нужной хотя бы одному ученику; сложность для каждого
+        подбирается по его профилю. PDF рендерятся параллельно в пуле
+        потоков. Возвращает статистику пропускной способности батча. Если
+        батч упал целиком, незавершённые задания ждут повтора в статусе
+        retrying (failed на последней попытке).
+        """
+        started = time.perf_counter()
+        assignments = (
+            self.db.query(Assignment)
+            .filter(Assignment.id.in_(assignment_ids), Assignment.status != "completed")
+            .order_by(Assignment.id)
+            .all()
+        )
+        stats = {
+            "assignments": len(assignments),
+            "completed": 0,
+            "failed": 0,
+            "candidate_pools": 0,
+            "retrieval_seconds": 0.0,
+            "selection_seconds": 0.0,
+            "render_seconds": 0.0
+        }
+        if not assignments:
+            return stats
+        
+        # Задачи из общих пулов переиспользуются всеми заданиями батча, поэтому
+        # commit после каждого этапа не должен сбрасывать их состояние
+        expire_on_commit = self.db.expire_on_commit
+        self.db.expire_on_commit = False
+        try:
+            return self._generate_batch(assignments, stats, started)
+        except Exception:
+            self.db.rollback()
+            for assignment in assignments:
+                if assignment.status not in ("completed", "failed"):
+                    self._fail(assignment, final_attempt)
+            raise
+        finally:
+            self.db.expire_on_commit = expire_on_commit
+    
+    def _generate_batch(self, assignments: List[Assignment], stats: Dict[str, Any], started: float) -> Dict[str, Any]:
+        contexts = self.get_student_contexts(assignment.student_id for assignment in assignments)
+        topics_by_text = {}
+        task_cache: Dict[int, Task] = {}
+        pools_by_text = {}
+        
+        stage_started = time.perf_counter()
+        for assignment in assignments:
+            self._set_status(assignment, "generating")
+            topics_by_text.setdefault(assignment.topics_text, self.parse_topics_text(assignment.topics_text))
+        
+        if self.rag_service.available:
+            for topics_text, topics in topics_by_text.items():
+                difficulties = {
+                    difficulty
+                    for assignment in assignments if assignment.topics_text == topics_text
+                    for difficulty in self._difficulty_levels(contexts[assignment.student_id])
+                }
+                pools = self.search_candidate_pools(topics, difficulties)
+                stats["candidate_pools"] += len(pools)
+                pools_by_text[topics_text] = pools
+        stats["retrieval_seconds"] = round(time.perf_counter() - stage_started, 3)
+        
+        stage_started = time.perf_counter()
+        pending_pdfs = []
+        for assignment in assignments:
+            student_context = contexts[assignment.student_id]
+            topics = topics_by_text[assignment.topics_text]
+            try:
+                topic_results = None
+                # Пулы общие для класса, выданные ученику задачи отсекаются по его битовой карте
+                seen_tasks = self._seen_tasks(assignment)
+                if assignment.topics_text in pools_by_text:
+                    topic_results = self.retrieve_candidates_for_topics(
+                        topics, student_context, pools=pools_by_text[assignment.topics_text],
+                        seen_tasks=seen_tasks
+                    )
+                # Точка сохранения откатывает только это задание: rollback всей
+                # сессии сбросил бы задачи из task_cache, общие для батча
+                with self.db.begin_nested():
+                    pdf_data = self._fill_assignment(
+                        assignment, topics, student_context, task_cache, topic_results,
+                        used_skeletons=self._initial_skeletons(assignment),
+                        seen_tasks=seen_tasks
+                    )
+            except Exception as e:
+                logger.error(f"Batch generation failed for assignment {assignment.id}: {e}")
+                self._set_status(assignment, "failed")
+                stats["failed"] += 1
+                continue
+            self._set_status(assignment, "generating_pdfs")
+            pending_pdfs.append((assignment, pdf_data))
+        stats["selection_seconds"] = round(time.perf_counter() - stage_started, 3)
+        
+        stage_started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=BATCH_RENDER_THREADS, thread_name_prefix="batch-pdf") as executor:
+            futures = [
+                (assignment, pdf_data, executor.submit(self.pdf_service.generate_pdf_artifacts, pdf_data))
+                for assignment, pdf_data in pending_pdfs
+            ]
+            for assignment, pdf_data, future in futures:
+                try:
+                    pdf_keys = future.result()
+                except Exception as e:
+                    # В сессии нет несохранённых изменений, откатывать нечего
+                    logger.error(f"PDF generation failed for assignment {assignment.id}: {e}")
+                    self._set_status(assignment, "failed")
+                    stats["failed"] += 1
+                    continue
+                self._complete(assignment, pdf_keys, pdf_data)
+                stats["completed"] += 1
+        stats["render_seconds"] = round(time.perf_counter() - stage_started, 3)
+        
+        total_seconds = time.perf_counter() - started
+        stats["seconds"] = round(total_seconds, 3)
+        stats["assignments_per_sec"] = round(stats["completed"] / total_seconds, 2) if total_seconds > 0 else 0.0
+        logger.info(f"Assignment batch finished: {stats}")
+        return stats
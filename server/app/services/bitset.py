@@ -0,0 +1,63 @@
+from typing import Iterable, Iterator
+
+
+class IdBitset:
+    """Множество неотрицательных целых id: по одному биту на id.
+
+    Биты в байте идут от старшего к младшему, как в битовых картах Redis
+    (SETBIT/GETBIT), поэтому to_bytes/from_bytes совместимы с ними.
+    """
+
+    __slots__ = ("_bits",)
+
+    def __init__(self, ids: Iterable[int] = (), capacity: int = 0):
+        self._bits = bytearray((capacity + 7) // 8)
+        self.update(ids)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "IdBitset":
+        bitset = cls()
+        bitset._bits = bytearray(data or b"")
+        return bitset
+
+    def to_bytes(self) -> bytes:
+        return bytes(self._bits)
+
+    def add(self, item: int):
+        if item < 0:
+            raise ValueError(f"IdBitset stores non-negative ids, got {item}")
+        byte = item >> 3
+        if byte >= len(self._bits):
+            # Рост с запасом, чтобы последовательные add не копировали буфер каждый раз
+            self._bits.extend(bytes(max(byte + 1 - len(self._bits), len(self._bits))))
+        self._bits[byte] |= 0x80 >> (item & 7)
+
+    def update(self, ids: Iterable[int]):
+        for item in ids:
+            self.add(item)
+
+    def __contains__(self, item) -> bool:
+        if item is None or item < 0:
+            return False
+        byte = item >> 3
+        return byte < len(self._bits) and bool(self._bits[byte] & (0x80 >> (item & 7)))
+
+    def __or__(self, other: "IdBitset") -> "IdBitset":
+        short, long = sorted((self._bits, other._bits), key=len)
+        result = IdBitset.from_bytes(long)
+        for position, value in enumerate(short):
+            result._bits[position] |= value
+        return result
+
+    def __len__(self) -> int:
+        return int.from_bytes(self._bits, "big").bit_count()
+
+    def __iter__(self) -> Iterator[int]:
+        for byte, value in enumerate(self._bits):
+            if value:
+                for bit in range(8):
+                    if value & (0x80 >> bit):
+                        yield (byte << 3) | bit
+
+    def __repr__(self) -> str:
+        return f"IdBitset({len(self)} ids)"
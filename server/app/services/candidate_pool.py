@@ -0,0 +1,230 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from typing import List, Dict, Any, Optional, Iterable, Tuple
+
+logger = logging.getLogger(__name__)
+
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+# redis - общий для API и воркеров, memory - только в пределах процесса, off - без пулов
+CANDIDATE_POOL_BACKEND = os.getenv("CANDIDATE_POOL_BACKEND", "redis")
+# Сколько лучших задач хранится для каждой пары (тема, сложность)
+CANDIDATE_POOL_SIZE = int(os.getenv("CANDIDATE_POOL_SIZE", "100"))
+# Страховка на случай, если инвалидация разошлась с индексацией
+CANDIDATE_POOL_TTL = int(os.getenv("CANDIDATE_POOL_TTL", "3600"))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+_index: Optional["CandidatePoolIndex"] = None
+_index_lock = threading.Lock()
+
+
+def normalize_topic(topic: str) -> str:
+    return " ".join(topic.split()).lower()
+
+
+def pool_request(
+    topic: str,
+    difficulty: int,
+    limit: int = CANDIDATE_POOL_SIZE,
+    exclude_task_ids: Optional[List[int]] = None
+) -> Dict[str, Any]:
+    """Запрос hybrid_search_batch, результат которого хранится как пул (тема, сложность)"""
+    return {
+        "query": topic,
+        "topic": topic,
+        "difficulty_range": (difficulty, difficulty),
+        "limit": limit,
+        "exclude_task_ids": exclude_task_ids
+    }
+
+
+def search_complete(legs: Dict[str, str]) -> bool:
+    """Обе части гибридного поиска отработали; только такую выдачу можно делать пулом"""
+    return bool(legs) and all(status == "ok" for status in legs.values())
+
+
+class CandidatePoolIndex:
+    """Материализованные результаты гибридного поиска по (тема, сложность).
+
+    Для каждой пары хранится ранжированный список записей с task_id,
+    скорами, skeleton_hash и skeleton_id - ровно то, что вернул бы hybrid_search с
+    запросом, равным теме. Пул строится при первом промахе. Когда в банк
+    добавляются задачи той же темы и сложности и индексация подтверждена,
+    пул сразу перестраивается (rebuild_tasks); при импорте без ожидания
+    индексации он только сбрасывается (invalidate_tasks).
+    """
+
+    def __init__(self, backend: str = "memory", ttl: int = CANDIDATE_POOL_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._redis = None
+        self._memory: Dict[str, Tuple[float, List[Dict[str, Any]]]] = {}
+        self._lock = threading.Lock()
+
+        if backend == "redis":
+            if not REDIS_AVAILABLE:
+                logger.warning("redis package is not installed, keeping candidate pools in memory")
+            else:
+                try:
+                    self._redis = redis.Redis.from_url(REDIS_URL, socket_timeout=1.0, socket_connect_timeout=1.0)
+                    self._redis.ping()
+                except Exception as e:
+                    logger.warning(f"Redis is not available for candidate pools, keeping them in memory: {e}")
+                    self._redis = None
+
+    @property
+    def backend(self) -> str:
+        return "redis" if self._redis is not None else "memory"
+
+    @staticmethod
+    def _key(topic: str, difficulty: int) -> str:
+        topic_hash = hashlib.sha1(normalize_topic(topic).encode("utf-8")).hexdigest()
+        return f"candidate_pool:{topic_hash}:{int(difficulty)}"
+
+    def get_many(self, keys: Iterable[Tuple[str, int]]) -> Dict[Tuple[str, int], List[Dict[str, Any]]]:
+        """Пулы для пар (тема, сложность); отсутствующие пары в ответ не попадают"""
+        keys = list(keys)
+        if not keys:
+            return {}
+        storage_keys = [self._key(topic, difficulty) for topic, difficulty in keys]
+        found = {}
+
+        if self._redis is not None:
+            try:
+                values = self._redis.mget(storage_keys)
+            except Exception as e:
+                logger.warning(f"Could not read candidate pools: {e}")
+                values = [None] * len(keys)
+            for key, value in zip(keys, values):
+                if value is not None:
+                    found[key] = json.loads(value)
+        else:
+            now = time.monotonic()
+            with self._lock:
+                for key, storage_key in zip(keys, storage_keys):
+                    entry = self._memory.get(storage_key)
+                    if entry and entry[0] > now:
+                        found[key] = entry[1]
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, pools: Dict[Tuple[str, int], List[Dict[str, Any]]]):
+        if not pools:
+            return
+        trimmed = {
+            self._key(topic, difficulty): [
+                {
+                    "task_id": entry["task_id"],
+                    "vector_score": entry.get("vector_score", 0.0),
+                    "bm25_score": entry.get("bm25_score", 0.0),
+                    "combined_score": entry.get("combined_score", 0.0),
+                    "skeleton_hash": entry.get("skeleton_hash"),
+                    "skeleton_id": entry.get("skeleton_id")
+                }
+                for entry in entries[:CANDIDATE_POOL_SIZE]
+            ]
+            for (topic, difficulty), entries in pools.items()
+        }
+
+        if self._redis is not None:
+            try:
+                pipeline = self._redis.pipeline(transaction=False)
+                for storage_key, entries in trimmed.items():
+                    pipeline.set(storage_key, json.dumps(entries), ex=self.ttl)
+                pipeline.execute()
+            except Exception as e:
+                logger.warning(f"Could not store candidate pools: {e}")
+        else:
+            expires_at = time.monotonic() + self.ttl
+            with self._lock:
+                for storage_key, entries in trimmed.items():
+                    self._memory[storage_key] = (expires_at, entries)
+
+    def invalidate(self, keys: Iterable[Tuple[str, int]]):
+        """Сбрасывает пулы, в которые могли попасть новые задачи"""
+        storage_keys = {self._key(topic, difficulty) for topic, difficulty in keys if topic and difficulty}
+        if not storage_keys:
+            return
+
+        if self._redis is not None:
+            try:
+                self._redis.delete(*storage_keys)
+            except Exception as e:
+                logger.warning(f"Could not invalidate candidate pools: {e}")
+        else:
+            with self._lock:
+                for storage_key in storage_keys:
+                    self._memory.pop(storage_key, None)
+        logger.info(f"Invalidated {len(storage_keys)} candidate pools")
+
+    @staticmethod
+    def _task_keys(tasks: Iterable[Any]) -> List[Tuple[str, int]]:
+        keys = {
+            (task["topic"], task["difficulty"]) if isinstance(task, dict) else (task.topic, task.difficulty)
+            for task in tasks
+        }
+        return [(topic, difficulty) for topic, difficulty in keys if topic and difficulty]
+
+    def invalidate_tasks(self, tasks: Iterable[Any]):
+        """Сбрасывает пулы по темам и сложностям добавленных задач
+        (моделей, схем или словарей документов для индекса)"""
+        self.invalidate(self._task_keys(tasks))
+
+    def rebuild_tasks(self, tasks: Iterable[Any], rag_service) -> int:
+        """Перестраивает пулы по темам и сложностям добавленных задач.
+
+        Вызывается после подтверждённой индексации, поэтому новые задачи
+        уже видны в поиске. Если какая-то часть поиска не отработала, пулы
+        сбрасываются и строятся заново при следующем запросе. Возвращает
+        число перестроенных пулов.
+        """
+        keys = self._task_keys(tasks)
+        if not keys:
+            return 0
+        response = rag_service.hybrid_search_batch_with_legs(
+            [pool_request(topic, difficulty) for topic, difficulty in keys]
+        )
+        if not search_complete(response["legs"]):
+            self.invalidate(keys)
+            return 0
+
+        pools = {key: results for key, results in zip(keys, response["results"]) if results}
+        self.invalidate(key for key in keys if key not in pools)
+        self.put_many(pools)
+        logger.info(f"Rebuilt {len(pools)} candidate pools")
+        return len(pools)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "backend": self.backend,
+            "pool_size": CANDIDATE_POOL_SIZE,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0
+        }
+
+
+def get_candidate_pool_index() -> Optional[CandidatePoolIndex]:
+    """Общий для процесса индекс пулов; None, если пулы отключены"""
+    global _index
+    if CANDIDATE_POOL_BACKEND == "off":
+        return None
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = CandidatePoolIndex(CANDIDATE_POOL_BACKEND)
+    return _index
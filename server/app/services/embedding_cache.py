@@ -0,0 +1,163 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Dict, Any
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingCache:
+    """LRU-кэш эмбеддингов запросов.
+
+    Ключ - хэш нормализованного текста и имени модели. Каждые flush_every
+    новых записей снимок кэша в фоновом потоке атомарно сохраняется в
+    .npy-файл (ключ + вектор в каждой строке), при остановке процесса -
+    синхронно через flush. При старте снимок открывается через memory map:
+    в память читаются только ключи, а вектор копируется из файла при
+    первом обращении к нему, так что новые воркеры сразу получают
+    прогретый кэш и не держат в RAM неиспользуемые строки.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        dim: int,
+        capacity: int = 4096,
+        path: Optional[str] = None,
+        flush_every: int = 32
+    ):
+        self.model_name = model_name
+        self.dim = dim
+        self.capacity = capacity
+        self.path = path
+        self.flush_every = flush_every
+
+        self.hits = 0
+        self.misses = 0
+
+        self._vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self._slots: "OrderedDict[str, int]" = OrderedDict()
+        self._free_slots = list(range(capacity - 1, -1, -1))
+        # Строки снимка, ещё не перенесённые в _vectors: ключ -> номер строки
+        self._snapshot: Optional[np.ndarray] = None
+        self._snapshot_rows: Dict[str, int] = {}
+        self._dirty = 0
+        self._lock = threading.Lock()
+        # Сохранения снимка идут по одному: фоновое и при остановке пишут один файл
+        self._flush_lock = threading.Lock()
+        self._flush_thread: Optional[threading.Thread] = None
+
+        if self.path:
+            self._load()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return " ".join(text.split()).lower()
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha1(f"{self.model_name}\x00{self.normalize(text)}".encode("utf-8")).hexdigest()
+
+    def get(self, text: str) -> Optional[List[float]]:
+        key = self._key(text)
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is None:
+                row = self._snapshot_rows.pop(key, None)
+                if row is None:
+                    self.misses += 1
+                    return None
+                slot = self._allocate_slot()
+                self._vectors[slot] = self._snapshot["vector"][row]
+                self._slots[key] = slot
+            self._slots.move_to_end(key)
+            self.hits += 1
+            return self._vectors[slot].tolist()
+
+    def _allocate_slot(self) -> int:
+        if self._free_slots:
+            return self._free_slots.pop()
+        _, slot = self._slots.popitem(last=False)
+        return slot
+
+    def put(self, text: str, embedding: List[float]):
+        if self.capacity <= 0:
+            return
+        key = self._key(text)
+        with self._lock:
+            self._snapshot_rows.pop(key, None)
+            slot = self._slots.get(key)
+            if slot is None:
+                slot = self._allocate_slot()
+            self._slots[key] = slot
+            self._slots.move_to_end(key)
+            self._vectors[slot] = embedding
+            self._dirty += 1
+            should_flush = (
+                self.path and self._dirty >= self.flush_every
+                and (self._flush_thread is None or not self._flush_thread.is_alive())
+            )
+            if should_flush:
+                # Запись на диск не должна задерживать поиск, который положил эмбеддинг
+                self._flush_thread = threading.Thread(target=self.flush, name="embedding-cache-flush", daemon=True)
+                self._flush_thread.start()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "model": self.model_name,
+            "size": len(self._slots) + len(self._snapshot_rows),
+            "capacity": self.capacity,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0
+        }
+
+    def _snapshot_dtype(self) -> np.dtype:
+        return np.dtype([("key", "S40"), ("vector", np.float32, (self.dim,))])
+
+    def _load(self):
+        if self.capacity <= 0 or not os.path.exists(self.path):
+            return
+        try:
+            stored = np.load(self.path, mmap_mode="r")
+            if stored.dtype != self._snapshot_dtype():
+                logger.info("Embedding cache snapshot has another layout, ignoring it")
+                return
+            # Строки снимка хранятся в порядке LRU, самые свежие в конце
+            self._snapshot = stored[-self.capacity:]
+            self._snapshot_rows = {key.decode("ascii"): row for row, key in enumerate(self._snapshot["key"])}
+            logger.info(f"Mapped {len(self._snapshot_rows)} cached query embeddings")
+        except Exception as e:
+            logger.warning(f"Could not load embedding cache: {e}")
+
+    def flush(self):
+        """Атомарно сохраняет снимок кэша на диск"""
+        if not self.path:
+            return
+        with self._flush_lock:
+            self._write_snapshot()
+
+    def _write_snapshot(self):
+        with self._lock:
+            # Непрочитанные строки старого снимка давнее всего, что уже в памяти
+            mapped = len(self._snapshot_rows)
+            snapshot = np.empty(mapped + len(self._slots), dtype=self._snapshot_dtype())
+            if mapped:
+                rows = np.fromiter(self._snapshot_rows.values(), dtype=np.int64, count=mapped)
+                snapshot[:mapped] = self._snapshot[rows]
+            snapshot["key"][mapped:] = [key.encode("ascii") for key in self._slots]
+            snapshot["vector"][mapped:] = self._vectors[np.fromiter(self._slots.values(), dtype=np.int64, count=len(self._slots))]
+            snapshot = snapshot[-self.capacity:]
+            self._dirty = 0
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, snapshot)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.warning(f"Could not persist embedding cache: {e}")
@@ -0,0 +1,569 @@
+import os
+import re
+import json
+import math
+import time
+import logging
+import threading
+from array import array
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, Iterable, Tuple
+
+import numpy as np
+
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False
+
+try:
+    import snowballstemmer
+    SNOWBALL_AVAILABLE = True
+except ImportError:
+    SNOWBALL_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# meilisearch - внешний Meilisearch, local - LexicalIndex (BM25) в процессе
+LEXICAL_BACKEND = os.getenv("LEXICAL_BACKEND", "meilisearch")
+LEXICAL_INDEX_PATH = os.getenv("LEXICAL_INDEX_PATH", "/app/data/lexical_index.npz")
+# Как часто проверять, не сохранил ли другой процесс новую версию индекса
+LEXICAL_INDEX_RELOAD_INTERVAL = float(os.getenv("LEXICAL_INDEX_RELOAD_INTERVAL", "5"))
+# Сколько документов может накопиться в журнале, прежде чем индекс сохраняется целиком
+LEXICAL_LOG_MAX_DOCUMENTS = int(os.getenv("LEXICAL_LOG_MAX_DOCUMENTS", "10000"))
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Доля заменённых документов, после которой индекс пересобирается без них
+COMPACT_DEAD_RATIO = 0.25
+
+TOKEN_RE = re.compile(r"[a-zа-я]+|\d+(?:[.,]\d+)?")
+
+STOP_WORDS = frozenset(
+    "а в во вы да для до его ее если есть же за и из или им их к как ко ли мы на над не ни "
+    "но о об он она они оно от по под при про с со так то том у уж что чтобы это эта эти этот я".split()
+)
+
+# Окончания для запасного стеммера, если snowballstemmer не установлен; длинные проверяются первыми
+RUSSIAN_SUFFIXES = sorted(
+    (
+        "иями ями ами ией ого его ому ему ыми ими ешь ете ишь ите ует уют ают яют "
+        "ать ять ить еть уть ал ял ил ел ла ли ло ов ев ей ий ый ой ая яя ое ее ые ие "
+        "ом ем ам ям ах ях ую юю ию ия ья ье ью а я о е ы и у ю ь"
+    ).split(),
+    key=len,
+    reverse=True
+)
+
+_index: Optional["LexicalIndex"] = None
+_index_lock = threading.Lock()
+_stemmer = snowballstemmer.stemmer("russian") if SNOWBALL_AVAILABLE else None
+
+
+@lru_cache(maxsize=100000)
+def stem(token: str) -> str:
+    if not "а" <= token[0] <= "я":
+        return token
+    if _stemmer is not None:
+        return _stemmer.stemWord(token)
+    for suffix in RUSSIAN_SUFFIXES:
+        if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+            return token[:-len(suffix)]
+    return token
+
+
+def tokenize(text: str) -> List[str]:
+    """Токены для BM25: нижний регистр, ё как е, без стоп-слов, со стеммингом"""
+    text = text.lower().replace("ё", "е")
+    return [stem(token) for token in TOKEN_RE.findall(text) if token not in STOP_WORDS]
+
+
+COLUMNS = ("ids", "doc_len", "topics", "difficulty", "skeleton_hash", "skeleton_id", "alive")
+
+
+class _GrowableColumn:
+    """Буфер колонки с запасом под новые строки.
+
+    Версии индекса делят буфер и видят только свои первые count строк,
+    поэтому новая версия дописывает строки за концом предыдущей без
+    копирования. Буфер копируется, только если место кончилось или за
+    концом этой версии уже дописала другая.
+    """
+
+    __slots__ = ("buffer", "used", "lock")
+
+    def __init__(self, buffer: np.ndarray, used: int):
+        self.buffer = buffer
+        self.used = used
+        self.lock = threading.Lock()
+
+    @classmethod
+    def extend(cls, column: Optional["_GrowableColumn"], current: np.ndarray, values: np.ndarray) -> Tuple["_GrowableColumn", np.ndarray]:
+        """Колонка и представление current + values"""
+        count, total = len(current), len(current) + len(values)
+        if column is not None:
+            with column.lock:
+                if column.used == count and total <= len(column.buffer):
+                    column.buffer[count:total] = values
+                    column.used = total
+                    return column, column.buffer[:total]
+        buffer = np.empty(max(total * 2, 1024), dtype=current.dtype)
+        buffer[:count] = current
+        buffer[count:total] = values
+        return cls(buffer, total), buffer[:total]
+
+
+class _LexicalState:
+    """Неизменяемая после публикации версия индекса.
+
+    Записи строят новую версию, разделяя с предыдущей непоменявшиеся
+    списки вхождений и буферы колонок, поэтому поиск идёт без блокировок.
+    """
+
+    def __init__(self):
+        self.ids = np.empty(0, dtype=np.int64)
+        self.doc_len = np.empty(0, dtype=np.int32)
+        self.topics = np.empty(0, dtype=np.int32)
+        self.difficulty = np.empty(0, dtype=np.int16)
+        self.skeleton_hash = np.empty(0, dtype="S32")
+        self.skeleton_id = np.empty(0, dtype=np.int64)
+        self.alive = np.empty(0, dtype=bool)
+        self.topic_names: List[str] = []
+        # term -> (номера документов uint32, частоты uint16)
+        self.postings: Dict[str, Tuple[array, array]] = {}
+        self.topic_codes: Dict[str, int] = {}
+        self.columns: Dict[str, _GrowableColumn] = {}
+        self.live_count = 0
+        self.live_length = 0
+        self.avg_len = 0.0
+
+    @property
+    def count(self) -> int:
+        return len(self.ids)
+
+    def finalize(self) -> "_LexicalState":
+        """Счётчики по всем строкам; после _apply они обновляются без полного прохода"""
+        self.topic_codes = {topic: code for code, topic in enumerate(self.topic_names)}
+        self.live_count = int(self.alive.sum())
+        self.live_length = int(self.doc_len[self.alive].sum())
+        self.avg_len = self.live_length / self.live_count if self.live_count else 0.0
+        return self
+
+
+class LexicalIndex:
+    """BM25 по тексту задач в процессе вместо Meilisearch.
+
+    Индексируются statement_text (уже после normalize_text), тема,
+    подтема, теги и навыки - те же поля, что ищет Meilisearch. Списки
+    вхождений хранятся в array('I')/array('H'), колонки документов - в
+    NumPy, фильтры по теме, сложности и id применяются к найденным
+    документам.
+
+    На диске индекс - снимок LEXICAL_INDEX_PATH плюс журнал
+    <path>.<epoch>.log, куда каждая запись дописывает свои документы
+    строками JSON; стоимость записи не зависит от размера индекса. Другие
+    процессы дочитывают журнал с того места, где остановились, и применяют
+    документы так же, как при записи. Когда в журнале больше
+    LEXICAL_LOG_MAX_DOCUMENTS документов или много заменённых, индекс
+    сохраняется новым снимком (без заменённых документов) со следующим
+    epoch, а старый журнал удаляется.
+    """
+
+    def __init__(self, path: Optional[str] = LEXICAL_INDEX_PATH):
+        self.path = path
+        self._state = _LexicalState()
+        self._loaded_mtime = None
+        self._epoch = 0
+        self._log_offset = 0
+        self._log_documents = 0
+        self._last_reload_check = 0.0
+        self._pending: Dict[int, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+        if self.path:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._reload(force=True)
+
+    # Загрузка и сохранение
+
+    def _mtime(self) -> Optional[int]:
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _reload(self, force: bool = False):
+        if not self.path:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_reload_check < LEXICAL_INDEX_RELOAD_INTERVAL:
+            return
+        self._last_reload_check = now
+
+        mtime = self._mtime()
+        if mtime is not None and mtime != self._loaded_mtime:
+            try:
+                self._state, self._epoch = self._load()
+                self._loaded_mtime = mtime
+                self._log_offset = self._log_documents = 0
+                logger.info(f"Loaded lexical index with {self._state.live_count} documents")
+            except Exception as e:
+                logger.warning(f"Could not load lexical index: {e}")
+                return
+        self._replay_log()
+
+    def _log_path(self, epoch: int) -> str:
+        return f"{self.path}.{epoch}.log"
+
+    def _replay_log(self):
+        """Применяет документы, дописанные в журнал после последнего чтения"""
+        try:
+            with open(self._log_path(self._epoch), "rb") as f:
+                f.seek(self._log_offset)
+                data = f.read()
+        except FileNotFoundError:
+            return
+        # Незаконченная строка может дописываться прямо сейчас, её читает следующая проверка
+        end = data.rfind(b"\n") + 1
+        if not end:
+            return
+        documents = []
+        for line in data[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                documents.append(json.loads(line))
+            except ValueError as e:
+                logger.warning(f"Skipping damaged lexical index log line: {e}")
+        if documents:
+            self._state = self._apply(self._state, documents)
+        self._log_offset += end
+        self._log_documents += len(documents)
+
+    def _load(self) -> Tuple[_LexicalState, int]:
+        state = _LexicalState()
+        with np.load(self.path, allow_pickle=False) as data:
+            for column in COLUMNS:
+                setattr(state, column, data[column])
+            state.topic_names = data["topic_names"].tolist()
+            offsets = data["offsets"]
+            rows, freqs = data["rows"], data["freqs"]
+            for position, term in enumerate(data["terms"].tolist()):
+                start, end = offsets[position], offsets[position + 1]
+                term_rows, term_freqs = array("I"), array("H")
+                term_rows.frombytes(rows[start:end].tobytes())
+                term_freqs.frombytes(freqs[start:end].tobytes())
+                state.postings[term] = (term_rows, term_freqs)
+            epoch = int(data["epoch"]) if "epoch" in data.files else 0
+        return state.finalize(), epoch
+
+    def _save(self, state: _LexicalState, epoch: int):
+        terms = list(state.postings)
+        lengths = np.fromiter((len(state.postings[term][0]) for term in terms), dtype=np.int64, count=len(terms))
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        rows = np.empty(int(offsets[-1]), dtype=np.uint32)
+        freqs = np.empty(int(offsets[-1]), dtype=np.uint16)
+        for position, term in enumerate(terms):
+            term_rows, term_freqs = state.postings[term]
+            rows[offsets[position]:offsets[position + 1]] = np.frombuffer(term_rows, dtype=np.uint32)
+            freqs[offsets[position]:offsets[position + 1]] = np.frombuffer(term_freqs, dtype=np.uint16)
+
+        tmp_path = f"{self.path}.{os.getpid()}.tmp.npz"
+        np.savez(
+            tmp_path,
+            ids=state.ids, doc_len=state.doc_len, topics=state.topics, difficulty=state.difficulty,
+            skeleton_hash=state.skeleton_hash, skeleton_id=state.skeleton_id, alive=state.alive,
+            topic_names=np.array(state.topic_names, dtype=str),
+            terms=np.array(terms, dtype=str), offsets=offsets, rows=rows, freqs=freqs,
+            epoch=np.array(epoch, dtype=np.int64)
+        )
+        os.replace(tmp_path, self.path)
+        self._loaded_mtime = self._mtime()
+
+        # Документы старого журнала уже в снимке
+        try:
+            os.remove(self._log_path(self._epoch))
+        except FileNotFoundError:
+            pass
+        self._epoch = epoch
+        self._log_offset = self._log_documents = 0
+
+    def _append_log(self, documents: List[Dict[str, Any]]):
+        data = "".join(
+            json.dumps(document, ensure_ascii=False, separators=(",", ":")) + "\n" for document in documents
+        ).encode("utf-8")
+        with open(self._log_path(self._epoch), "ab") as f:
+            if f.tell() != self._log_offset:
+                # Хвост от прерванной записи: новые строки начинаются с новой строки
+                data = b"\n" + data
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self._log_offset += len(data)
+        self._log_documents += len(documents)
+
+    # Запись
+
+    def add_documents(self, documents: Iterable[Dict[str, Any]], flush: bool = True):
+        """Добавляет или заменяет документы в формате документов Meilisearch.
+
+        С flush=False документы копятся в памяти до вызова flush.
+        """
+        with self._lock:
+            for document in documents:
+                self._pending[int(document["id"])] = document
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """Применяет накопленные документы и дописывает их в журнал"""
+        with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+
+        lock_file = open(f"{self.path}.lock", "w") if self.path else None
+        try:
+            # Запись сериализуется между процессами, каждый пишет поверх последней версии
+            if lock_file is not None and FCNTL_AVAILABLE:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self._reload(force=True)
+            documents = list(pending.values())
+            state = self._apply(self._state, documents)
+            many_dead = state.count and state.live_count < state.count * (1 - COMPACT_DEAD_RATIO)
+            if many_dead:
+                state = self._compact(state)
+            if self.path:
+                if many_dead or self._log_documents + len(documents) > LEXICAL_LOG_MAX_DOCUMENTS:
+                    self._save(state, self._epoch + 1)
+                else:
+                    self._append_log(documents)
+            self._state = state
+        except Exception:
+            with self._lock:
+                for task_id, document in pending.items():
+                    self._pending.setdefault(task_id, document)
+            raise
+        finally:
+            if lock_file is not None:
+                lock_file.close()
+
+    @staticmethod
+    def _document_text(document: Dict[str, Any]) -> str:
+        parts = [document.get("statement_text") or "", document.get("topic") or "", document.get("subtopic") or ""]
+        parts.extend(document.get("tags") or [])
+        parts.extend(document.get("skills") or [])
+        return " ".join(parts)
+
+    def _apply(self, base: _LexicalState, documents: List[Dict[str, Any]]) -> _LexicalState:
+        """Новая версия индекса с документами поверх base.
+
+        Стоимость зависит от числа документов, а не от размера base:
+        заменённые строки ищутся векторно по колонке ids, колонки
+        дописываются в общий буфер, счётчики обновляются на разницу.
+        """
+        # В журнале один id может встретиться несколько раз, действует последняя версия
+        documents = list({int(document["id"]): document for document in documents}.values())
+        new_ids = np.array([int(document["id"]) for document in documents], dtype=np.int64)
+
+        state = _LexicalState()
+        state.topic_names = list(base.topic_names)
+        topic_codes = dict(base.topic_codes)
+
+        first_row = base.count
+        new_postings: Dict[str, Tuple[List[int], List[int]]] = {}
+        doc_len, topics, difficulty, skeleton_hash, skeleton_id = [], [], [], [], []
+
+        for offset, document in enumerate(documents):
+            topic = document.get("topic") or ""
+            if topic not in topic_codes:
+                topic_codes[topic] = len(state.topic_names)
+                state.topic_names.append(topic)
+
+            tokens = tokenize(self._document_text(document))
+            frequencies: Dict[str, int] = {}
+            for token in tokens:
+                frequencies[token] = frequencies.get(token, 0) + 1
+            for token, frequency in frequencies.items():
+                term_rows, term_freqs = new_postings.setdefault(token, ([], []))
+                term_rows.append(first_row + offset)
+                term_freqs.append(min(frequency, 65535))
+
+            doc_len.append(len(tokens))
+            topics.append(topic_codes[topic])
+            difficulty.append(document.get("difficulty") or 0)
+            skeleton_hash.append((document.get("skeleton_hash") or "").encode("ascii"))
+            skeleton_id.append(-1 if document.get("skeleton_id") is None else document["skeleton_id"])
+
+        # Старая версия документа остаётся в списках вхождений, но больше не находится
+        replaced = np.flatnonzero(np.isin(base.ids, new_ids) & base.alive) if base.count else np.empty(0, dtype=np.int64)
+
+        new_columns = {
+            "ids": new_ids,
+            "doc_len": np.array(doc_len, dtype=np.int32),
+            "topics": np.array(topics, dtype=np.int32),
+            "difficulty": np.array(difficulty, dtype=np.int16),
+            "skeleton_hash": np.array(skeleton_hash, dtype="S32"),
+            "skeleton_id": np.array(skeleton_id, dtype=np.int64),
+            "alive": np.ones(len(documents), dtype=bool)
+        }
+        for name, values in new_columns.items():
+            current = getattr(base, name)
+            column = base.columns.get(name)
+            if name == "alive" and len(replaced):
+                # Прежняя версия должна и дальше находить заменённые документы
+                current, column = current.copy(), None
+                current[replaced] = False
+            state.columns[name], view = _GrowableColumn.extend(column, current, values)
+            setattr(state, name, view)
+
+        state.topic_codes = topic_codes
+        state.live_count = base.live_count - len(replaced) + len(documents)
+        state.live_length = base.live_length - int(base.doc_len[replaced].sum()) + int(new_columns["doc_len"].sum())
+        state.avg_len = state.live_length / state.live_count if state.live_count else 0.0
+
+        # Копируются только списки затронутых термов, остальные общие с base
+        state.postings = dict(base.postings)
+        for term, (term_rows, term_freqs) in new_postings.items():
+            old_rows, old_freqs = base.postings.get(term, (array("I"), array("H")))
+            rows, freqs = array("I", old_rows), array("H", old_freqs)
+            rows.extend(term_rows)
+            freqs.extend(term_freqs)
+            state.postings[term] = (rows, freqs)
+        return state
+
+    def _compact(self, state: _LexicalState) -> _LexicalState:
+        """Пересобирает индекс без заменённых документов"""
+        compacted = _LexicalState()
+        compacted.topic_names = state.topic_names
+        new_rows = np.cumsum(state.alive) - 1
+        for column in COLUMNS:
+            setattr(compacted, column, getattr(state, column)[state.alive])
+        for term, (term_rows, term_freqs) in state.postings.items():
+            rows = np.frombuffer(term_rows, dtype=np.uint32)
+            keep = state.alive[rows]
+            if keep.any():
+                compacted.postings[term] = (
+                    array("I", new_rows[rows[keep]].astype(np.uint32).tobytes()),
+                    array("H", np.frombuffer(term_freqs, dtype=np.uint16)[keep].tobytes())
+                )
+        logger.info(f"Compacted lexical index from {state.count} to {int(state.alive.sum())} documents")
+        return compacted.finalize()
+
+    # Поиск
+
+    def search(
+        self,
+        query: str,
+        limit: int = 20,
+        topic: Optional[str] = None,
+        difficulty_range: Optional[Tuple[int, int]] = None,
+        exclude_task_ids: Optional[Iterable[int]] = None
+    ) -> List[Dict[str, Any]]:
+        """Документы с наибольшим BM25.
+
+        Возвращает словари с id, bm25_score, нормированным на лучший
+        результат запроса (0..1], и исходным bm25 - как хиты Meilisearch
+        для RAGService._merge_results.
+        """
+        self._reload()
+        state = self._state
+        if not state.live_count or limit <= 0:
+            return []
+
+        matched_rows, matched_scores = [], []
+        for term in set(tokenize(query)):
+            posting = state.postings.get(term)
+            if posting is None:
+                continue
+            rows = np.frombuffer(posting[0], dtype=np.uint32)
+            frequencies = np.frombuffer(posting[1], dtype=np.uint16).astype(np.float32)
+            document_frequency = len(rows)
+            idf = math.log(1 + (state.live_count - document_frequency + 0.5) / (document_frequency + 0.5))
+            length_norm = 1 - BM25_B + BM25_B * state.doc_len[rows] / state.avg_len
+            matched_rows.append(rows)
+            matched_scores.append(idf * frequencies * (BM25_K1 + 1) / (frequencies + BM25_K1 * length_norm))
+        if not matched_rows:
+            return []
+
+        all_rows, all_scores = np.concatenate(matched_rows), np.concatenate(matched_scores)
+        if len(all_rows) > state.count // 16:
+            # Частые термы: плотный аккумулятор дешевле сортировки в np.unique
+            scores = np.bincount(all_rows, weights=all_scores, minlength=state.count)
+            rows = np.flatnonzero(scores)
+            scores = scores[rows]
+        else:
+            rows, inverse = np.unique(all_rows, return_inverse=True)
+            scores = np.bincount(inverse, weights=all_scores)
+
+        mask = state.alive[rows]
+        if topic:
+            code = state.topic_codes.get(topic)
+            if code is None:
+                return []
+            mask &= state.topics[rows] == code
+        if difficulty_range:
+            difficulties = state.difficulty[rows]
+            mask &= (difficulties >= difficulty_range[0]) & (difficulties <= difficulty_range[1])
+        if exclude_task_ids:
+            mask &= ~np.isin(state.ids[rows], np.fromiter(exclude_task_ids, dtype=np.int64))
+        rows, scores = rows[mask], scores[mask]
+        if not len(rows):
+            return []
+
+        if len(scores) > limit:
+            top = np.argpartition(-scores, limit - 1)[:limit]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+        best = float(scores[top[0]])
+
+        hits = []
+        for position in top:
+            row = int(rows[position])
+            skeleton_id = int(state.skeleton_id[row])
+            hits.append({
+                "id": int(state.ids[row]),
+                "bm25": float(scores[position]),
+                "bm25_score": float(scores[position]) / best if best > 0 else 0.0,
+                "topic": state.topic_names[int(state.topics[row])],
+                "difficulty": int(state.difficulty[row]),
+                "skeleton_hash": state.skeleton_hash[row].decode("ascii") or None,
+                "skeleton_id": skeleton_id if skeleton_id >= 0 else None
+            })
+        return hits
+
+    def search_batch(self, requests: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+        """Поиск по запросам в формате RAGService.hybrid_search_batch"""
+        return [
+            self.search(
+                request["query"], request.get("limit", 20), request.get("topic"),
+                request.get("difficulty_range"), request.get("exclude_task_ids")
+            )
+            for request in requests
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        state = self._state
+        return {
+            "backend": "local",
+            "documents": state.live_count,
+            "terms": len(state.postings),
+            "avg_document_length": round(state.avg_len, 2),
+            "stemmer": "snowball" if _stemmer is not None else "suffix",
+            "log_documents": self._log_documents,
+            "pending": len(self._pending)
+        }
+
+
+def get_lexical_index() -> Optional[LexicalIndex]:
+    """Общий для процесса BM25-индекс; None, если используется Meilisearch"""
+    global _index
+    if LEXICAL_BACKEND != "local":
+        return None
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = LexicalIndex()
+    return _index
@@ -1,65 +1,212 @@
 import httpx
 import os
+import shutil
+import logging
 import tempfile
-from typing import Dict, Any
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional, Tuple
+
+from shared.pdf_cache import PDFCache, pdf_cache_key
+
+from ..drivers.http_clients import create_client
+from .artifact_store import get_artifact_store, pdf_artifact_key
+
+logger = logging.getLogger(__name__)
+
+_http_client: Optional[httpx.Client] = None
+_http_client_lock = threading.Lock()
+
+# Когда PDF-сервис последний раз ответил, что /generate-bundle не существует;
+# после PDF_BUNDLE_RETRY_INTERVAL секунд эндпоинт пробуется снова
+_bundle_endpoint_missing_since: Optional[float] = None
+PDF_BUNDLE_RETRY_INTERVAL = float(os.getenv("PDF_BUNDLE_RETRY_INTERVAL", "300"))
+
+# Потоки для параллельной генерации версий ученика и учителя
+_render_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("PDF_RENDER_THREADS", "4")),
+    thread_name_prefix="pdf-render"
+)
+
+# Повторы при 429 от PDF-сервиса (очередь рендера заполнена)
+PDF_SERVICE_MAX_RETRIES = int(os.getenv("PDF_SERVICE_MAX_RETRIES", "3"))
+PDF_SERVICE_MAX_RETRY_AFTER = float(os.getenv("PDF_SERVICE_MAX_RETRY_AFTER", "10"))
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+PDF_CACHE_DIR = os.getenv("PDF_CACHE_DIR", "/app/data/cache/pdf")
+PDF_CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+# Пустой PDF_CACHE_DIR отключает кэш
+pdf_cache: Optional[PDFCache] = PDFCache(PDF_CACHE_DIR, PDF_CACHE_MAX_BYTES) if PDF_CACHE_DIR else None
+
+def bundle_endpoint_enabled() -> bool:
+    """Пробовать ли /generate-bundle: эндпоинт мог появиться после обновления PDF-сервиса"""
+    missing_since = _bundle_endpoint_missing_since
+    return missing_since is None or time.monotonic() - missing_since >= PDF_BUNDLE_RETRY_INTERVAL
+
+def get_pdf_http_client() -> httpx.Client:
+    """Общий для процесса HTTP-клиент к PDF-сервису"""
+    global _http_client
+    if _http_client is None:
+        with _http_client_lock:
+            if _http_client is None:
+                _http_client = create_client(timeout=30.0)
+    return _http_client
+
+def close_pdf_http_client():
+    global _http_client
+    if _http_client is not None:
+        _http_client.close()
+        _http_client = None
 
 class PDFService:
     def __init__(self):
         self.pdf_service_url = os.getenv("PDF_SERVICE_URL", "http://localhost:8001")
     
-    def generate_student_pdf(self, data: Dict[str, Any]) -> str:
+    def _post_to_file(self, path: str, payload: Dict[str, Any], timeout: float, target_path: str) -> int:
+        """POST к PDF-сервису с записью тела ответа в файл по частям.
+
+        При 429 ждёт Retry-After и повторяет запрос. Возвращает код ответа;
+        файл записывается только при 200.
+        """
+        client = get_pdf_http_client()
+        for attempt in range(PDF_SERVICE_MAX_RETRIES + 1):
+            with client.stream("POST", f"{self.pdf_service_url}{path}", json=payload, timeout=timeout) as response:
+                if response.status_code != 429 or attempt == PDF_SERVICE_MAX_RETRIES:
+                    if response.status_code == 200:
+                        with open(target_path, "wb") as f:
+                            for chunk in response.iter_bytes(STREAM_CHUNK_SIZE):
+                                f.write(chunk)
+                        cpu_time = response.headers.get("X-Render-CPU-Time")
+                        if cpu_time:
+                            logger.info(f"PDF service rendered {path} in {cpu_time}s of CPU time")
+                    return response.status_code
+                try:
+                    delay = float(response.headers.get("Retry-After", "1"))
+                except ValueError:
+                    delay = 1.0
+            delay = min(max(delay, 0.0), PDF_SERVICE_MAX_RETRY_AFTER)
+            logger.info(f"PDF service is busy, retrying {path} in {delay:.1f}s")
+            time.sleep(delay)
+    
+    def _pdf_path(self, data: Dict[str, Any], pdf_type: str) -> str:
+        assignment_id = data.get("assignment_id", "unknown")
+        filename = f"assignment_{assignment_id}_{pdf_type}.pdf"
+        return os.path.join(tempfile.gettempdir(), filename)
+    
+    def _from_cache(self, data: Dict[str, Any], pdf_type: str, renderer: str = "service") -> Optional[str]:
+        """Копирует PDF из кэша по месту назначения, если он там есть"""
+        if pdf_cache is None:
+            return None
+        filepath = self._pdf_path(data, pdf_type)
+        if pdf_cache.copy_to(pdf_cache_key(data, pdf_type, renderer), filepath):
+            return filepath
+        return None
+    
+    def _store_in_cache(self, data: Dict[str, Any], pdf_type: str, filepath: str, renderer: str = "service"):
+        if pdf_cache is not None:
+            pdf_cache.put_file(pdf_cache_key(data, pdf_type, renderer), filepath)
+    
+    def _generate_pdf(self, data: Dict[str, Any], pdf_type: str) -> str:
+        cached = self._from_cache(data, pdf_type)
+        if cached:
+            return cached
+        
         try:
-            with httpx.Client() as client:
-                response = client.post(
-                    f"{self.pdf_service_url}/generate",
-                    json={
-                        "type": "student",
-                        "data": data
-                    },
-                    timeout=30.0
-                )
-                
-                if response.status_code == 200:
-                    assignment_id = data.get("assignment_id", "unknown")
-                    filename = f"assignment_{assignment_id}_student.pdf"
-                    filepath = os.path.join(tempfile.gettempdir(), filename)
-                    
-                    with open(filepath, "wb") as f:
-                        f.write(response.content)
-                    
-                    return filepath
-                else:
-                    raise Exception(f"PDF service error: {response.status_code}")
+            filepath = self._pdf_path(data, pdf_type)
+            status_code = self._post_to_file(
+                "/generate",
+                {
+                    "type": pdf_type,
+                    "data": data
+                },
+                timeout=30.0,
+                target_path=filepath
+            )
+            
+            if status_code == 200:
+                self._store_in_cache(data, pdf_type, filepath)
+                return filepath
+            else:
+                raise Exception(f"PDF service error: {status_code}")
         
         except Exception as e:
-            return self._generate_fallback_pdf(data, "student")
+            return self._generate_fallback_pdf(data, pdf_type)
+    
+    def generate_student_pdf(self, data: Dict[str, Any]) -> str:
+        return self._generate_pdf(data, "student")
     
     def generate_teacher_pdf(self, data: Dict[str, Any]) -> str:
+        return self._generate_pdf(data, "teacher")
+    
+    def _generate_bundle(self, data: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+        """Обе версии одним запросом к /generate-bundle.
+
+        Возвращает None, если у PDF-сервиса нет этого эндпоинта.
+        """
+        global _bundle_endpoint_missing_since
+        
+        bundle_path = self._pdf_path(data, "bundle") + ".zip"
+        status_code = self._post_to_file("/generate-bundle", {"data": data}, timeout=60.0, target_path=bundle_path)
+        
+        if status_code in (404, 405):
+            logger.info("PDF service has no /generate-bundle endpoint, rendering versions separately")
+            _bundle_endpoint_missing_since = time.monotonic()
+            return None
+        if status_code != 200:
+            raise Exception(f"PDF service error: {status_code}")
+        _bundle_endpoint_missing_since = None
+        
+        paths = []
         try:
-            with httpx.Client() as client:
-                response = client.post(
-                    f"{self.pdf_service_url}/generate",
-                    json={
-                        "type": "teacher",
-                        "data": data
-                    },
-                    timeout=30.0
-                )
-                
-                if response.status_code == 200:
-                    assignment_id = data.get("assignment_id", "unknown")
-                    filename = f"assignment_{assignment_id}_teacher.pdf"
-                    filepath = os.path.join(tempfile.gettempdir(), filename)
-                    
-                    with open(filepath, "wb") as f:
-                        f.write(response.content)
-                    
-                    return filepath
-                else:
-                    raise Exception(f"PDF service error: {response.status_code}")
+            with zipfile.ZipFile(bundle_path) as archive:
+                for pdf_type in ("student", "teacher"):
+                    filepath = self._pdf_path(data, pdf_type)
+                    with archive.open(f"{pdf_type}.pdf") as src, open(filepath, "wb") as dst:
+                        shutil.copyfileobj(src, dst, STREAM_CHUNK_SIZE)
+                    self._store_in_cache(data, pdf_type, filepath)
+                    paths.append(filepath)
+        finally:
+            os.remove(bundle_path)
+        return paths[0], paths[1]
+    
+    def generate_pdfs(self, data: Dict[str, Any]) -> Tuple[str, str]:
+        """PDF ученика и учителя: одним запросом, если PDF-сервис это
+        поддерживает, иначе двумя параллельными запросами."""
+        student_path = self._from_cache(data, "student")
+        teacher_path = self._from_cache(data, "teacher")
+        if student_path and teacher_path:
+            return student_path, teacher_path
         
-        except Exception as e:
-            return self._generate_fallback_pdf(data, "teacher")
+        if bundle_endpoint_enabled():
+            try:
+                paths = self._generate_bundle(data)
+                if paths:
+                    return paths
+            except Exception as e:
+                logger.warning(f"PDF bundle generation failed, rendering versions separately: {e}")
+        
+        student_future = _render_executor.submit(self.generate_student_pdf, data)
+        teacher_future = _render_executor.submit(self.generate_teacher_pdf, data)
+        return student_future.result(), teacher_future.result()
+    
+    def generate_pdf_artifacts(self, data: Dict[str, Any]) -> Tuple[str, str]:
+        """Генерирует обе версии и сохраняет их в хранилище артефактов.
+
+        Возвращает ключи, которые записываются в Assignment.
+        """
+        store = get_artifact_store()
+        keys = []
+        for pdf_type, filepath in zip(("student", "teacher"), self.generate_pdfs(data)):
+            keys.append(store.put_file(pdf_artifact_key(data.get("assignment_id", "unknown"), pdf_type), filepath))
+            try:
+                os.remove(filepath)
+            except OSError:
+                pass
+        return keys[0], keys[1]
     
     def _generate_fallback_pdf(self, data: Dict[str, Any], pdf_type: str) -> str:
         from reportlab.pdfgen import canvas
@@ -72,6 +219,10 @@ class PDFService:
         filename = f"assignment_{assignment_id}_{pdf_type}.pdf"
         filepath = os.path.join(tempfile.gettempdir(), filename)
         
+        cached = self._from_cache(data, pdf_type, renderer="fallback")
+        if cached:
+            return cached
+        
         c = canvas.Canvas(filepath, pagesize=A4)
         width, height = A4
         
@@ -101,4 +252,5 @@ class PDFService:
                 y_position -= 20
         
         c.save()
+        self._store_in_cache(data, pdf_type, filepath, renderer="fallback")
         return filepath
@@ -1,12 +1,23 @@
 import os
+import asyncio
 import numpy as np
-from typing import List, Dict, Any, Optional, Tuple
-from qdrant_client import QdrantClient
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import List, Dict, Any, Optional, Tuple, Iterable
+from qdrant_client import QdrantClient, AsyncQdrantClient
 from qdrant_client.http import models
 import meilisearch
+import httpx
 import logging
 import hashlib
 import re
+import threading
+import time
+
+from .utils import chunked
+from .embedding_cache import EmbeddingCache
+from .vector_index import LocalVectorIndex, get_vector_index
+from .lexical_index import LexicalIndex, get_lexical_index
+from ..drivers.http_clients import create_async_client
 
 try:
     from sentence_transformers import SentenceTransformer
@@ -16,26 +27,140 @@ except ImportError:
 
 logger = logging.getLogger(__name__)
 
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "paraphrase-multilingual-MiniLM-L12-v2")
+RAG_HEALTH_CHECK_INTERVAL = float(os.getenv("RAG_HEALTH_CHECK_INTERVAL", "30"))
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "4096"))
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "/app/data/cache/query_embeddings.npy")
+RAG_VECTOR_TIMEOUT = float(os.getenv("RAG_VECTOR_TIMEOUT", "2.0"))
+RAG_BM25_TIMEOUT = float(os.getenv("RAG_BM25_TIMEOUT", "2.0"))
+
+# Потоки на каждую часть гибридного поиска (векторную и BM25)
+RAG_SEARCH_THREADS = int(os.getenv("RAG_SEARCH_THREADS", "4"))
+
+
+class _LegExecutor:
+    """Пул потоков одной части гибридного поиска.
+
+    Вызов, не уложившийся в таймаут, продолжает занимать поток до ответа
+    клиента. Такие вызовы считаются, и когда ими занят весь пул, новые
+    сразу получают отказ, а не ждут в очереди за зависшими. Пулы частей
+    раздельные, поэтому зависший Qdrant не задерживает BM25 и наоборот.
+    """
+
+    def __init__(self, name: str, max_workers: int):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._abandoned = 0
+        self._lock = threading.Lock()
+
+    def submit(self, call) -> Optional[Future]:
+        """None, если все потоки заняты вызовами, которые уже не ждут"""
+        with self._lock:
+            if self._abandoned >= self.max_workers:
+                return None
+        return self._executor.submit(call)
+
+    def abandon(self, future: Future):
+        """Учитывает future, чей результат больше не нужен, до его завершения"""
+        with self._lock:
+            self._abandoned += 1
+        future.add_done_callback(self._release)
+
+    def _release(self, future: Future):
+        with self._lock:
+            self._abandoned -= 1
+
+
+_leg_executors = {
+    "vector": _LegExecutor("hybrid-vector", RAG_SEARCH_THREADS),
+    "bm25": _LegExecutor("hybrid-bm25", RAG_SEARCH_THREADS),
+}
+
+_embedding_model = None
+_embedding_model_lock = threading.Lock()
+
+_rag_service: Optional["RAGService"] = None
+_rag_service_lock = threading.Lock()
+
+
+def load_embedding_model():
+    """Загружает модель эмбеддингов один раз на процесс"""
+    global _embedding_model
+    if _embedding_model is None and SENTENCE_TRANSFORMERS_AVAILABLE:
+        with _embedding_model_lock:
+            if _embedding_model is None:
+                try:
+                    _embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+                    logger.info("Sentence transformer model loaded")
+                except Exception as e:
+                    logger.warning(f"Could not load embedding model: {e}")
+    return _embedding_model
+
+
+def get_rag_service() -> "RAGService":
+    """Общий для процесса экземпляр RAGService"""
+    global _rag_service
+    if _rag_service is None:
+        with _rag_service_lock:
+            if _rag_service is None:
+                _rag_service = RAGService()
+    _rag_service.ensure_available()
+    return _rag_service
+
+
+def flush_rag_caches():
+    if _rag_service is not None and _rag_service.query_cache is not None:
+        _rag_service.query_cache.flush()
+
+
+async def close_rag_service():
+    if _rag_service is not None:
+        flush_rag_caches()
+        await _rag_service.aclose()
+
+
 class RAGService:
     def __init__(self):
         self.qdrant_url = os.getenv("QDRANT_URL", "http://localhost:6333")
         self.meili_url = os.getenv("MEILI_URL", "http://localhost:7700")
         self.meili_key = os.getenv("MEILI_MASTER_KEY", "A0TtmeQyFUGBM3We9fbThjuaT3Zq8U72FQh6AO3F2-s")
+        self.collection_name = "tasks"
+        self.index_name = "tasks"
         
-        # Инициализация модели эмбеддингов
-        self.embedding_model = None
-        if SENTENCE_TRANSFORMERS_AVAILABLE:
-            try:
-                self.embedding_model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
-                logger.info("Sentence transformer model loaded")
-            except Exception as e:
-                logger.warning(f"Could not load embedding model: {e}")
+        # Модель эмбеддингов общая для всех экземпляров в процессе
+        self.embedding_model = load_embedding_model()
+        self.query_cache: Optional[EmbeddingCache] = None
+        if self.embedding_model:
+            self.query_cache = EmbeddingCache(
+                model_name=EMBEDDING_MODEL_NAME,
+                dim=self.embedding_model.get_sentence_embedding_dimension(),
+                capacity=EMBEDDING_CACHE_SIZE,
+                path=EMBEDDING_CACHE_PATH or None
+            )
+        
+        self._async_qdrant_client: Optional[AsyncQdrantClient] = None
+        self._async_meili_client: Optional[httpx.AsyncClient] = None
+        # При VECTOR_BACKEND=local векторная часть поиска выполняется в процессе, без Qdrant
+        self.vector_index: Optional[LocalVectorIndex] = None
+        # При LEXICAL_BACKEND=local BM25-часть поиска выполняется в процессе, без Meilisearch
+        self.lexical_index: Optional[LexicalIndex] = None
         
+        self.available = False
+        self._last_health_check = 0.0
+        self._health_lock = threading.Lock()
+        self._connect()
+    
+    def _connect(self):
+        self._last_health_check = time.monotonic()
         try:
-            self.qdrant_client = QdrantClient(url=self.qdrant_url)
-            self.meili_client = meilisearch.Client(self.meili_url, self.meili_key)
-            self.collection_name = "tasks"
-            self.index_name = "tasks"
+            self.vector_index = get_vector_index()
+            if self.vector_index is None:
+                self.qdrant_client = QdrantClient(url=self.qdrant_url)
+            self.lexical_index = get_lexical_index()
+            if self.lexical_index is None:
+                self.meili_client = meilisearch.Client(self.meili_url, self.meili_key)
+            if not self.check_health():
+                raise RuntimeError("Qdrant/Meilisearch health check failed")
             self._ensure_collections()
             self.available = True
             logger.info("RAG Service initialized successfully")
@@ -43,22 +168,52 @@ class RAGService:
             logger.warning(f"RAG Service not available: {e}")
             self.available = False
     
-    def _ensure_collections(self):
+    def check_health(self) -> bool:
         try:
-            collections = self.qdrant_client.get_collections().collections
-            collection_names = [c.name for c in collections]
-            
-            if self.collection_name not in collection_names:
-                self.qdrant_client.create_collection(
-                    collection_name=self.collection_name,
-                    vectors_config=models.VectorParams(
-                        size=384,
-                        distance=models.Distance.COSINE
-                    )
-                )
-                logger.info(f"Created Qdrant collection: {self.collection_name}")
+            if self.vector_index is None:
+                self.qdrant_client.get_collections()
+            if self.lexical_index is None and not self.meili_client.is_healthy():
+                raise RuntimeError("Meilisearch is not healthy")
+            return True
         except Exception as e:
-            logger.error(f"Error creating Qdrant collection: {e}")
+            logger.warning(f"RAG health check failed: {e}")
+            return False
+    
+    def ensure_available(self) -> bool:
+        """Проверяет бэкенды не чаще раза в RAG_HEALTH_CHECK_INTERVAL секунд
+        и переподключается к ним, если они стали недоступны."""
+        if time.monotonic() - self._last_health_check < RAG_HEALTH_CHECK_INTERVAL:
+            return self.available
+        with self._health_lock:
+            if time.monotonic() - self._last_health_check < RAG_HEALTH_CHECK_INTERVAL:
+                return self.available
+            self._last_health_check = time.monotonic()
+            if self.available:
+                self.available = self.check_health()
+            if not self.available:
+                self._connect()
+        return self.available
+    
+    def _ensure_collections(self):
+        if self.vector_index is None:
+            try:
+                collections = self.qdrant_client.get_collections().collections
+                collection_names = [c.name for c in collections]
+                
+                if self.collection_name not in collection_names:
+                    self.qdrant_client.create_collection(
+                        collection_name=self.collection_name,
+                        vectors_config=models.VectorParams(
+                            size=384,
+                            distance=models.Distance.COSINE
+                        )
+                    )
+                    logger.info(f"Created Qdrant collection: {self.collection_name}")
+            except Exception as e:
+                logger.error(f"Error creating Qdrant collection: {e}")
+        
+        if self.lexical_index is not None:
+            return
         
         try:
             try:
@@ -71,9 +226,12 @@ class RAGService:
                 index.update_searchable_attributes([
                     'statement_text', 'topic', 'subtopic', 'tags', 'skills'
                 ])
-                index.update_filterable_attributes([
-                    'topic', 'subtopic', 'difficulty', 'format', 'tags'
-                ])
+            
+            # id фильтруемый, чтобы исключать уже выданные ученику задачи
+            index = self.meili_client.index(self.index_name)
+            filterable = ['topic', 'subtopic', 'difficulty', 'format', 'tags', 'id']
+            if set(index.get_filterable_attributes() or []) != set(filterable):
+                index.update_filterable_attributes(filterable)
         except Exception as e:
             logger.error(f"Error creating Meilisearch index: {e}")
     
@@ -91,53 +249,60 @@ class RAGService:
     def compute_skeleton_hash(self, skeleton: str) -> str:
         return hashlib.md5(skeleton.encode('utf-8')).hexdigest()
     
+    def _encode_texts(self, texts: List[str], batch_size: int = 64) -> List[List[float]]:
+        if self.embedding_model:
+            return self.embedding_model.encode(texts, batch_size=batch_size).tolist()
+        return np.random.rand(len(texts), 384).tolist()
+    
+    def _build_documents(
+        self, task_data: Dict[str, Any], normalized_text: str, embedding: List[float]
+    ) -> Tuple[models.PointStruct, Dict[str, Any]]:
+        skeleton = self.extract_skeleton(normalized_text)
+        skeleton_hash = self.compute_skeleton_hash(skeleton)
+        
+        point = models.PointStruct(
+            id=task_data['id'],
+            vector=embedding,
+            payload={
+                "task_id": task_data['id'],
+                "topic": task_data['topic'],
+                "subtopic": task_data.get('subtopic', ''),
+                "difficulty": task_data['difficulty'],
+                "skeleton_hash": skeleton_hash,
+                "skeleton_id": task_data.get('skeleton_id')
+            }
+        )
+        meili_doc = {
+            "id": task_data['id'],
+            "statement_text": normalized_text,
+            "topic": task_data['topic'],
+            "subtopic": task_data.get('subtopic', ''),
+            "difficulty": task_data['difficulty'],
+            "tags": task_data.get('tags', []),
+            "skills": task_data.get('skills', []),
+            "skeleton_hash": skeleton_hash,
+            "skeleton_id": task_data.get('skeleton_id')
+        }
+        return point, meili_doc
+    
     def index_task(self, task_data: Dict[str, Any]):
         if not self.available:
             return False
             
         try:
             normalized_text = self.normalize_text(task_data['statement_text'])
-            skeleton = self.extract_skeleton(normalized_text)
-            skeleton_hash = self.compute_skeleton_hash(skeleton)
+            embedding = self._encode_texts([normalized_text])[0]
+            point, meili_doc = self._build_documents(task_data, normalized_text, embedding)
             
-            # Генерация эмбеддинга
-            if self.embedding_model:
-                embedding = self.embedding_model.encode(normalized_text).tolist()
-            else:
-                embedding = np.random.rand(384).tolist()
-            
-            # Индексация в Qdrant
-            self.qdrant_client.upsert(
-                collection_name=self.collection_name,
-                points=[
-                    models.PointStruct(
-                        id=task_data['id'],
-                        vector=embedding,
-                        payload={
-                            "task_id": task_data['id'],
-                            "topic": task_data['topic'],
-                            "subtopic": task_data.get('subtopic', ''),
-                            "difficulty": task_data['difficulty'],
-                            "skeleton_hash": skeleton_hash
-                        }
-                    )
-                ]
-            )
-            
-            # Индексация в Meilisearch
-            meili_doc = {
-                "id": task_data['id'],
-                "statement_text": normalized_text,
-                "topic": task_data['topic'],
-                "subtopic": task_data.get('subtopic', ''),
-                "difficulty": task_data['difficulty'],
-                "tags": task_data.get('tags', []),
-                "skills": task_data.get('skills', []),
-                "skeleton_hash": skeleton_hash
-            }
+            # Индексация в Qdrant или локальный индекс
+            self._upsert_vectors([point])
             
-            index = self.meili_client.index(self.index_name)
-            index.add_documents([meili_doc])
+            # Индексация в Meilisearch или локальный BM25
+            if self.lexical_index is not None:
+                self.lexical_index.add_documents([meili_doc])
+            else:
+                index = self.meili_client.index(self.index_name)
+                index.add_documents([meili_doc])
             
             logger.info(f"Indexed task {task_data['id']} successfully")
             return True
@@ -146,125 +311,575 @@ class RAGService:
             logger.error(f"Error indexing task {task_data['id']}: {e}")
             return False
     
+    def index_tasks_bulk(
+        self,
+        tasks: Iterable[Dict[str, Any]],
+        batch_size: int = 256,
+        meili_batch_size: int = 5000,
+        wait: bool = True
+    ) -> Dict[str, Any]:
+        """Пакетная индексация задач.
+
+        Эмбеддинги считаются одним вызовом модели на батч, точки Qdrant
+        отправляются батчами, а документы Meilisearch копятся до
+        meili_batch_size и отправляются без ожидания. С wait=True Qdrant
+        применяет каждый батч до ответа, а задачи Meilisearch проверяются в
+        конце, так что после возврата все задачи из indexed видны в поиске.
+        Задачи, документы которых Meilisearch не принял, считаются в failed.
+        """
+        stats = {"indexed": 0, "failed": 0, "batches": [], "meili_task_uids": [], "meili_errors": 0}
+        if not self.available:
+            return stats
+        
+        index = self.meili_client.index(self.index_name) if self.lexical_index is None else None
+        pending_docs: List[Dict[str, Any]] = []
+        # UID задачи Meilisearch -> сколько документов в ней отправлено
+        meili_task_sizes: Dict[int, int] = {}
+        
+        def fail_documents(count: int):
+            stats["indexed"] -= count
+            stats["failed"] += count
+        
+        def flush_meili():
+            if not pending_docs:
+                return
+            if self.lexical_index is not None:
+                # Локальный BM25 сохраняется один раз в конце импорта
+                self.lexical_index.add_documents(pending_docs, flush=False)
+                pending_docs.clear()
+                return
+            try:
+                task_info = index.add_documents(pending_docs)
+                stats["meili_task_uids"].append(task_info.task_uid)
+                meili_task_sizes[task_info.task_uid] = len(pending_docs)
+            except Exception as e:
+                logger.error(f"Error sending {len(pending_docs)} documents to Meilisearch: {e}")
+                stats["meili_errors"] += 1
+                fail_documents(len(pending_docs))
+            pending_docs.clear()
+        
+        for batch in chunked(tasks, batch_size):
+            started = time.perf_counter()
+            try:
+                texts = [self.normalize_text(task['statement_text']) for task in batch]
+                embeddings = self._encode_texts(texts, batch_size=batch_size)
+                points, meili_docs = [], []
+                for task_data, text, embedding in zip(batch, texts, embeddings):
+                    point, meili_doc = self._build_documents(task_data, text, embedding)
+                    points.append(point)
+                    meili_docs.append(meili_doc)
+                
+                # Локальный индекс записывается один раз после цикла
+                self._upsert_vectors(points, wait=wait and self.vector_index is None)
+                pending_docs.extend(meili_docs)
+                stats["indexed"] += len(batch)
+            except Exception as e:
+                logger.error(f"Error indexing batch of {len(batch)} tasks: {e}")
+                stats["failed"] += len(batch)
+                continue
+            
+            if len(pending_docs) >= meili_batch_size:
+                flush_meili()
+            
+            elapsed = time.perf_counter() - started
+            batch_stats = {
+                "size": len(batch),
+                "seconds": round(elapsed, 3),
+                "tasks_per_sec": round(len(batch) / elapsed, 1) if elapsed > 0 else None
+            }
+            stats["batches"].append(batch_stats)
+            logger.info(
+                f"Indexed batch of {batch_stats['size']} tasks in {batch_stats['seconds']}s "
+                f"({batch_stats['tasks_per_sec']} tasks/s)"
+            )
+        
+        flush_meili()
+        
+        if self.vector_index is not None:
+            # Остаток точек записывается в локальный индекс одним сегментом
+            try:
+                self.vector_index.flush()
+            except Exception as e:
+                logger.error(f"Error writing local vector index: {e}")
+                stats["failed"] += stats["indexed"]
+                stats["indexed"] = 0
+        
+        if self.lexical_index is not None:
+            try:
+                self.lexical_index.flush()
+            except Exception as e:
+                logger.error(f"Error writing local lexical index: {e}")
+                stats["meili_errors"] += 1
+                fail_documents(stats["indexed"])
+        
+        if wait:
+            for task_uid in stats["meili_task_uids"]:
+                try:
+                    task = self.meili_client.wait_for_task(task_uid, timeout_in_ms=60000)
+                    if task.status != "succeeded":
+                        logger.error(f"Meilisearch task {task_uid} finished with status {task.status}")
+                        stats["meili_errors"] += 1
+                        fail_documents(meili_task_sizes[task_uid])
+                except Exception as e:
+                    logger.error(f"Error waiting for Meilisearch task {task_uid}: {e}")
+                    stats["meili_errors"] += 1
+                    fail_documents(meili_task_sizes[task_uid])
+        
+        return stats
+    
+    def _upsert_vectors(self, points: List[models.PointStruct], wait: bool = True):
+        """Записывает точки в Qdrant или в локальный индекс.
+
+        Локальный индекс с wait=False накапливает точки (не больше
+        VECTOR_INDEX_FLUSH_ROWS), остаток записывается вызовом
+        self.vector_index.flush().
+        """
+        if self.vector_index is not None:
+            self.vector_index.upsert(
+                ({"id": point.id, "vector": point.vector, "payload": point.payload} for point in points),
+                flush=wait
+            )
+        else:
+            self.qdrant_client.upsert(
+                collection_name=self.collection_name,
+                points=points,
+                wait=wait
+            )
+    
+    def _encode_query(self, query: str) -> List[float]:
+        if not self.embedding_model:
+            return np.random.rand(384).tolist()
+        
+        embedding = self.query_cache.get(query)
+        if embedding is None:
+            embedding = self.embedding_model.encode(query).tolist()
+            self.query_cache.put(query, embedding)
+        return embedding
+    
+    def _build_filters(
+        self,
+        topic: Optional[str],
+        difficulty_range: Optional[Tuple[int, int]],
+        exclude_task_ids: Optional[Iterable[int]] = None
+    ) -> Tuple[Optional[models.Filter], Optional[str]]:
+        exclude_task_ids = sorted(exclude_task_ids) if exclude_task_ids else []
+        
+        qdrant_filter = models.Filter(must=[], must_not=[])
+        if topic:
+            qdrant_filter.must.append(
+                models.FieldCondition(key="topic", match=models.MatchValue(value=topic))
+            )
+        if difficulty_range:
+            qdrant_filter.must.append(
+                models.FieldCondition(
+                    key="difficulty",
+                    range=models.Range(gte=difficulty_range[0], lte=difficulty_range[1])
+                )
+            )
+        if exclude_task_ids:
+            # id точки в Qdrant совпадает с id задачи
+            qdrant_filter.must_not.append(models.HasIdCondition(has_id=exclude_task_ids))
+        
+        meili_filter = []
+        if topic:
+            meili_filter.append(f"topic = '{topic}'")
+        if difficulty_range:
+            meili_filter.append(f"difficulty >= {difficulty_range[0]} AND difficulty <= {difficulty_range[1]}")
+        if exclude_task_ids:
+            meili_filter.append(f"id NOT IN [{', '.join(map(str, exclude_task_ids))}]")
+        
+        return (
+            qdrant_filter if qdrant_filter.must or qdrant_filter.must_not else None,
+            " AND ".join(meili_filter) if meili_filter else None
+        )
+    
+    def _merge_results(
+        self,
+        vector_results: List[Any],
+        bm25_hits: List[Dict[str, Any]],
+        limit: int
+    ) -> List[Dict[str, Any]]:
+        # Комбинирование результатов (60% векторы + 40% BM25)
+        combined_scores = {}
+        
+        for result in vector_results:
+            task_id = result.payload["task_id"]
+            combined_scores[task_id] = {
+                "task_id": task_id,
+                "vector_score": result.score,
+                "bm25_score": 0.0,
+                "combined_score": result.score * 0.6,
+                "skeleton_hash": result.payload.get("skeleton_hash"),
+                "skeleton_id": result.payload.get("skeleton_id")
+            }
+        
+        for result in bm25_hits:
+            task_id = result["id"]
+            # Локальный BM25 отдаёт уже нормированный скор
+            if "bm25_score" in result:
+                bm25_score = result["bm25_score"]
+            else:
+                bm25_score = 1.0 / (1.0 + result.get("_rankingScore", 1000))
+            
+            if task_id in combined_scores:
+                combined_scores[task_id]["bm25_score"] = bm25_score
+                combined_scores[task_id]["combined_score"] = (
+                    combined_scores[task_id]["vector_score"] * 0.6 + bm25_score * 0.4
+                )
+            else:
+                combined_scores[task_id] = {
+                    "task_id": task_id,
+                    "vector_score": 0.0,
+                    "bm25_score": bm25_score,
+                    "combined_score": bm25_score * 0.4,
+                    "skeleton_hash": result.get("skeleton_hash"),
+                    "skeleton_id": result.get("skeleton_id")
+                }
+        
+        # Сортировка по итоговому скору
+        sorted_results = sorted(
+            combined_scores.values(),
+            key=lambda x: x["combined_score"],
+            reverse=True
+        )
+        
+        return sorted_results[:limit]
+    
+    def _vector_search(
+        self,
+        query_embedding: List[float],
+        qdrant_filter: Optional[models.Filter],
+        limit: int,
+        request: Optional[Dict[str, Any]] = None
+    ) -> List[Any]:
+        """request - исходные topic, difficulty_range и exclude_task_ids для локального индекса"""
+        if self.vector_index is not None:
+            return self.vector_index.search_batch([query_embedding], [dict(request or {}, limit=limit)])[0]
+        return self.qdrant_client.search(
+            collection_name=self.collection_name,
+            query_vector=query_embedding,
+            query_filter=qdrant_filter,
+            limit=limit
+        )
+    
+    def _bm25_search(
+        self,
+        query: str,
+        meili_filter: Optional[str],
+        limit: int,
+        request: Optional[Dict[str, Any]] = None
+    ) -> List[Dict[str, Any]]:
+        """request - исходные topic, difficulty_range и exclude_task_ids для локального BM25"""
+        if self.lexical_index is not None:
+            return self.lexical_index.search_batch([dict(request or {}, query=query, limit=limit)])[0]
+        index = self.meili_client.index(self.index_name)
+        return index.search(
+            query,
+            {
+                "limit": limit,
+                "filter": meili_filter
+            }
+        )["hits"]
+    
+    def _fan_out(self, vector_call, bm25_call, default: Any) -> Tuple[Any, Any, Dict[str, str]]:
+        """Выполняет векторную и BM25 части параллельно с таймаутами.
+
+        Часть, которая не уложилась в таймаут или упала, возвращает default.
+        Третий элемент - статус каждой части: ok, timeout или error. Если
+        пул части целиком занят прошлыми зависшими вызовами, она сразу
+        считается timeout.
+        """
+        legs = {
+            "vector": (_leg_executors["vector"].submit(vector_call), RAG_VECTOR_TIMEOUT),
+            "bm25": (_leg_executors["bm25"].submit(bm25_call), RAG_BM25_TIMEOUT),
+        }
+        started = time.monotonic()
+        leg_results = {}
+        statuses = {}
+        for leg, (future, timeout) in legs.items():
+            if future is None:
+                logger.warning(f"Hybrid search {leg} leg skipped: all threads wait for timed out calls")
+                leg_results[leg], statuses[leg] = default, "timeout"
+                continue
+            try:
+                leg_results[leg] = future.result(timeout=max(0.0, started + timeout - time.monotonic()))
+                statuses[leg] = "ok"
+            except FutureTimeoutError:
+                logger.warning(f"Hybrid search {leg} leg timed out after {timeout}s")
+                _leg_executors[leg].abandon(future)
+                leg_results[leg], statuses[leg] = default, "timeout"
+            except Exception as e:
+                logger.error(f"Hybrid search {leg} leg failed: {e}")
+                leg_results[leg], statuses[leg] = default, "error"
+        return leg_results["vector"], leg_results["bm25"], statuses
+    
     def hybrid_search(
         self,
         query: str,
         topic: Optional[str] = None,
         difficulty_range: Optional[Tuple[int, int]] = None,
-        limit: int = 20
+        limit: int = 20,
+        exclude_task_ids: Optional[Iterable[int]] = None
     ) -> List[Dict[str, Any]]:
         
         if not self.available:
             return []
             
         try:
-            # Генерация эмбеддинга запроса
-            if self.embedding_model:
-                query_embedding = self.embedding_model.encode(query).tolist()
-            else:
-                query_embedding = np.random.rand(384).tolist()
+            query_embedding = self._encode_query(query)
+            qdrant_filter, meili_filter = self._build_filters(topic, difficulty_range, exclude_task_ids)
+            request = {"topic": topic, "difficulty_range": difficulty_range, "exclude_task_ids": exclude_task_ids}
             
-            # Векторный поиск в Qdrant
-            qdrant_filter = models.Filter(must=[])
-            if topic:
-                qdrant_filter.must.append(
-                    models.FieldCondition(key="topic", match=models.MatchValue(value=topic))
-                )
-            if difficulty_range:
-                qdrant_filter.must.append(
-                    models.FieldCondition(
-                        key="difficulty",
-                        range=models.Range(gte=difficulty_range[0], lte=difficulty_range[1])
-                    )
-                )
-            
-            vector_results = self.qdrant_client.search(
-                collection_name=self.collection_name,
-                query_vector=query_embedding,
-                query_filter=qdrant_filter if qdrant_filter.must else None,
-                limit=limit
+            vector_results, bm25_hits, _ = self._fan_out(
+                lambda: self._vector_search(query_embedding, qdrant_filter, limit, request),
+                lambda: self._bm25_search(query, meili_filter, limit, request),
+                default=[]
             )
             
-            # BM25 поиск в Meilisearch
-            meili_filter = []
-            if topic:
-                meili_filter.append(f"topic = '{topic}'")
-            if difficulty_range:
-                meili_filter.append(f"difficulty >= {difficulty_range[0]} AND difficulty <= {difficulty_range[1]}")
-            
-            index = self.meili_client.index(self.index_name)
-            bm25_results = index.search(
-                query,
-                {
-                    "limit": limit,
-                    "filter": " AND ".join(meili_filter) if meili_filter else None
-                }
-            )
+            return self._merge_results(vector_results, bm25_hits, limit)
             
-            # Комбинирование результатов (60% векторы + 40% BM25)
-            combined_scores = {}
+        except Exception as e:
+            logger.error(f"Error in hybrid search: {e}")
+            return []
+    
+    def _encode_queries(self, queries: List[str]) -> List[List[float]]:
+        """Эмбеддинги для нескольких запросов: кэш плюс один вызов модели на промахи"""
+        if not self.embedding_model:
+            return np.random.rand(len(queries), 384).tolist()
+        
+        embeddings = [self.query_cache.get(query) for query in queries]
+        missing = sorted({query for query, embedding in zip(queries, embeddings) if embedding is None})
+        if missing:
+            encoded = dict(zip(missing, self.embedding_model.encode(missing).tolist()))
+            for query, embedding in encoded.items():
+                self.query_cache.put(query, embedding)
+            embeddings = [
+                embedding if embedding is not None else encoded[query]
+                for query, embedding in zip(queries, embeddings)
+            ]
+        return embeddings
+    
+    def hybrid_search_batch(self, requests: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+        """Гибридный поиск сразу по нескольким запросам.
+
+        Каждый запрос - словарь с ключами query, topic, difficulty_range,
+        limit и exclude_task_ids, как у hybrid_search. Все запросы кодируются одним вызовом
+        модели, в Qdrant уходит один search_batch, в Meilisearch один
+        multi_search. Результаты возвращаются в порядке запросов.
+        """
+        return self.hybrid_search_batch_with_legs(requests)["results"]
+    
+    def hybrid_search_batch_with_legs(self, requests: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """hybrid_search_batch вместе со статусом векторной и BM25 частей.
+
+        Если одна из частей не успела или упала, results построены только
+        по второй; такие результаты не стоит сохранять надолго.
+        """
+        if not self.available or not requests:
+            return {"results": [[] for _ in requests], "legs": {}}
+        
+        try:
+            embeddings = self._encode_queries([request["query"] for request in requests])
+            filters = [
+                self._build_filters(
+                    request.get("topic"), request.get("difficulty_range"), request.get("exclude_task_ids")
+                )
+                for request in requests
+            ]
             
-            for result in vector_results:
-                task_id = result.payload["task_id"]
-                combined_scores[task_id] = {
-                    "task_id": task_id,
-                    "vector_score": result.score,
-                    "bm25_score": 0.0,
-                    "combined_score": result.score * 0.6
-                }
+            def vector_call():
+                if self.vector_index is not None:
+                    return self.vector_index.search_batch(embeddings, requests)
+                return self.qdrant_client.search_batch(
+                    collection_name=self.collection_name,
+                    requests=[
+                        models.SearchRequest(
+                            vector=embedding,
+                            filter=qdrant_filter,
+                            limit=request.get("limit", 20),
+                            with_payload=True
+                        )
+                        for request, embedding, (qdrant_filter, _) in zip(requests, embeddings, filters)
+                    ]
+                )
             
-            for result in bm25_results["hits"]:
-                task_id = result["id"]
-                bm25_score = 1.0 / (1.0 + result.get("_rankingScore", 1000))
-                
-                if task_id in combined_scores:
-                    combined_scores[task_id]["bm25_score"] = bm25_score
-                    combined_scores[task_id]["combined_score"] = (
-                        combined_scores[task_id]["vector_score"] * 0.6 + bm25_score * 0.4
-                    )
-                else:
-                    combined_scores[task_id] = {
-                        "task_id": task_id,
-                        "vector_score": 0.0,
-                        "bm25_score": bm25_score,
-                        "combined_score": bm25_score * 0.4
+            def bm25_call():
+                if self.lexical_index is not None:
+                    return self.lexical_index.search_batch(requests)
+                response = self.meili_client.multi_search([
+                    {
+                        "indexUid": self.index_name,
+                        "q": request["query"],
+                        "limit": request.get("limit", 20),
+                        "filter": meili_filter
                     }
+                    for request, (_, meili_filter) in zip(requests, filters)
+                ])
+                return [result["hits"] for result in response["results"]]
             
-            # Сортировка по итоговому скору
-            sorted_results = sorted(
-                combined_scores.values(),
-                key=lambda x: x["combined_score"],
-                reverse=True
-            )
+            empty = [[] for _ in requests]
+            vector_batches, bm25_batches, legs = self._fan_out(vector_call, bm25_call, default=empty)
             
-            return sorted_results[:limit]
+            return {
+                "results": [
+                    self._merge_results(vector_results, bm25_hits, request.get("limit", 20))
+                    for request, vector_results, bm25_hits in zip(requests, vector_batches, bm25_batches)
+                ],
+                "legs": legs
+            }
             
         except Exception as e:
-            logger.error(f"Error in hybrid search: {e}")
-            return []
+            logger.error(f"Error in batch hybrid search: {e}")
+            return {"results": [[] for _ in requests], "legs": {"vector": "error", "bm25": "error"}}
+    
+    def _get_async_clients(self) -> Tuple[AsyncQdrantClient, httpx.AsyncClient]:
+        if self._async_qdrant_client is None:
+            self._async_qdrant_client = AsyncQdrantClient(url=self.qdrant_url)
+        if self._async_meili_client is None:
+            self._async_meili_client = create_async_client(
+                base_url=self.meili_url,
+                headers={"Authorization": f"Bearer {self.meili_key}"}
+            )
+        return self._async_qdrant_client, self._async_meili_client
+    
+    async def _timed_leg(self, leg: str, coro, timeout: float) -> Tuple[Any, Dict[str, Any]]:
+        started = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(coro, timeout=timeout)
+            status = "ok"
+        except asyncio.TimeoutError:
+            logger.warning(f"Hybrid search {leg} leg timed out after {timeout}s")
+            result, status = [], "timeout"
+        except Exception as e:
+            logger.error(f"Hybrid search {leg} leg failed: {e}")
+            result, status = [], "error"
+        return result, {
+            "status": status,
+            "latency_ms": round((time.perf_counter() - started) * 1000, 1)
+        }
+    
+    async def _async_vector_search(
+        self,
+        query_embedding: List[float],
+        qdrant_filter: Optional[models.Filter],
+        limit: int,
+        request: Optional[Dict[str, Any]] = None
+    ) -> List[Any]:
+        if self.vector_index is not None:
+            return await asyncio.to_thread(self._vector_search, query_embedding, qdrant_filter, limit, request)
+        qdrant_client, _ = self._get_async_clients()
+        return await qdrant_client.search(
+            collection_name=self.collection_name,
+            query_vector=query_embedding,
+            query_filter=qdrant_filter,
+            limit=limit
+        )
+    
+    async def _async_bm25_search(
+        self,
+        query: str,
+        meili_filter: Optional[str],
+        limit: int,
+        request: Optional[Dict[str, Any]] = None
+    ) -> List[Dict[str, Any]]:
+        if self.lexical_index is not None:
+            return await asyncio.to_thread(self._bm25_search, query, meili_filter, limit, request)
+        _, meili_client = self._get_async_clients()
+        response = await meili_client.post(
+            f"/indexes/{self.index_name}/search",
+            json={"q": query, "limit": limit, "filter": meili_filter}
+        )
+        response.raise_for_status()
+        return response.json()["hits"]
+    
+    async def hybrid_search_async(
+        self,
+        query: str,
+        topic: Optional[str] = None,
+        difficulty_range: Optional[Tuple[int, int]] = None,
+        limit: int = 20
+    ) -> Dict[str, Any]:
+        """Асинхронный гибридный поиск для обработчиков FastAPI.
+
+        Векторная и BM25 части выполняются параллельно, каждая со своим
+        таймаутом. Если одна из них не успела или упала, результат строится
+        по второй. Кодирование запроса - отдельный этап: BM25 идёт во время
+        него, а таймаут векторной части отсчитывается уже после. Возвращает
+        результаты и задержку каждого этапа.
+        """
+        if not self.available:
+            return {"results": [], "legs": {}}
+        
+        qdrant_filter, meili_filter = self._build_filters(topic, difficulty_range)
+        request = {"topic": topic, "difficulty_range": difficulty_range}
+        bm25_leg_task = asyncio.create_task(self._timed_leg(
+            "bm25", self._async_bm25_search(query, meili_filter, limit, request), RAG_BM25_TIMEOUT
+        ))
+        
+        started = time.perf_counter()
+        try:
+            query_embedding = await asyncio.to_thread(self._encode_query, query)
+            encode_status = "ok"
+        except Exception as e:
+            logger.error(f"Hybrid search query encoding failed: {e}")
+            query_embedding, encode_status = None, "error"
+        encode_stage = {
+            "status": encode_status,
+            "latency_ms": round((time.perf_counter() - started) * 1000, 1)
+        }
+        
+        if query_embedding is not None:
+            vector_results, vector_leg = await self._timed_leg(
+                "vector", self._async_vector_search(query_embedding, qdrant_filter, limit, request), RAG_VECTOR_TIMEOUT
+            )
+        else:
+            vector_results, vector_leg = [], {"status": "error", "latency_ms": 0.0}
+        bm25_hits, bm25_leg = await bm25_leg_task
+        
+        return {
+            "results": self._merge_results(vector_results, bm25_hits, limit),
+            "legs": {"encode": encode_stage, "vector": vector_leg, "bm25": bm25_leg}
+        }
+    
+    async def aclose(self):
+        if self._async_qdrant_client is not None:
+            await self._async_qdrant_client.close()
+            self._async_qdrant_client = None
+        if self._async_meili_client is not None:
+            await self._async_meili_client.aclose()
+            self._async_meili_client = None
     
     def get_collection_info(self):
         if not self.available:
             return {"error": "RAG Service not available"}
             
         try:
-            # Информация о Qdrant коллекции
-            collection_info = self.qdrant_client.get_collection(self.collection_name)
-            
-            # Информация о Meilisearch индексе
-            index = self.meili_client.index(self.index_name)
-            index_stats = index.get_stats()
-            
-            return {
-                "qdrant": {
+            # Информация о Qdrant коллекции или локальном индексе
+            if self.vector_index is not None:
+                vector_info = self.vector_index.stats()
+            else:
+                collection_info = self.qdrant_client.get_collection(self.collection_name)
+                vector_info = {
                     "collection": self.collection_name,
                     "points_count": collection_info.points_count,
                     "vector_size": collection_info.config.params.vectors.size
-                },
-                "meilisearch": {
+                }
+            
+            # Информация о Meilisearch индексе или локальном BM25
+            if self.lexical_index is not None:
+                lexical_info = self.lexical_index.stats()
+            else:
+                index = self.meili_client.index(self.index_name)
+                index_stats = index.get_stats()
+                lexical_info = {
                     "index": self.index_name,
                     "documents_count": index_stats.get("numberOfDocuments", 0)
                 }
+            
+            return {
+                "qdrant" if self.vector_index is None else "vector_index": vector_info,
+                "meilisearch" if self.lexical_index is None else "lexical_index": lexical_info,
+                "embedding_cache": self.query_cache.stats() if self.query_cache else None
             }
         except Exception as e:
             return {"error": str(e)}
@@ -0,0 +1,140 @@
+import os
+import logging
+import threading
+from typing import Dict, Iterable, Optional, Callable, Set
+
+from .bitset import IdBitset
+
+logger = logging.getLogger(__name__)
+
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+# redis - битовые карты в Redis, memory - в пределах процесса, off - без учёта выданных задач
+SEEN_TASKS_BACKEND = os.getenv("SEEN_TASKS_BACKEND", "redis")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+# Больше выданных задач в exclude_task_ids поиска не передаётся, остальные отсеиваются по битовой карте
+SEEN_TASKS_MAX_EXCLUDE = int(os.getenv("SEEN_TASKS_MAX_EXCLUDE", "500"))
+
+_index: Optional["SeenTaskIndex"] = None
+_index_lock = threading.Lock()
+
+
+class SeenTaskIndex:
+    """Задачи, уже выданные каждому ученику, в виде битовой карты по id задачи.
+
+    В Redis карта ученика хранится под ключом seen_tasks:<student_id> и
+    читается одним GET; бит task_id выставлен, если задача была в одном из
+    завершённых заданий. mark всегда выставляет биты через SETBIT, а карта
+    считается полной только после backfill из AssignmentItem: его результат
+    объединяется с уже отмеченным через BITOP OR, после чего ставится
+    ключ seen_tasks:<student_id>:ready. Так отметки, сделанные во время
+    backfill, не теряются.
+    """
+
+    def __init__(self, backend: str = "memory"):
+        self._redis = None
+        self._memory: Dict[int, IdBitset] = {}
+        self._memory_ready: Set[int] = set()
+        self._lock = threading.Lock()
+
+        if backend == "redis":
+            if not REDIS_AVAILABLE:
+                logger.warning("redis package is not installed, keeping seen tasks in memory")
+            else:
+                try:
+                    self._redis = redis.Redis.from_url(REDIS_URL, socket_timeout=1.0, socket_connect_timeout=1.0)
+                    self._redis.ping()
+                except Exception as e:
+                    logger.warning(f"Redis is not available for seen tasks, keeping them in memory: {e}")
+                    self._redis = None
+
+    @property
+    def backend(self) -> str:
+        return "redis" if self._redis is not None else "memory"
+
+    @staticmethod
+    def _key(student_id: int) -> str:
+        return f"seen_tasks:{student_id}"
+
+    @staticmethod
+    def _ready_key(student_id: int) -> str:
+        return f"seen_tasks:{student_id}:ready"
+
+    def get(self, student_id: int, backfill: Callable[[int], Iterable[int]]) -> IdBitset:
+        """Выданные ученику задачи; backfill(student_id) читает их из БД, если карты ещё нет"""
+        if self._redis is not None:
+            try:
+                pipeline = self._redis.pipeline(transaction=False)
+                pipeline.get(self._key(student_id))
+                pipeline.exists(self._ready_key(student_id))
+                data, ready = pipeline.execute()
+                if ready:
+                    return IdBitset.from_bytes(data)
+            except Exception as e:
+                logger.warning(f"Could not read seen tasks for student {student_id}: {e}")
+                return IdBitset(backfill(student_id))
+        else:
+            with self._lock:
+                if student_id in self._memory_ready:
+                    return IdBitset.from_bytes(self._memory[student_id].to_bytes())
+
+        return self._store(student_id, IdBitset(backfill(student_id)))
+
+    def _store(self, student_id: int, seen: IdBitset) -> IdBitset:
+        """Объединяет backfill с отметками, сделанными за это время, и помечает карту полной"""
+        if self._redis is not None:
+            key = self._key(student_id)
+            backfill_key = f"{key}:backfill"
+            try:
+                pipeline = self._redis.pipeline(transaction=True)
+                pipeline.set(backfill_key, seen.to_bytes(), ex=60)
+                pipeline.bitop("OR", key, key, backfill_key)
+                pipeline.delete(backfill_key)
+                pipeline.set(self._ready_key(student_id), 1)
+                pipeline.get(key)
+                return IdBitset.from_bytes(pipeline.execute()[-1])
+            except Exception as e:
+                logger.warning(f"Could not store seen tasks for student {student_id}: {e}")
+                return seen
+        with self._lock:
+            stored = self._memory.get(student_id)
+            self._memory[student_id] = seen if stored is None else stored | seen
+            self._memory_ready.add(student_id)
+            return IdBitset.from_bytes(self._memory[student_id].to_bytes())
+
+    def mark(self, student_id: int, task_ids: Iterable[int]):
+        """Отмечает задачи завершённого задания как выданные"""
+        task_ids = [task_id for task_id in task_ids if task_id is not None]
+        if not task_ids:
+            return
+
+        if self._redis is not None:
+            try:
+                # Биты выставляются и до backfill: неполной карту делает
+                # отсутствие ключа :ready, а не отсутствие самой карты
+                key = self._key(student_id)
+                pipeline = self._redis.pipeline(transaction=False)
+                for task_id in task_ids:
+                    pipeline.setbit(key, task_id, 1)
+                pipeline.execute()
+            except Exception as e:
+                logger.warning(f"Could not mark seen tasks for student {student_id}: {e}")
+        else:
+            with self._lock:
+                self._memory.setdefault(student_id, IdBitset()).update(task_ids)
+
+
+def get_seen_task_index() -> Optional[SeenTaskIndex]:
+    """Общий для процесса индекс выданных задач; None, если учёт отключён"""
+    global _index
+    if SEEN_TASKS_BACKEND == "off":
+        return None
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = SeenTaskIndex(SEEN_TASKS_BACKEND)
+    return _index
@@ -1,18 +1,30 @@
 import json
+import os
 import pandas as pd
 import hashlib
 import re
-from typing import List, Dict, Any
+import logging
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Tuple
+from sqlalchemy import select, insert
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import Session
 
 from ..models import Task, TaskSkeleton, ImportSession
 from ..schemas import TaskCreate
-from .rag_service import RAGService
+from .rag_service import RAGService, get_rag_service
+from .utils import chunked
+from .candidate_pool import get_candidate_pool_index
+
+logger = logging.getLogger(__name__)
+
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "500"))
 
 class TaskService:
-    def __init__(self, db: Session):
+    def __init__(self, db: Session, rag_service: Optional[RAGService] = None):
         self.db = db
-        self.rag_service = RAGService()
+        # Асинхронные обработчики получают сервис в пуле потоков и передают его сюда:
+        # get_rag_service может проверять доступность бэкендов блокирующими запросами
+        self.rag_service = rag_service if rag_service is not None else get_rag_service()
     
     def normalize_text(self, text: str) -> str:
         text = re.sub(r'\s+', ' ', text.strip())
@@ -28,7 +40,7 @@ class TaskService:
     def compute_skeleton_hash(self, skeleton: str) -> str:
         return hashlib.md5(skeleton.encode('utf-8')).hexdigest()
     
-    def create_task(self, task_data: TaskCreate) -> Task:
+    def create_task(self, task_data: TaskCreate, index: bool = True) -> Task:
         normalized_text = self.normalize_text(task_data.statement_text)
         skeleton = self.extract_skeleton(normalized_text)
         skeleton_hash = self.compute_skeleton_hash(skeleton)
@@ -54,20 +66,189 @@ class TaskService:
         self.db.commit()
         self.db.refresh(db_task)
         
-        if self.rag_service.available:
-            task_dict = {
-                "id": db_task.id,
-                "topic": db_task.topic,
-                "subtopic": db_task.subtopic or "",
-                "difficulty": db_task.difficulty,
-                "statement_text": db_task.statement_text,
-                "skills": db_task.skills or [],
-                "tags": db_task.tags or []
-            }
-            self.rag_service.index_task(task_dict)
+        if index:
+            self.index_in_rag(db_task)
         
         return db_task
     
+    def index_in_rag(self, db_task: Task) -> bool:
+        if not self.rag_service.available:
+            return False
+        indexed = self.rag_service.index_task(self._rag_document(db_task.id, db_task))
+        if indexed:
+            # Точка в Qdrant записана с wait=True, поэтому пул сразу перестраивается с новой задачей
+            pool_index = get_candidate_pool_index()
+            if pool_index is not None:
+                pool_index.rebuild_tasks([db_task], self.rag_service)
+        return indexed
+    
+    def _invalidate_candidate_pools(self, tasks: Iterable[Any]):
+        """Пулы кандидатов с темой и сложностью новых задач перестраиваются при следующем запросе.
+
+        Импорт индексирует пачки с wait=False, поэтому перестроить пулы сразу
+        нельзя: они бы не увидели ещё не применённые документы. Пул,
+        построенный по запросу до окончания индексации, может не содержать
+        новых задач до истечения CANDIDATE_POOL_TTL.
+        """
+        pool_index = get_candidate_pool_index()
+        if pool_index is not None:
+            pool_index.invalidate_tasks(tasks)
+    
+    def _rag_document(self, task_id: int, task: Any, skeleton_id: Optional[int] = None) -> Dict[str, Any]:
+        return {
+            "id": task_id,
+            "skeleton_id": skeleton_id if skeleton_id is not None else getattr(task, "skeleton_id", None),
+            "topic": task.topic,
+            "subtopic": task.subtopic or "",
+            "difficulty": task.difficulty,
+            "statement_text": task.statement_text,
+            "skills": task.skills or [],
+            "tags": task.tags or []
+        }
+    
+    def _insert_chunk(self, tasks_data: List[TaskCreate]) -> List[Tuple[int, int]]:
+        """Вставляет пачку задач: один SELECT по хэшам скелетов и
+        INSERT ... RETURNING для новых скелетов и задач. Возвращает пары
+        (id задачи, id скелета). Коммит делает вызывающий код.
+
+        Скелеты вставляются с ON CONFLICT DO NOTHING: параллельный импорт
+        мог успеть добавить тот же хэш, тогда его id перечитывается."""
+        skeletons = []
+        for task_data in tasks_data:
+            normalized_text = self.normalize_text(task_data.statement_text)
+            skeleton = self.extract_skeleton(normalized_text)
+            skeletons.append((skeleton, self.compute_skeleton_hash(skeleton)))
+        
+        hashes = {skeleton_hash for _, skeleton_hash in skeletons}
+        skeleton_ids = dict(self.db.execute(
+            select(TaskSkeleton.skeleton_hash, TaskSkeleton.id)
+            .where(TaskSkeleton.skeleton_hash.in_(hashes))
+        ).all())
+        
+        new_skeletons = {}
+        for skeleton, skeleton_hash in skeletons:
+            if skeleton_hash not in skeleton_ids:
+                new_skeletons[skeleton_hash] = skeleton
+        
+        if new_skeletons:
+            self.db.execute(
+                pg_insert(TaskSkeleton).on_conflict_do_nothing(index_elements=["skeleton_hash"]),
+                [
+                    {"skeleton_text": skeleton, "skeleton_hash": skeleton_hash}
+                    for skeleton_hash, skeleton in new_skeletons.items()
+                ]
+            )
+            skeleton_ids.update(self.db.execute(
+                select(TaskSkeleton.skeleton_hash, TaskSkeleton.id)
+                .where(TaskSkeleton.skeleton_hash.in_(new_skeletons.keys()))
+            ).all())
+        
+        task_ids = self.db.scalars(
+            insert(Task).returning(Task.id, sort_by_parameter_order=True),
+            [
+                {**task_data.dict(), "skeleton_id": skeleton_ids[skeleton_hash]}
+                for task_data, (_, skeleton_hash) in zip(tasks_data, skeletons)
+            ]
+        ).all()
+        return [
+            (task_id, skeleton_ids[skeleton_hash])
+            for task_id, (_, skeleton_hash) in zip(task_ids, skeletons)
+        ]
+    
+    def _insert_rows_separately(
+        self,
+        chunk: List[TaskCreate],
+        first_row: int,
+        errors: List[str]
+    ) -> Tuple[List[Tuple[int, int]], List[TaskCreate]]:
+        """Вставляет строки упавшей пачки по одной, каждую в своём savepoint.
+
+        Возвращает пары (id задачи, id скелета) и вставленные строки.
+        """
+        inserted = []
+        inserted_rows = []
+        for row_number, task_data in enumerate(chunk, first_row):
+            try:
+                with self.db.begin_nested():
+                    inserted.extend(self._insert_chunk([task_data]))
+                inserted_rows.append(task_data)
+            except Exception as e:
+                logger.error(f"Error importing row {row_number}: {e}")
+                errors.append(f"Row {row_number}: {e}")
+        return inserted, inserted_rows
+    
+    def _import_in_chunks(
+        self,
+        session: ImportSession,
+        tasks_data: Iterable[TaskCreate],
+        errors: List[str]
+    ) -> int:
+        """Импортирует задачи пачками по IMPORT_CHUNK_SIZE, по одной
+        транзакции на пачку. Прогресс сессии обновляется в той же транзакции.
+        Если пачка не вставилась целиком, её строки вставляются по одной,
+        и ошибка теряет только свою строку."""
+        imported = 0
+        processed = 0
+        
+        for chunk_number, chunk in enumerate(chunked(tasks_data, IMPORT_CHUNK_SIZE), 1):
+            first_row = processed + 1
+            processed += len(chunk)
+            try:
+                inserted = self._insert_chunk(chunk)
+            except Exception as e:
+                self.db.rollback()
+                logger.warning(f"Chunk {chunk_number} failed, importing its rows one by one: {e}")
+                inserted, chunk = self._insert_rows_separately(chunk, first_row, errors)
+            
+            try:
+                session.imported_tasks = imported + len(inserted)
+                session.total_tasks = max(session.total_tasks or 0, processed)
+                self.db.commit()
+                imported += len(inserted)
+            except Exception as e:
+                self.db.rollback()
+                logger.error(f"Error importing chunk {chunk_number}: {e}")
+                errors.append(f"Chunk {chunk_number}: {e}")
+                continue
+            
+            if self.rag_service.available:
+                self.rag_service.index_tasks_bulk(
+                    [
+                        self._rag_document(task_id, task_data, skeleton_id)
+                        for (task_id, skeleton_id), task_data in zip(inserted, chunk)
+                    ],
+                    wait=False
+                )
+                self._invalidate_candidate_pools(chunk)
+        
+        return imported
+    
+    def _iter_tasks_from_file(self, file_path: str, errors: List[str]) -> Iterator[TaskCreate]:
+        if file_path.endswith('.jsonl'):
+            with open(file_path, 'r', encoding='utf-8') as f:
+                for line_number, line in enumerate(f, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        yield TaskCreate(**json.loads(line))
+                    except Exception as e:
+                        errors.append(f"Line {line_number}: {e}")
+        
+        elif file_path.endswith('.csv'):
+            row_number = 0
+            for df in pd.read_csv(file_path, chunksize=IMPORT_CHUNK_SIZE):
+                df = df.astype(object).where(pd.notnull(df), None)
+                for task_dict in df.to_dict('records'):
+                    row_number += 1
+                    try:
+                        if 'skills' in task_dict and isinstance(task_dict['skills'], str):
+                            task_dict['skills'] = json.loads(task_dict['skills'])
+                        if 'tags' in task_dict and isinstance(task_dict['tags'], str):
+                            task_dict['tags'] = json.loads(task_dict['tags'])
+                        yield TaskCreate(**task_dict)
+                    except Exception as e:
+                        errors.append(f"Row {row_number}: {e}")
+    
     def import_tasks_from_data(self, session_id: int, tasks_data: List[TaskCreate]):
         session = self.db.query(ImportSession).filter(ImportSession.id == session_id).first()
         if not session:
@@ -77,15 +258,8 @@ class TaskService:
         session.total_tasks = len(tasks_data)
         self.db.commit()
         
-        imported = 0
         errors = []
-        
-        for task_data in tasks_data:
-            try:
-                self.create_task(task_data)
-                imported += 1
-            except Exception as e:
-                errors.append(str(e))
+        imported = self._import_in_chunks(session, tasks_data, errors)
         
         session.imported_tasks = imported
         session.errors = errors
@@ -100,51 +274,24 @@ class TaskService:
         session.status = "processing"
         self.db.commit()
         
-        tasks_data = []
         errors = []
         
         try:
-            if file_path.endswith('.jsonl'):
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    for line in f:
-                        if line.strip():
-                            task_dict = json.loads(line)
-                            tasks_data.append(TaskCreate(**task_dict))
-            
-            elif file_path.endswith('.csv'):
-                df = pd.read_csv(file_path)
-                for _, row in df.iterrows():
-                    task_dict = row.to_dict()
-                    if 'skills' in task_dict and isinstance(task_dict['skills'], str):
-                        task_dict['skills'] = json.loads(task_dict['skills'])
-                    if 'tags' in task_dict and isinstance(task_dict['tags'], str):
-                        task_dict['tags'] = json.loads(task_dict['tags'])
-                    tasks_data.append(TaskCreate(**task_dict))
-            
-            session.total_tasks = len(tasks_data)
-            self.db.commit()
-            
-            imported = 0
-            for task_data in tasks_data:
-                try:
-                    self.create_task(task_data)
-                    imported += 1
-                except Exception as e:
-                    errors.append(str(e))
-            
+            imported = self._import_in_chunks(
+                session, self._iter_tasks_from_file(file_path, errors), errors
+            )
             session.imported_tasks = imported
             session.errors = errors
             session.status = "completed"
             
         except Exception as e:
+            self.db.rollback()
             session.status = "failed"
-            session.errors = [str(e)]
+            session.errors = errors + [str(e)]
         
         self.db.commit()
     
     def import_all_tasks_from_directory(self, session_id: int, directory_path: str):
-        import os
-        
         session = self.db.query(ImportSession).filter(ImportSession.id == session_id).first()
         if not session:
             return
@@ -0,0 +1,13 @@
+from typing import Any, Iterable, List
+
+
+def chunked(items: Iterable[Any], size: int) -> Iterable[List[Any]]:
+    """Разбивает итерируемый объект на списки длиной не больше size"""
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,689 @@
+import os
+import json
+import time
+import shutil
+import logging
+import threading
+from contextlib import contextmanager
+from typing import List, Dict, Any, Optional, Iterable, Tuple, NamedTuple
+
+import numpy as np
+
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+# qdrant - внешний Qdrant, local - LocalVectorIndex в процессе
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "qdrant")
+VECTOR_INDEX_DIR = os.getenv("VECTOR_INDEX_DIR", "/app/data/vector_index")
+# float16 - 2 байта на координату, int8 - 1 байт с небольшой потерей точности
+VECTOR_INDEX_DTYPE = os.getenv("VECTOR_INDEX_DTYPE", "float16")
+# flat - точный перебор, ivf - перебор только ближайших кластеров
+VECTOR_INDEX_MODE = os.getenv("VECTOR_INDEX_MODE", "flat")
+VECTOR_INDEX_NPROBE = int(os.getenv("VECTOR_INDEX_NPROBE", "8"))
+# IVF строится только начиная с этого размера, на меньших банках перебор быстрее
+VECTOR_INDEX_IVF_MIN_SIZE = int(os.getenv("VECTOR_INDEX_IVF_MIN_SIZE", "50000"))
+# Как часто проверять, не записал ли другой процесс новое поколение индекса
+VECTOR_INDEX_RELOAD_INTERVAL = float(os.getenv("VECTOR_INDEX_RELOAD_INTERVAL", "5"))
+# Накопленные без flush точки сами записываются сегментом при таком числе строк
+VECTOR_INDEX_FLUSH_ROWS = int(os.getenv("VECTOR_INDEX_FLUSH_ROWS", "10000"))
+# Сегменты склеиваются в один, когда их больше этого числа
+VECTOR_INDEX_MAX_SEGMENTS = int(os.getenv("VECTOR_INDEX_MAX_SEGMENTS", "16"))
+# Сегменты вливаются в основное поколение, когда в них столько строк
+VECTOR_INDEX_MERGE_ROWS = int(os.getenv("VECTOR_INDEX_MERGE_ROWS", "50000"))
+
+BLOCK_ROWS = 65536
+INT8_SCALE = 127.0
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_PER_LIST = 64
+
+_index: Optional["LocalVectorIndex"] = None
+_index_lock = threading.Lock()
+
+
+COLUMNS = ("ids", "topics", "difficulty", "skeleton_hash", "skeleton_id")
+
+
+class VectorHit(NamedTuple):
+    """Результат поиска с теми же полями id, score и payload, что у ScoredPoint Qdrant"""
+    id: int
+    score: float
+    payload: Dict[str, Any]
+
+
+def _concat_columns(parts: List[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+    """Склеивает пачки колонок; для повторяющегося id остаётся последняя строка"""
+    columns = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+    ids = columns["ids"]
+    _, last_from_end = np.unique(ids[::-1], return_index=True)
+    if len(last_from_end) == len(ids):
+        return columns
+    keep = np.sort(len(ids) - 1 - last_from_end)
+    return {name: values[keep] for name, values in columns.items()}
+
+
+class _Snapshot:
+    """Одно поколение индекса, открытое через memory map, или сегменты в памяти"""
+
+    def __init__(self, generation: Optional[str] = None, path: Optional[str] = None):
+        self.generation = generation
+        self.meta: Dict[str, Any] = {"count": 0, "dim": None, "dtype": VECTOR_INDEX_DTYPE, "topics": []}
+        self.vectors = None
+        self.ids = np.empty(0, dtype=np.int64)
+        self.topics = np.empty(0, dtype=np.int32)
+        self.difficulty = np.empty(0, dtype=np.int16)
+        self.skeleton_hash = np.empty(0, dtype="S32")
+        self.skeleton_id = np.empty(0, dtype=np.int64)
+        self.centroids = None
+        self.lists = None
+        self.list_order = None
+        self.list_offsets = None
+
+        if path is not None:
+            with open(os.path.join(path, "meta.json"), encoding="utf-8") as f:
+                self.meta = json.load(f)
+            for column in ("vectors",) + COLUMNS:
+                setattr(self, column, np.load(os.path.join(path, f"{column}.npy"), mmap_mode="r"))
+            if self.meta.get("ivf"):
+                self.centroids = np.load(os.path.join(path, "ivf_centroids.npy"))
+                self.lists = np.load(os.path.join(path, "ivf_lists.npy"), mmap_mode="r")
+                self.list_order = np.argsort(self.lists, kind="stable")
+                self.list_offsets = np.concatenate(
+                    ([0], np.cumsum(np.bincount(self.lists, minlength=len(self.centroids))))
+                )
+
+        self.topic_codes = {topic: code for code, topic in enumerate(self.meta["topics"])}
+
+    @classmethod
+    def from_columns(cls, columns: Dict[str, np.ndarray]) -> "_Snapshot":
+        """Снимок в памяти из колонок сегментов (topics - строки)"""
+        snapshot = cls()
+        topic_names, codes = np.unique(columns["topics"], return_inverse=True)
+        snapshot.meta = {
+            "count": len(columns["ids"]),
+            "dim": int(columns["vectors"].shape[1]),
+            "dtype": str(columns["vectors"].dtype),
+            "topics": topic_names.tolist()
+        }
+        snapshot.vectors = columns["vectors"]
+        for column in COLUMNS:
+            setattr(snapshot, column, columns[column])
+        snapshot.topics = codes.astype(np.int32)
+        snapshot.topic_codes = {topic: code for code, topic in enumerate(snapshot.meta["topics"])}
+        return snapshot
+
+    @property
+    def count(self) -> int:
+        return int(self.meta["count"])
+
+
+class _IndexView:
+    """Основное поколение плюс сегменты, перечисленные в CURRENT.
+
+    Строки основного поколения, id которых есть в сегментах, исключаются
+    из поиска маской base_alive.
+    """
+
+    def __init__(self, manifest: Dict[str, Any], base: _Snapshot, segments: List[Dict[str, np.ndarray]]):
+        self.manifest = manifest
+        self.base = base
+        self.delta_columns = _concat_columns(segments) if segments else None
+        self.delta = _Snapshot.from_columns(self.delta_columns) if segments else _Snapshot()
+        self.base_alive = None
+        if base.count and self.delta.count:
+            superseded = np.isin(base.ids, self.delta.ids)
+            if superseded.any():
+                self.base_alive = ~superseded
+
+    @property
+    def count(self) -> int:
+        base_count = self.base.count if self.base_alive is None else int(self.base_alive.sum())
+        return base_count + self.delta.count
+
+    @property
+    def layout(self) -> Optional[Tuple[int, str]]:
+        snapshot = self.base if self.base.count else self.delta
+        return (snapshot.meta["dim"], snapshot.meta["dtype"]) if snapshot.count else None
+
+
+class LocalVectorIndex:
+    """Векторный индекс задач в процессе вместо Qdrant.
+
+    Эмбеддинги нормализуются и хранятся матрицей float16 или int8 в
+    vectors.npy, рядом лежат колонки ids, topics (коды из meta.json),
+    difficulty, skeleton_hash и skeleton_id. Всё читается через memory
+    map, поэтому процессы API и воркеров делят одни страницы в page cache.
+    Поиск - векторизованный перебор по строкам, прошедшим фильтр; в режиме
+    ivf перебираются только nprobe ближайших кластеров k-means.
+
+    Запись дописывает небольшой сегмент delta-*.npz с новыми строками и
+    добавляет его в список сегментов файла CURRENT, так что её стоимость
+    не зависит от размера индекса. Сегменты читаются в память и
+    перекрывают строки основного поколения (каталог gen-*) с теми же id.
+    В фоне сегменты склеиваются (больше VECTOR_INDEX_MAX_SEGMENTS) и
+    вливаются в новое поколение (больше VECTOR_INDEX_MERGE_ROWS строк).
+    Остальные процессы подхватывают изменения не позже чем через
+    VECTOR_INDEX_RELOAD_INTERVAL секунд.
+    """
+
+    def __init__(
+        self,
+        directory: str = VECTOR_INDEX_DIR,
+        dtype: str = VECTOR_INDEX_DTYPE,
+        mode: str = VECTOR_INDEX_MODE,
+        nprobe: int = VECTOR_INDEX_NPROBE
+    ):
+        if dtype not in ("float16", "int8"):
+            raise ValueError(f"Unsupported vector index dtype: {dtype}")
+        self.directory = directory
+        self.dtype = dtype
+        self.mode = mode
+        self.nprobe = nprobe
+
+        self._view = _IndexView({"generation": None, "segments": []}, _Snapshot(), [])
+        self._segments: Dict[str, Dict[str, np.ndarray]] = {}
+        self._last_reload_check = 0.0
+        # Ещё не записанные точки - пачки колонок, уже нормализованные и квантованные
+        self._pending: List[Dict[str, np.ndarray]] = []
+        self._pending_rows = 0
+        self._compacting = False
+        self._lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._reload(force=True)
+
+    # Загрузка
+
+    def _read_manifest(self) -> Dict[str, Any]:
+        try:
+            with open(os.path.join(self.directory, "CURRENT"), encoding="utf-8") as f:
+                text = f.read().strip()
+        except FileNotFoundError:
+            return {"generation": None, "segments": []}
+        if text.startswith("{"):
+            return json.loads(text)
+        # Формат до сегментов: в CURRENT только имя поколения
+        return {"generation": text or None, "segments": []}
+
+    def _write_manifest(self, manifest: Dict[str, Any]):
+        current_tmp = os.path.join(self.directory, f"CURRENT.{os.getpid()}.tmp")
+        with open(current_tmp, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(current_tmp, os.path.join(self.directory, "CURRENT"))
+
+    @contextmanager
+    def _file_lock(self, name: str, blocking: bool = True):
+        """Межпроцессная блокировка; отдаёт False, если blocking=False и она занята"""
+        lock_file = open(os.path.join(self.directory, name), "w")
+        try:
+            acquired = True
+            if FCNTL_AVAILABLE:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+                except BlockingIOError:
+                    acquired = False
+            yield acquired
+        finally:
+            lock_file.close()
+
+    def _load_segment(self, name: str) -> Dict[str, np.ndarray]:
+        with np.load(os.path.join(self.directory, name), allow_pickle=False) as data:
+            return {column: data[column] for column in data.files}
+
+    def _reload(self, force: bool = False):
+        now = time.monotonic()
+        if not force and now - self._last_reload_check < VECTOR_INDEX_RELOAD_INTERVAL:
+            return
+        self._last_reload_check = now
+
+        manifest = self._read_manifest()
+        view = self._view
+        if manifest == view.manifest:
+            return
+        generation = manifest["generation"]
+        try:
+            if generation == view.base.generation:
+                base = view.base
+            elif generation is None:
+                base = _Snapshot()
+            else:
+                base = _Snapshot(generation, os.path.join(self.directory, generation))
+            loaded = {
+                name: self._segments[name] if name in self._segments else self._load_segment(name)
+                for name in manifest["segments"]
+            }
+            self._view = _IndexView(manifest, base, list(loaded.values()))
+            self._segments = loaded
+            if generation != view.base.generation:
+                logger.info(f"Loaded vector index {generation} with {base.count} vectors")
+        except Exception as e:
+            logger.warning(f"Could not load vector index {generation}: {e}")
+
+    # Запись
+
+    def upsert(self, points: Iterable[Dict[str, Any]], flush: bool = True):
+        """Добавляет или заменяет векторы.
+
+        Точка - словарь с ключами id, vector и payload (topic, difficulty,
+        skeleton_hash, skeleton_id). С flush=False изменения копятся в
+        памяти до вызова flush, что удобно для пакетной индексации, но не
+        больше VECTOR_INDEX_FLUSH_ROWS строк: дальше они записываются сами.
+        """
+        points = list(points)
+        if not points:
+            return
+        columns = self._columns(points)
+        with self._lock:
+            self._pending.append(columns)
+            self._pending_rows += len(points)
+            flush = flush or self._pending_rows >= VECTOR_INDEX_FLUSH_ROWS
+        if flush:
+            self.flush()
+
+    def _columns(self, points: List[Dict[str, Any]]) -> Dict[str, np.ndarray]:
+        payloads = [point.get("payload") or {} for point in points]
+        return {
+            "ids": np.fromiter((int(point["id"]) for point in points), dtype=np.int64, count=len(points)),
+            "vectors": self._quantize(self._normalize([point["vector"] for point in points])),
+            "topics": np.array([payload.get("topic") or "" for payload in payloads], dtype=str),
+            "difficulty": np.array([payload.get("difficulty") or 0 for payload in payloads], dtype=np.int16),
+            "skeleton_hash": np.array(
+                [(payload.get("skeleton_hash") or "").encode("ascii") for payload in payloads], dtype="S32"
+            ),
+            "skeleton_id": np.array(
+                [-1 if payload.get("skeleton_id") is None else payload["skeleton_id"] for payload in payloads],
+                dtype=np.int64
+            )
+        }
+
+    def flush(self):
+        """Записывает накопленные изменения новым сегментом"""
+        with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending, self._pending_rows = self._pending, [], 0
+
+        try:
+            columns = _concat_columns(pending)
+            with self._file_lock(".lock"):
+                self._reload(force=True)
+                layout = self._view.layout
+                if layout is not None and layout != (columns["vectors"].shape[1], self.dtype):
+                    # Сменилась модель или формат хранения - индекс строится заново
+                    logger.warning("Vector index layout changed, rebuilding it from new points only")
+                    generation = self._write_generation(_Snapshot(), columns)
+                    self._write_manifest({"generation": generation, "segments": []})
+                    self._remove_unused_files(keep_generation=self._view.base.generation)
+                else:
+                    name = self._write_segment(columns)
+                    manifest = self._read_manifest()
+                    self._write_manifest(dict(manifest, segments=manifest["segments"] + [name]))
+                self._reload(force=True)
+        except Exception:
+            with self._lock:
+                self._pending[:0] = pending
+                self._pending_rows += sum(len(part["ids"]) for part in pending)
+            raise
+        logger.info(f"Wrote {len(columns['ids'])} vectors to the vector index")
+        self._maybe_compact()
+
+    def _write_segment(self, columns: Dict[str, np.ndarray]) -> str:
+        name = f"delta-{time.time_ns()}-{os.getpid()}.npz"
+        tmp_path = os.path.join(self.directory, f".{name}.tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **columns)
+        os.replace(tmp_path, os.path.join(self.directory, name))
+        return name
+
+    def _normalize(self, vectors: np.ndarray) -> np.ndarray:
+        vectors = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def _quantize(self, vectors: np.ndarray) -> np.ndarray:
+        if self.dtype == "int8":
+            return np.clip(np.rint(vectors * INT8_SCALE), -INT8_SCALE, INT8_SCALE).astype(np.int8)
+        return vectors.astype(np.float16)
+
+    # Слияние сегментов
+
+    def _maybe_compact(self):
+        view = self._view
+        if view.delta.count < VECTOR_INDEX_MERGE_ROWS and len(view.manifest["segments"]) <= VECTOR_INDEX_MAX_SEGMENTS:
+            return
+        with self._lock:
+            if self._compacting:
+                return
+            self._compacting = True
+        threading.Thread(target=self.compact, name="vector-index-compact", daemon=True).start()
+
+    def compact(self):
+        """Склеивает сегменты в один или вливает их в новое поколение.
+
+        Тяжёлая запись идёт без блокировки записи, поэтому upsert в это
+        время не ждут; под блокировкой CURRENT только переключается, а
+        сегменты, дописанные за время слияния, в нём сохраняются.
+        """
+        try:
+            with self._file_lock(".compact.lock", blocking=False) as acquired:
+                if acquired:
+                    self._compact()
+        except Exception as e:
+            logger.error(f"Could not compact vector index: {e}")
+        finally:
+            self._compacting = False
+
+    def _compact(self):
+        self._reload(force=True)
+        view = self._view
+        merged = view.manifest["segments"]
+        if not merged:
+            return
+
+        if view.delta.count >= VECTOR_INDEX_MERGE_ROWS:
+            generation, replacement = self._write_generation(view.base, view.delta_columns), []
+        else:
+            generation, replacement = view.manifest["generation"], [self._write_segment(view.delta_columns)]
+
+        with self._file_lock(".lock"):
+            manifest = self._read_manifest()
+            if manifest["generation"] != view.manifest["generation"] or manifest["segments"][:len(merged)] != merged:
+                # Индекс перестроен заново, пока шло слияние; записанное слиянием удаляется как лишнее
+                logger.warning("Vector index changed during compaction, discarding merged data")
+            else:
+                manifest = {"generation": generation, "segments": replacement + manifest["segments"][len(merged):]}
+                self._write_manifest(manifest)
+                logger.info(f"Compacted {len(merged)} vector index segments into {generation}")
+            self._remove_unused_files(manifest, keep_generation=view.base.generation)
+        self._reload(force=True)
+
+    def _remove_unused_files(self, manifest: Optional[Dict[str, Any]] = None, keep_generation: Optional[str] = None):
+        """Удаляет поколения и сегменты, которых нет в CURRENT; вызывается под блокировкой записи.
+
+        Предыдущее поколение остаётся для процессов, которые ещё не переключились.
+        """
+        manifest = manifest or self._read_manifest()
+        keep = {manifest["generation"], keep_generation, *manifest["segments"]}
+        for name in os.listdir(self.directory):
+            if name in keep:
+                continue
+            path = os.path.join(self.directory, name)
+            if name.startswith("gen-"):
+                shutil.rmtree(path, ignore_errors=True)
+            elif name.startswith("delta-"):
+                os.remove(path)
+
+    def _write_generation(self, base: _Snapshot, columns: Dict[str, np.ndarray]) -> str:
+        """Пишет каталог нового поколения из base и строк columns; CURRENT не меняет"""
+        pending_ids = columns["ids"]
+        dim = columns["vectors"].shape[1]
+        if base.count and (base.meta["dim"] != dim or base.meta["dtype"] != self.dtype):
+            base = _Snapshot()
+
+        topics = list(base.meta["topics"])
+        topic_codes = dict(base.topic_codes)
+        for topic in np.unique(columns["topics"]).tolist():
+            if topic not in topic_codes:
+                topic_codes[topic] = len(topics)
+                topics.append(topic)
+
+        # Заменяемые строки остаются на своих местах, новые дописываются в конец
+        rows = np.full(len(pending_ids), -1, dtype=np.int64)
+        if base.count:
+            order = np.argsort(base.ids, kind="stable")
+            positions = np.minimum(np.searchsorted(base.ids, pending_ids, sorter=order), base.count - 1)
+            found = base.ids[order[positions]] == pending_ids
+            rows[found] = order[positions[found]]
+        appended = rows < 0
+        rows[appended] = base.count + np.arange(int(appended.sum()))
+        count = base.count + int(appended.sum())
+
+        generation = f"gen-{time.time_ns()}"
+        path = os.path.join(self.directory, generation)
+        os.makedirs(path)
+
+        vectors = np.lib.format.open_memmap(
+            os.path.join(path, "vectors.npy"), mode="w+", dtype=np.dtype(self.dtype), shape=(count, dim)
+        )
+        for start in range(0, base.count, BLOCK_ROWS):
+            end = min(start + BLOCK_ROWS, base.count)
+            vectors[start:end] = base.vectors[start:end]
+        vectors[rows] = columns["vectors"]
+        vectors.flush()
+
+        new_values = dict(columns, topics=np.array([topic_codes[topic] for topic in columns["topics"].tolist()]))
+        dtypes = {"ids": np.int64, "topics": np.int32, "difficulty": np.int16, "skeleton_hash": "S32", "skeleton_id": np.int64}
+        for column in COLUMNS:
+            data = np.empty(count, dtype=dtypes[column])
+            data[:base.count] = getattr(base, column)
+            data[rows] = new_values[column]
+            np.save(os.path.join(path, f"{column}.npy"), data)
+
+        meta = {"count": count, "dim": dim, "dtype": self.dtype, "topics": topics, "ivf": False}
+        if self.mode == "ivf" and count >= VECTOR_INDEX_IVF_MIN_SIZE:
+            meta["ivf"] = True
+            meta["ivf_trained_count"] = self._write_ivf(path, vectors, base, rows, count)
+
+        with open(os.path.join(path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        logger.info(f"Wrote vector index {generation}: {len(pending_ids)} upserted, {count} total")
+        return generation
+
+    # IVF
+
+    def _write_ivf(self, path: str, vectors: np.ndarray, base: _Snapshot, rows: np.ndarray, count: int) -> int:
+        """Сохраняет центроиды и номер кластера каждой строки; возвращает,
+        на скольких строках обучены центроиды"""
+        trained_count = base.meta.get("ivf_trained_count", 0)
+        if base.centroids is not None and count <= 2 * trained_count:
+            # Центроиды переиспользуются, кластеры назначаются только изменённым строкам
+            centroids = base.centroids
+            lists = np.empty(count, dtype=np.int32)
+            lists[:base.count] = base.lists
+            lists[rows] = self._assign_lists(vectors[rows], centroids)
+        else:
+            centroids = self._train_centroids(vectors, count)
+            lists = np.concatenate([
+                self._assign_lists(vectors[start:start + BLOCK_ROWS], centroids)
+                for start in range(0, count, BLOCK_ROWS)
+            ])
+            trained_count = count
+
+        np.save(os.path.join(path, "ivf_centroids.npy"), centroids)
+        np.save(os.path.join(path, "ivf_lists.npy"), lists)
+        return trained_count
+
+    def _as_float(self, block: np.ndarray) -> np.ndarray:
+        block = np.asarray(block, dtype=np.float32)
+        return block / INT8_SCALE if self.dtype == "int8" else block
+
+    def _assign_lists(self, block: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        return np.argmax(self._as_float(block) @ centroids.T, axis=1).astype(np.int32)
+
+    def _train_centroids(self, vectors: np.ndarray, count: int) -> np.ndarray:
+        """Сферический k-means на случайной выборке строк"""
+        n_lists = int(min(max(np.sqrt(count), 16), 4096))
+        rng = np.random.default_rng(0)
+        sample_rows = np.sort(rng.choice(count, size=min(count, n_lists * KMEANS_SAMPLE_PER_LIST), replace=False))
+        sample = self._as_float(vectors[sample_rows])
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+
+        for _ in range(KMEANS_ITERATIONS):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            filled = np.bincount(assignment, minlength=n_lists) > 0
+            centroids[filled] = self._normalize(sums[filled])
+        logger.info(f"Trained {n_lists} IVF lists on {len(sample)} vectors")
+        return centroids
+
+    # Поиск
+
+    def _filter_rows(
+        self,
+        snapshot: _Snapshot,
+        topic: Optional[str],
+        difficulty_range: Optional[Tuple[int, int]],
+        exclude_ids: Optional[Iterable[int]],
+        alive: Optional[np.ndarray] = None
+    ) -> Optional[np.ndarray]:
+        """Номера строк, прошедших фильтр; None - подходят все"""
+        mask = alive
+        if topic:
+            code = snapshot.topic_codes.get(topic)
+            if code is None:
+                return np.empty(0, dtype=np.int64)
+            mask = snapshot.topics == code if mask is None else mask & (snapshot.topics == code)
+        if difficulty_range:
+            difficulty_mask = (snapshot.difficulty >= difficulty_range[0]) & (snapshot.difficulty <= difficulty_range[1])
+            mask = difficulty_mask if mask is None else mask & difficulty_mask
+        if exclude_ids:
+            exclude_mask = ~np.isin(snapshot.ids, np.fromiter(exclude_ids, dtype=np.int64))
+            mask = exclude_mask if mask is None else mask & exclude_mask
+        return None if mask is None else np.flatnonzero(mask)
+
+    def _ivf_rows(self, snapshot: _Snapshot, query: np.ndarray) -> np.ndarray:
+        probes = np.argsort(snapshot.centroids @ query)[::-1][:self.nprobe]
+        return np.sort(np.concatenate([
+            snapshot.list_order[snapshot.list_offsets[probe]:snapshot.list_offsets[probe + 1]]
+            for probe in probes
+        ]))
+
+    def _scores(self, snapshot: _Snapshot, query: np.ndarray, rows: Optional[np.ndarray]) -> np.ndarray:
+        total = snapshot.count if rows is None else len(rows)
+        scores = np.empty(total, dtype=np.float32)
+        for start in range(0, total, BLOCK_ROWS):
+            if rows is None:
+                block = snapshot.vectors[start:start + BLOCK_ROWS]
+            else:
+                block = snapshot.vectors[rows[start:start + BLOCK_ROWS]]
+            scores[start:start + len(block)] = self._as_float(block) @ query
+        return scores
+
+    def _search_one(
+        self,
+        snapshot: _Snapshot,
+        query: np.ndarray,
+        limit: int,
+        topic: Optional[str] = None,
+        difficulty_range: Optional[Tuple[int, int]] = None,
+        exclude_ids: Optional[Iterable[int]] = None,
+        alive: Optional[np.ndarray] = None
+    ) -> List[VectorHit]:
+        if not snapshot.count or limit <= 0:
+            return []
+        rows = self._filter_rows(snapshot, topic, difficulty_range, exclude_ids, alive)
+
+        if snapshot.centroids is not None:
+            candidates = self._ivf_rows(snapshot, query)
+            if rows is not None:
+                candidates = candidates[np.isin(candidates, rows, assume_unique=True)]
+            # В ближайших кластерах мало подходящих строк - точный перебор
+            if len(candidates) >= limit:
+                rows = candidates
+
+        scores = self._scores(snapshot, query, rows)
+        if len(scores) > limit:
+            top = np.argpartition(-scores, limit - 1)[:limit]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top])]
+
+        hits = []
+        for position in top:
+            row = int(position if rows is None else rows[position])
+            task_id = int(snapshot.ids[row])
+            skeleton_id = int(snapshot.skeleton_id[row])
+            hits.append(VectorHit(
+                id=task_id,
+                score=float(scores[position]),
+                payload={
+                    "task_id": task_id,
+                    "topic": snapshot.meta["topics"][int(snapshot.topics[row])],
+                    "difficulty": int(snapshot.difficulty[row]),
+                    "skeleton_hash": snapshot.skeleton_hash[row].decode("ascii") or None,
+                    "skeleton_id": skeleton_id if skeleton_id >= 0 else None
+                }
+            ))
+        return hits
+
+    def search(
+        self,
+        query_vector: List[float],
+        limit: int = 20,
+        topic: Optional[str] = None,
+        difficulty_range: Optional[Tuple[int, int]] = None,
+        exclude_ids: Optional[Iterable[int]] = None
+    ) -> List[VectorHit]:
+        """Ближайшие по косинусу векторы среди строк, прошедших фильтр"""
+        self._reload()
+        return self._search_view(
+            self._view, self._normalize(query_vector), limit, topic, difficulty_range, exclude_ids
+        )
+
+    def _search_view(
+        self,
+        view: _IndexView,
+        query: np.ndarray,
+        limit: int,
+        topic: Optional[str] = None,
+        difficulty_range: Optional[Tuple[int, int]] = None,
+        exclude_ids: Optional[Iterable[int]] = None
+    ) -> List[VectorHit]:
+        """Лучшие limit строк из основного поколения и сегментов вместе"""
+        hits = self._search_one(view.base, query, limit, topic, difficulty_range, exclude_ids, view.base_alive)
+        if view.delta.count:
+            hits = sorted(
+                hits + self._search_one(view.delta, query, limit, topic, difficulty_range, exclude_ids),
+                key=lambda hit: hit.score,
+                reverse=True
+            )[:limit]
+        return hits
+
+    def search_batch(self, query_vectors: List[List[float]], requests: List[Dict[str, Any]]) -> List[List[VectorHit]]:
+        """Поиск по нескольким запросам на одном снимке индекса.
+
+        requests - словари с ключами limit, topic, difficulty_range и
+        exclude_task_ids, как у RAGService.hybrid_search_batch.
+        """
+        self._reload()
+        view = self._view
+        queries = self._normalize(query_vectors)
+        return [
+            self._search_view(
+                view, query, request.get("limit", 20), request.get("topic"),
+                request.get("difficulty_range"), request.get("exclude_task_ids")
+            )
+            for query, request in zip(queries, requests)
+        ]
+
+    def stats(self) -> Dict[str, Any]:
+        view = self._view
+        layout = view.layout
+        return {
+            "backend": "local",
+            "generation": view.base.generation,
+            "vectors": view.count,
+            "dim": layout[0] if layout else None,
+            "dtype": layout[1] if layout else self.dtype,
+            "ivf_lists": len(view.base.centroids) if view.base.centroids is not None else 0,
+            "segments": len(view.manifest["segments"]),
+            "segment_vectors": view.delta.count,
+            "pending": self._pending_rows
+        }
+
+
+def get_vector_index() -> Optional[LocalVectorIndex]:
+    """Общий для процесса локальный индекс; None, если используется Qdrant"""
+    global _index
+    if VECTOR_BACKEND != "local":
+        return None
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = LocalVectorIndex()
+    return _index
@@ -0,0 +1,22 @@
+"""Add assignment stage timings
+
+Revision ID: 002
+Revises: 001
+Create Date: 2026-10-16 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = '002'
+down_revision = '001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column('assignments', sa.Column('stage_timings', sa.JSON(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column('assignments', 'stage_timings')
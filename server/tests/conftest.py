@@ -0,0 +1,8 @@
+import os
+import sys
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# server и пакет shared из корня репозитория, как в Docker-образе
+sys.path.insert(0, SERVER_DIR)
+sys.path.insert(0, os.path.dirname(SERVER_DIR))
@@ -0,0 +1,86 @@
+import pytest
+
+from app.services import assignment_service
+from app.services.assignment_service import AssignmentService
+from app.services.candidate_pool import CandidatePoolIndex, CANDIDATE_POOL_SIZE
+
+
+class FakeRAG:
+    """hybrid_search_batch_with_legs, отвечающий limit задачами подряд; у каждого вызова свои id"""
+
+    def __init__(self, legs=None):
+        self.legs = legs or {"vector": "ok", "bm25": "ok"}
+        self.requests = []
+        self.calls = 0
+
+    def hybrid_search_batch_with_legs(self, requests):
+        self.requests.extend(requests)
+        self.calls += 1
+        first_id = self.calls * 1000
+        return {
+            "results": [
+                [{"task_id": task_id} for task_id in range(first_id, first_id + request["limit"])]
+                for request in requests
+            ],
+            "legs": self.legs
+        }
+
+
+@pytest.fixture
+def pool_index(monkeypatch):
+    index = CandidatePoolIndex("memory")
+    monkeypatch.setattr(assignment_service, "get_candidate_pool_index", lambda: index)
+    return index
+
+
+def make_service(rag):
+    service = object.__new__(AssignmentService)
+    service.rag_service = rag
+    return service
+
+
+def test_miss_fills_pool_and_next_search_hits_it(pool_index):
+    rag = FakeRAG()
+    service = make_service(rag)
+    topics = [{"topic": "Алгебра", "count": 3}]
+
+    first = service.search_candidate_pools(topics, [2])
+    assert [request["limit"] for request in rag.requests] == [CANDIDATE_POOL_SIZE]
+    assert len(first[(0, 2)]) == CANDIDATE_POOL_SIZE
+
+    second = service.search_candidate_pools(topics, [2])
+    assert len(rag.requests) == 1
+    assert [entry["task_id"] for entry in second[(0, 2)]] == [entry["task_id"] for entry in first[(0, 2)]]
+
+
+def test_limit_above_pool_size_searches_without_rewriting_pool(pool_index):
+    rag = FakeRAG()
+    service = make_service(rag)
+    service.search_candidate_pools([{"topic": "Алгебра", "count": 1}], [2])
+    stored = pool_index.get_many([("Алгебра", 2)])[("Алгебра", 2)]
+
+    big_limit = CANDIDATE_POOL_SIZE + 30
+    pools = service.search_candidate_pools([{"topic": "Алгебра", "count": big_limit // 3 + 1}], [2])
+
+    assert rag.requests[-1]["limit"] > CANDIDATE_POOL_SIZE
+    assert len(pools[(0, 2)]) > CANDIDATE_POOL_SIZE
+    assert pool_index.get_many([("Алгебра", 2)])[("Алгебра", 2)] == stored
+
+
+def test_short_pool_serves_any_limit(pool_index):
+    pool_index.put_many({("Геометрия", 3): [{"task_id": 7}, {"task_id": 8}]})
+    rag = FakeRAG()
+
+    pools = make_service(rag).search_candidate_pools([{"topic": "Геометрия", "count": CANDIDATE_POOL_SIZE}], [3])
+
+    assert rag.requests == []
+    assert [entry["task_id"] for entry in pools[(0, 3)]] == [7, 8]
+
+
+def test_incomplete_search_is_not_stored(pool_index):
+    rag = FakeRAG(legs={"vector": "timeout", "bm25": "ok"})
+
+    pools = make_service(rag).search_candidate_pools([{"topic": "Алгебра", "count": 3}], [2])
+
+    assert len(pools[(0, 2)]) == CANDIDATE_POOL_SIZE
+    assert pool_index.get_many([("Алгебра", 2)]) == {}
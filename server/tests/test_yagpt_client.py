@@ -0,0 +1,191 @@
+import json
+import time
+import socket
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from app.drivers import yagpt_client
+from app.drivers.yagpt_client import YaGPTClient
+
+VARIANT = {
+    "statement_text": "Решите уравнение x² - 5x + 6 = 0",
+    "statement_tex": "x^2 - 5x + 6 = 0",
+    "answer": "x = 2; x = 3",
+    "solution_text": "D = 1",
+    "solution_tex": "D = 1"
+}
+
+
+class MockYaGPT:
+    """Локальный HTTP-сервер с ответами YaGPT; statuses - коды первых ответов, дальше 200"""
+
+    def __init__(self, statuses=(), retry_after=None, delay=0.0):
+        self.statuses = list(statuses)
+        self.retry_after = retry_after
+        self.delay = delay
+        self.requests = 0
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers["Content-Length"]))
+                with mock._lock:
+                    mock.requests += 1
+                    mock.active += 1
+                    mock.max_active = max(mock.max_active, mock.active)
+                    status = mock.statuses.pop(0) if mock.statuses else 200
+                try:
+                    time.sleep(mock.delay)
+                    if status != 200:
+                        self.send_response(status)
+                        if mock.retry_after is not None:
+                            self.send_header("Retry-After", str(mock.retry_after))
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                        return
+                    text = "```json\n" + json.dumps(VARIANT, ensure_ascii=False) + "\n```"
+                    body = json.dumps({"result": {"alternatives": [{"message": {"text": text}}]}}).encode("utf-8")
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                finally:
+                    with mock._lock:
+                        mock.active -= 1
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/completion"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def no_completion_cache(monkeypatch):
+    # Настоящий кэш ходит в Redis и создаёт SQLite-файл под /app/data
+    monkeypatch.setattr(yagpt_client, "get_completion_cache", lambda: None)
+
+
+@pytest.fixture
+def mock_server():
+    servers = []
+
+    def start(**kwargs):
+        server = MockYaGPT(**kwargs)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
+
+
+def make_client(url, **kwargs):
+    return YaGPTClient(api_url=url, api_key="test-key", rate_limit=0, **kwargs)
+
+
+def run_batch(client, count, max_concurrency=4):
+    async def main():
+        try:
+            return await client.generate_variants_batch(
+                [{"id": task_id, "statement_text": f"Задача {task_id}"} for task_id in range(count)],
+                {"target_score": 80},
+                "Ты генерируешь варианты задач ЕГЭ.",
+                max_concurrency=max_concurrency
+            )
+        finally:
+            await client.aclose()
+
+    return asyncio.run(main())
+
+
+def test_retries_429_honoring_retry_after(mock_server):
+    server = mock_server(statuses=[429], retry_after=0.3)
+    client = make_client(server.url, max_retries=2)
+
+    started = time.perf_counter()
+    result = run_batch(client, 1)
+
+    assert result["variants"] == [VARIANT]
+    assert result["stats"]["failed"] == 0
+    assert result["stats"]["retries"] == 1
+    assert server.requests == 2
+    assert time.perf_counter() - started >= 0.3
+
+
+def test_retries_server_errors(mock_server):
+    server = mock_server(statuses=[503, 500])
+    client = make_client(server.url, max_retries=3)
+
+    result = run_batch(client, 1)
+
+    assert result["variants"] == [VARIANT]
+    assert result["stats"]["retries"] == 2
+    assert server.requests == 3
+
+
+def test_exhausted_retries_count_as_failed(mock_server):
+    server = mock_server(statuses=[503, 503])
+    client = make_client(server.url, max_retries=1)
+
+    result = run_batch(client, 1)
+
+    assert result["variants"] == [None]
+    assert result["stats"]["failed"] == 1
+
+
+def test_connection_refused_counts_as_failed():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    client = make_client(f"http://127.0.0.1:{port}/completion", max_retries=1)
+
+    result = run_batch(client, 2)
+
+    assert result["variants"] == [None, None]
+    assert result["stats"]["failed"] == 2
+    assert result["stats"]["retries"] == 2
+
+
+def test_concurrency_stays_within_semaphore(mock_server):
+    server = mock_server(delay=0.05)
+    client = make_client(server.url)
+
+    result = run_batch(client, 12, max_concurrency=3)
+
+    assert result["stats"]["failed"] == 0
+    assert server.requests == 12
+    assert 1 < server.max_active <= 3
+
+
+def test_client_of_finished_loop_is_closed(mock_server):
+    server = mock_server()
+    client = make_client(server.url)
+
+    async def request():
+        await client.generate_completion([{"role": "user", "text": "Привет"}])
+        return await client._get_http_client()
+
+    first = asyncio.run(request())
+    second = asyncio.run(request())
+
+    assert first is not second
+    assert first.is_closed
+    assert list(client._http_clients.values()) == [second]
+
+    asyncio.run(client.aclose())
+    assert second.is_closed
+    assert client._http_clients == {}
@@ -0,0 +1,234 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import time
+import uuid
+from typing import Dict, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+# Меняется при изменении вёрстки PDF, чтобы старые файлы не отдавались
+PDF_LAYOUT_VERSION = "1"
+
+# Ссылки из checkout, оставшиеся после падения процесса, удаляются при вытеснении
+LEASE_MAX_AGE = 3600
+
+
+def normalize_payload(data: Dict[str, Any], pdf_type: str, renderer: str = "service") -> Dict[str, Any]:
+    """Только то, что попадает в документ данного типа"""
+    tasks = []
+    for task in data.get("tasks", []):
+        item = {"statement_text": task.get("statement_text")}
+        if pdf_type == "teacher":
+            item["answer"] = task.get("answer")
+            item["solution_text"] = task.get("solution_text")
+        tasks.append(item)
+
+    return {
+        "layout": PDF_LAYOUT_VERSION,
+        "renderer": renderer,
+        "type": pdf_type,
+        "assignment_id": data.get("assignment_id"),
+        "student": (data.get("student") or {}).get("name"),
+        "topics_text": data.get("topics_text"),
+        "tasks": tasks
+    }
+
+
+def pdf_cache_key(data: Dict[str, Any], pdf_type: str, renderer: str = "service") -> str:
+    normalized = json.dumps(
+        normalize_payload(data, pdf_type, renderer),
+        sort_keys=True,
+        ensure_ascii=False,
+        default=str
+    )
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+
+class PDFCache:
+    """Дисковый кэш PDF, адресуемый хэшем содержимого.
+
+    Время последнего обращения хранится в mtime файла; при превышении
+    max_bytes удаляются самые давно использованные файлы. Запись идёт
+    через временный файл и os.replace, поэтому кэш можно делить между
+    процессами.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._total_bytes: Optional[int] = None
+
+    def path_for(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], f"{key}.pdf")
+
+    def get(self, key: str) -> Optional[str]:
+        path = self.path_for(key)
+        try:
+            os.utime(path)
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def checkout(self, key: str) -> Optional[str]:
+        """Жёсткая ссылка на PDF из кэша для отдачи одним ответом.
+
+        Ссылка создаётся под той же блокировкой, что и вытеснение, поэтому
+        файл нельзя удалить между проверкой и отдачей. Вызывающий код
+        удаляет ссылку после ответа. None, если файла в кэше нет.
+        """
+        path = self.path_for(key)
+        lease_path = os.path.join(self.directory, f"{uuid.uuid4().hex}.lease")
+        with self._lock:
+            try:
+                os.link(path, lease_path)
+                os.utime(path)
+            except OSError:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return lease_path
+
+    def copy_to(self, key: str, target_path: str) -> bool:
+        path = self.get(key)
+        if not path:
+            return False
+        try:
+            shutil.copyfile(path, target_path)
+            return True
+        except OSError as e:
+            logger.warning(f"Could not copy cached PDF {key}: {e}")
+            return False
+
+    def put(self, key: str, content: bytes) -> Optional[str]:
+        return self._store(key, lambda f: f.write(content))
+
+    def put_file(self, key: str, source_path: str) -> Optional[str]:
+        def write(f):
+            with open(source_path, "rb") as src:
+                shutil.copyfileobj(src, f)
+        return self._store(key, write)
+
+    def _store(self, key: str, write) -> Optional[str]:
+        path = self.path_for(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                write(f)
+            size = os.path.getsize(tmp_path)
+            replaced = self._existing_size(path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not store PDF in cache: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return None
+
+        self._account(size - replaced)
+        return path
+
+    def staging_path(self) -> str:
+        """Временный файл в каталоге кэша, чтобы потом добавить его через put_link"""
+        os.makedirs(self.directory, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.close(fd)
+        return path
+
+    def put_link(self, key: str, source_path: str) -> Optional[str]:
+        """Добавляет готовый файл в кэш жёсткой ссылкой, без копирования.
+
+        source_path остаётся на месте, и его можно отдавать, даже если
+        запись в кэше тут же вытеснят.
+        """
+        path = self.path_for(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            size = os.path.getsize(source_path)
+            replaced = self._existing_size(path)
+            os.link(source_path, tmp_path)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not link PDF into cache: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return None
+
+        self._account(size - replaced)
+        return path
+
+    @staticmethod
+    def _existing_size(path: str) -> int:
+        """Размер файла, который будет перезаписан, чтобы не учесть его дважды"""
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    def _account(self, delta: int):
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes += delta
+            needs_eviction = self._total_bytes is None or self._total_bytes > self.max_bytes
+        if needs_eviction:
+            self._evict()
+
+    def _evict(self):
+        """Удаляет самые старые по mtime файлы, пока кэш больше max_bytes"""
+        with self._lock:
+            entries = []
+            stale_before = time.time() - LEASE_MAX_AGE
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                        if name.endswith(".lease") and stat.st_mtime < stale_before:
+                            os.remove(path)
+                    except OSError:
+                        continue
+                    if name.endswith(".pdf"):
+                        entries.append((stat.st_mtime, stat.st_size, path))
+
+            total = sum(size for _, size, _ in entries)
+            removed = 0
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    total -= size
+                    removed += 1
+                except OSError:
+                    continue
+
+            self._total_bytes = total
+        if removed:
+            logger.info(f"Evicted {removed} PDFs from cache, {total} bytes left")
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "directory": self.directory,
+            "max_bytes": self.max_bytes,
+            "size_bytes": self._total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0
+        }